@@ -0,0 +1,234 @@
+"""Offline benchmarks for duplicate_scanner, run against the fake Drive in fake_drive.py.
+
+suite: lists, groups and trashes synthetic drives of increasing size, runs
+a dry run of find_duplicates on each, and reports requests, wall time, peak memory and files per second per phase.
+
+memory: compares the peak RSS of the materializing scan path
+(fetch_all_files followed by a second grouping pass over the raw dicts) with
+the streaming path (iter_files piped into group_by_md5).
+
+projection: compares response bytes and wall time of the full listing with
+the lean listing plus the batched metadata fetch for duplicates.
+
+Every measurement runs in a child process of its own. Peak memory is the
+peak RSS during a phase minus the RSS before it, so the fake drive itself
+is not counted.
+
+    python benchmark_scanner.py suite --sizes 10000,100000,1000000 --latency 0.02
+    python benchmark_scanner.py memory --files 1000000
+    python benchmark_scanner.py projection --files 200000 --latency 0.05
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import duplicate_scanner
+from fake_drive import FakeDriveService, ROOT_ID, build_synthetic_drive
+
+
+def _proc_status_kb(field):
+    """Return a memory field such as VmRSS or VmHWM from /proc/self/status, or None off Linux."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def _reset_peak_rss():
+    """Reset VmHWM so the next peak only covers what runs after this call; returns False if unsupported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class PeakMemory:
+    """Context manager measuring the peak RSS growth, in MB, of the code it wraps."""
+
+    def __enter__(self):
+        self.exact = _reset_peak_rss()
+        self.baseline = _proc_status_kb('VmRSS') if self.exact else 0
+        self.peak_mb = None
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.exact:
+            self.peak_mb = (_proc_status_kb('VmHWM') - self.baseline) / 1024
+        else:
+            # ru_maxrss never goes down, so this is the process peak rather than the phase peak.
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak_mb = peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+        return False
+
+
+def _measure(service, name, function, files):
+    """Run one phase and return its row of results and the phase's return value."""
+    round_trips, calls = service.round_trips, sum(service.requests.values())
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+    return {
+        'phase': name,
+        'round_trips': service.round_trips - round_trips,
+        'api_calls': sum(service.requests.values()) - calls,
+        'seconds': round(elapsed, 3),
+        'peak_mb': round(memory.peak_mb, 1),
+        'files_per_second': round(files / elapsed) if elapsed else None,
+    }, result
+
+
+def run_suite_size(size, latency, workers):
+    """Run every phase on one synthetic drive and return the result rows."""
+    drive = build_synthetic_drive(size)
+    service = FakeDriveService(drive, latency=latency)
+    factory = lambda: service
+    rows = []
+
+    row, _ = _measure(service, 'list flat', lambda: sum(1 for _ in duplicate_scanner.iter_files(service)), size)
+    rows.append(row)
+    row, _ = _measure(service, 'list sharded', lambda: sum(1 for _ in duplicate_scanner.iter_files(
+        service, sharded=True, workers=workers, service_factory=factory)), size)
+    rows.append(row)
+    row, _ = _measure(service, 'list recursive', lambda: sum(1 for _ in duplicate_scanner.iter_files(
+        service, ROOT_ID, recursive=True, workers=workers, service_factory=factory, pack_queries=True)), size)
+    rows.append(row)
+    row, groups = _measure(service, 'group_by_md5', lambda: duplicate_scanner.group_by_md5(
+        duplicate_scanner.iter_files(service)), size)
+    rows.append(row)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        row, _ = _measure(service, 'find_duplicates', lambda: duplicate_scanner.find_duplicates(
+            service, report_path=os.path.join(tmpdir, 'duplicates.jsonl')), size)
+    rows.append(row)
+
+    assistant = duplicate_scanner.SelectionAssistant(service, groups)
+    assistant.mark_all_but_one('oldest')
+    to_trash = assistant.get_files_to_trash()
+    row, _ = _measure(service, 'trash', lambda: duplicate_scanner.trash_files_batched(service, to_trash),
+                      len(to_trash))
+    rows.append(row)
+    return rows
+
+
+def benchmark_suite(sizes, latency, workers):
+    print(f'{latency * 1000:.0f} ms per round trip, {workers} workers for the sharded and recursive listings')
+    print(f"{'files':>9}  {'phase':<16}{'round trips':>12}{'API calls':>11}{'seconds':>10}{'peak MB':>10}{'files/s':>11}")
+    for size in sizes:
+        output = subprocess.run([sys.executable, __file__, '_child', 'suite', str(size), str(latency), str(workers)],
+                                check=True, capture_output=True, text=True).stdout
+        for row in json.loads(output):
+            print(f"{size:>9}  {row['phase']:<16}{row['round_trips']:>12}{row['api_calls']:>11}"
+                  f"{row['seconds']:>10.2f}{row['peak_mb']:>10.1f}{row['files_per_second'] or 0:>11}")
+
+
+def _materialized_groups(service):
+    """The scan path before streaming: list everything, then group the raw dicts."""
+    all_files = duplicate_scanner.fetch_all_files(service)
+    file_dict = {}
+    for file in all_files:
+        if 'md5Checksum' in file:
+            file_dict.setdefault(file['md5Checksum'], []).append(file)
+    return {md5: files for md5, files in file_dict.items() if len(files) > 1}
+
+
+def _streaming_groups(service):
+    return duplicate_scanner.group_by_md5(duplicate_scanner.iter_files(service))
+
+
+MEMORY_PATHS = {'materialized': _materialized_groups, 'streaming': _streaming_groups}
+
+
+def run_memory_path(path, files):
+    service = FakeDriveService(build_synthetic_drive(files))
+    row, groups = _measure(service, path, lambda: MEMORY_PATHS[path](service), files)
+    row['groups'] = len(groups)
+    return row
+
+
+def benchmark_memory(files):
+    print(f'Synthetic drive of {files} files')
+    print(f"{'path':<14}{'groups':>10}{'seconds':>10}{'peak MB':>10}")
+    for path in MEMORY_PATHS:
+        output = subprocess.run([sys.executable, __file__, '_child', 'memory', path, str(files)],
+                                check=True, capture_output=True, text=True).stdout
+        row = json.loads(output)
+        print(f"{path:<14}{row['groups']:>10}{row['seconds']:>10.2f}{row['peak_mb']:>10.1f}")
+
+
+def run_projection(files, latency, workers):
+    # 2% of files copy an earlier one, so about 4% of files are in duplicate groups.
+    drive = build_synthetic_drive(files, duplicate_ratio=0.02)
+    rows = []
+    for mode, lean_listing in (('full', False), ('lean', True)):
+        service = FakeDriveService(drive, latency=latency)
+        row, _ = _measure(service, mode, lambda: duplicate_scanner.find_duplicates(
+            service, lean_listing=lean_listing, workers=workers, service_factory=lambda: service), files)
+        row['mb_received'] = round(service.bytes_received / 1e6, 1)
+        rows.append(row)
+    return rows
+
+
+def benchmark_projection(files, latency, workers):
+    print(f'Synthetic drive of {files} files, {latency * 1000:.0f} ms per round trip, {workers} workers')
+    print(f"{'mode':<8}{'round trips':>13}{'MB received':>13}{'seconds':>10}")
+    output = subprocess.run([sys.executable, __file__, '_child', 'projection', str(files), str(latency), str(workers)],
+                            check=True, capture_output=True, text=True).stdout
+    for row in json.loads(output):
+        print(f"{row['phase']:<8}{row['round_trips']:>13}{row['mb_received']:>13.1f}{row['seconds']:>10.2f}")
+
+
+def _run_child(args):
+    """Entry point of the child processes; prints the result as JSON."""
+    benchmark = args[0]
+    if benchmark == 'suite':
+        result = run_suite_size(int(args[1]), float(args[2]), int(args[3]))
+    elif benchmark == 'memory':
+        result = run_memory_path(args[1], int(args[2]))
+    else:
+        result = run_projection(int(args[1]), float(args[2]), int(args[3]))
+    print(json.dumps(result))
+
+
+def main():
+    logging.disable(logging.WARNING)
+    if len(sys.argv) > 1 and sys.argv[1] == '_child':
+        _run_child(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description='Offline benchmarks for duplicate_scanner')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    suite = subparsers.add_parser('suite', help='Listing, grouping and trashing on synthetic drives')
+    suite.add_argument('--sizes', default='10000,100000,1000000',
+                       help='Comma separated drive sizes in files (default: 10000,100000,1000000)')
+    suite.add_argument('--latency', type=float, default=0.0, help='Seconds per simulated round trip')
+    suite.add_argument('--workers', type=int, default=8, help='Workers used for the sharded and recursive listings')
+    memory = subparsers.add_parser('memory', help='Peak RSS of the materializing and streaming scan paths')
+    memory.add_argument('--files', type=int, default=200000, help='Number of files in the synthetic drive')
+    projection = subparsers.add_parser('projection', help='Full listing against lean listing plus hydration')
+    projection.add_argument('--files', type=int, default=200000, help='Number of files in the synthetic drive')
+    projection.add_argument('--latency', type=float, default=0.05, help='Seconds per simulated round trip')
+    projection.add_argument('--workers', type=int, default=8, help='Workers used for the metadata fetch')
+    args = parser.parse_args()
+
+    if args.benchmark == 'suite':
+        benchmark_suite([int(size) for size in args.sizes.split(',')], args.latency, args.workers)
+    elif args.benchmark == 'memory':
+        benchmark_memory(args.files)
+    elif args.benchmark == 'projection':
+        benchmark_projection(args.files, args.latency, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,149 @@
 from __future__ import print_function
 import os.path
+import csv
+import fnmatch
+import hashlib
+import io
+import json
 import logging
+import logging.handlers
+import sqlite3
+import stat
 import argparse
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+import cProfile
+import queue
+import random
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 import sys
 
-# Configure logging to write logs to a file and the console
-log_format = '%(asctime)s - %(levelname)s - %(message)s'
-logging.basicConfig(filename='drive_scanner.log', level=logging.INFO, format=log_format)
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setLevel(logging.INFO)
-console_handler.setFormatter(logging.Formatter(log_format))
-logging.getLogger().addHandler(console_handler)
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; it is only needed to fingerprint image thumbnails.
+    Image = None
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+DEFAULT_LOG_PATH = 'drive_scanner.log'
+DEFAULT_REPORT_PATH = 'duplicates_report.jsonl'
+PROGRESS_INTERVAL = 5  # Seconds between two progress lines of the same loop
+REPORT_BUFFER_SIZE = 1024 * 1024
 
 # If modifying these SCOPES, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/drive']
 
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+FILE_FIELDS = "nextPageToken, files(id, name, size, md5Checksum, trashed, parents, modifiedTime)"
+FOLDER_TREE_FIELDS = "nextPageToken, files(id, md5Checksum, size, parents)"
+# Lean listings only fetch what grouping needs; duplicates are hydrated with HYDRATE_FIELDS afterwards.
+LEAN_FILE_FIELDS = "nextPageToken, files(id, md5Checksum, size)"
+HYDRATE_FIELDS = "id, name, parents, modifiedTime"
+CHANGE_FIELDS = ("nextPageToken, newStartPageToken, "
+                 "changes(fileId, removed, file(id, name, mimeType, size, md5Checksum, trashed, parents, modifiedTime))")
+# The watch mode also needs the time of each change to measure how far detection lags behind.
+WATCH_CHANGE_FIELDS = ("nextPageToken, newStartPageToken, changes(fileId, removed, time, "
+                       "file(id, name, mimeType, size, md5Checksum, trashed, parents, modifiedTime))")
+DEFAULT_POLL_INTERVAL = 30
+# Drive accepts at most 100 calls in a single batch request.
+MAX_BATCH_SIZE = 100
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+RETRYABLE_STATUSES = (500, 502, 503, 504)
+# Drive's default per-user quota is 12,000 queries per minute.
+DEFAULT_MAX_QPS = 200
+DEFAULT_CHECKPOINT_PATH = 'scan_checkpoint.jsonl'
+SHARD_EPOCH = datetime(2004, 1, 1, tzinfo=timezone.utc)  # Older modification times share the first shard
+PLAN_VERSION = 1
+DEFAULT_HASH_CACHE_PATH = 'local_hash_cache.sqlite'
+LOCAL_HASH_READ_SIZE = 8 * 1024 * 1024
+DEFAULT_FINGERPRINT_CACHE_PATH = 'fingerprint_cache.sqlite'
+NEAR_DUPLICATE_FIELDS = "nextPageToken, files(id, name, mimeType, md5Checksum, parents, modifiedTime, thumbnailLink)"
+# Native files are exported as text to fingerprint them; Sheets export their first sheet only.
+EXPORT_MIME_TYPES = {'application/vnd.google-apps.document': 'text/plain',
+                     'application/vnd.google-apps.presentation': 'text/plain',
+                     'application/vnd.google-apps.spreadsheet': 'text/csv'}
+SHINGLE_WORDS = 5
+# 32 bands of 4 slots make pairs above about 0.6 similarity candidates with high probability.
+MINHASH_SLOTS = 128
+MINHASH_BANDS = 32
+DEFAULT_TEXT_SIMILARITY = 0.8
+DEFAULT_IMAGE_DISTANCE = 4
+# Upper bounds, in seconds, of the latency histogram buckets in the run stats.
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Upper bound for the `in parents` part of a packed recursive listing query.
+MAX_PACKED_QUERY_LENGTH = 2000
+
+
+_log_listener = None
+
+
+def configure_logging(log_path=DEFAULT_LOG_PATH, level=logging.INFO):
+    """Log to a file and stdout from a background thread.
+
+    Logging calls only put the record on a queue, so scans never wait for
+    disk or terminal writes. Call ``stop_logging`` before exiting to flush
+    what is still queued.
+    """
+    global _log_listener
+    stop_logging()
+    formatter = logging.Formatter(LOG_FORMAT)
+    file_handler = logging.FileHandler(log_path)
+    file_handler.setFormatter(formatter)
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    _log_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+    _log_listener.start()
+    return _log_listener
+
+
+def stop_logging():
+    """Write out the queued log records and stop the background logging thread, if it runs."""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+
+class Progress:
+    """Logs the progress of a loop at most once every ``interval`` seconds, however often it is updated.
+
+    ``message`` is a format string filled in with the keyword arguments of
+    ``update``, which the loop can call for every page or item.
+    """
+
+    def __init__(self, message, interval=PROGRESS_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self.next_log = time.monotonic() + interval
+
+    def update(self, **values):
+        now = time.monotonic()
+        if now >= self.next_log:
+            self.next_log = now + self.interval
+            logging.info(self.message.format(**values))
+
+
+def get_credentials(token_path='token.json'):
+    """Load, refresh or request the OAuth credentials for Google Drive, stored in token_path."""
+    # Only needed to sign in, and slow to import.
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
 
-def get_service():
-    """Authorize and return Google Drive service."""
     creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+    if os.path.exists(token_path):
+        creds = Credentials.from_authorized_user_file(token_path, SCOPES)
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
@@ -32,66 +151,356 @@ def get_service():
             flow = InstalledAppFlow.from_client_secrets_file(
                 'credentials.json', SCOPES)
             creds = flow.run_local_server(port=0)
-        with open('token.json', 'w') as token:
+        with open(token_path, 'w') as token:
             token.write(creds.to_json())
-    return build('drive', 'v3', credentials=creds, cache_discovery=False)
+    return creds
+
+
+def get_service(creds=None):
+    """Authorize and return Google Drive service."""
+    if creds is None:
+        creds = get_credentials()
+    service = build('drive', 'v3', credentials=creds, cache_discovery=False)
+    # Requests and batches built from this client share its transport, so this sees every response.
+    _count_response_bytes(service._http)
+    return service
+
+
+def make_service_factory(creds):
+    """Return a callable that hands out one Drive client per thread.
+
+    The httplib2 transport behind the client library is not thread-safe, so
+    every worker thread builds (once) and reuses its own service object.
+    """
+    local = threading.local()
+
+    def factory():
+        if not hasattr(local, 'service'):
+            local.service = get_service(creds)
+        return local.service
+    return factory
 
 
 from googleapiclient.errors import HttpError
 
 
+def _md5_hex(md5):
+    """Return an md5 group key as hex, whether it is a raw digest or already a hex string."""
+    return md5.hex() if isinstance(md5, bytes) else md5
+
+
+class FileRecord:
+    """Compact record of one Drive file that can be a duplicate.
+
+    The md5 digest is kept as 16 raw bytes, the size as an int and parent IDs
+    are interned, so millions of records fit in memory. Records support the
+    same ``record['name']`` / ``record.get('size')`` access as the dicts
+    returned by files().list, so code can handle either. ``source`` is the
+    index of the DriveSource a file came from when several are scanned.
+    """
+    __slots__ = ('id', 'md5', 'size', 'name', 'parents', 'modified_time', 'source')
+
+    _KEYS = {'id': 'id', 'name': 'name', 'size': 'size', 'parents': 'parents', 'modifiedTime': 'modified_time',
+             'source': 'source'}
+
+    def __init__(self, id, md5, size=None, name=None, parents=None, modified_time=None, source=None):
+        self.id = id
+        self.md5 = md5
+        self.size = size
+        self.name = name
+        self.parents = parents
+        self.modified_time = modified_time
+        self.source = source
+
+    @classmethod
+    def from_drive(cls, file):
+        """Build a record from a files().list dict that has an md5Checksum."""
+        return cls(file['id'], bytes.fromhex(file['md5Checksum']),
+                   int(file['size']) if 'size' in file else None, file.get('name'),
+                   tuple(sys.intern(parent) for parent in file['parents']) if 'parents' in file else None,
+                   file.get('modifiedTime'), file.get('source'))
+
+    def __getitem__(self, key):
+        if key == 'md5Checksum':
+            return self.md5.hex()
+        attr = self._KEYS.get(key)
+        value = getattr(self, attr) if attr else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        """Return the record in the shape of a files().list dict."""
+        file = {key: self[key] for key in ('id', 'name', 'md5Checksum', 'parents', 'modifiedTime') if key in self}
+        if 'parents' in file:
+            file['parents'] = list(file['parents'])
+        if self.size is not None:
+            file['size'] = str(self.size)
+        return file
+
+    def __repr__(self):
+        return f"FileRecord({self.to_dict()!r})"
+
+
+class SelectionRule:
+    """Keep or trash the duplicates inside a folder subtree, or whose path matches a glob.
+
+    Paths start at the top folder, as in ``/My Drive/Photos/2020/IMG_1.jpg``,
+    and ``*`` in a glob also matches ``/``.
+    """
+    __slots__ = ('action', 'folder_id', 'path')
+
+    def __init__(self, action, folder_id=None, path=None):
+        if action not in ('keep', 'trash'):
+            raise ValueError(f"Unknown rule action: {action}")
+        if (folder_id is None) == (path is None):
+            raise ValueError("A rule needs either a folder ID or a path glob")
+        self.action = action
+        self.folder_id = folder_id
+        self.path = path
+
+    def __repr__(self):
+        target = f"folder {self.folder_id}" if self.folder_id else f"path {self.path}"
+        return f"SelectionRule({self.action} {target})"
+
+
+def load_rules(path):
+    """Load selection rules from a JSON list like [{"action": "trash", "folder": "<id>"}, {"action": "keep", "path": "/My Drive/Archive/*"}]."""
+    with open(path, encoding='utf-8') as rules_file:
+        return [SelectionRule(rule['action'], rule.get('folder'), rule.get('path')) for rule in json.load(rules_file)]
+
+
+class FolderTree:
+    """Names and parents of Drive folders, used to resolve folder paths and ancestors.
+
+    Folders found by a recursive scan can be passed in up front; ``fetch``
+    looks up any other folder, and its ancestors, through batched
+    files().get requests.
+    """
+
+    def __init__(self, folders=()):
+        self.names = {}
+        self.parents = {}
+        self._paths = {}
+        for folder in folders:
+            self.add(folder)
+
+    def add(self, folder):
+        self.names[folder['id']] = folder.get('name', folder['id'])
+        self.parents[folder['id']] = (folder.get('parents') or [None])[0]
+
+    def fetch(self, service, folder_ids, batch_size=MAX_BATCH_SIZE):
+        """Look up every given folder and ancestor that is not known yet."""
+        missing = self._unknown_ancestors(folder_ids)
+        requests = 0
+        while missing:
+            requests += len(missing)
+
+            def fetched(folder_id, response):
+                self.add(dict(response, id=folder_id))
+
+            def failed(folder_id, error):
+                logging.error(f"Could not look up folder {folder_id}: {error}")
+                self.add({'id': folder_id})
+
+            execute_batched(service, sorted(missing),
+                            lambda folder_id: service.files().get(fileId=folder_id, fields='id, name, parents',
+                                                                          supportsAllDrives=True),
+                            fetched, failed, batch_size)
+            missing = self._unknown_ancestors(missing)
+        if requests:
+            logging.info(f"Looked up {requests} folders to resolve folder paths.")
+
+    def _unknown_ancestors(self, folder_ids):
+        """Return the first unknown folder on the way up from each given folder."""
+        unknown = set()
+        seen = set()
+        for folder_id in folder_ids:
+            node = folder_id
+            while node is not None and node not in seen:
+                seen.add(node)
+                if node not in self.names:
+                    unknown.add(node)
+                    break
+                node = self.parents[node]
+        return unknown
+
+    def path(self, folder_id):
+        """Return the path of a folder, like /My Drive/Photos."""
+        chain = []
+        node = folder_id
+        while node is not None and node not in self._paths:
+            chain.append(node)
+            node = self.parents.get(node)
+        path = self._paths.get(node, '')
+        for node in reversed(chain):
+            path = f"{path}/{self.names.get(node, node)}"
+            self._paths[node] = path
+        return path
+
+
+# Key and direction (True keeps the largest value) of each keep strategy.
+KEEP_STRATEGIES = {
+    'oldest': (lambda file: file.get('modifiedTime', ''), False),
+    'newest': (lambda file: file.get('modifiedTime', ''), True),
+    'smallest': (lambda file: int(file.get('size', 0)), False),
+    'largest': (lambda file: int(file.get('size', 0)), True),
+    'shortest_name': (lambda file: len(file.get('name', '')), False),
+    'longest_name': (lambda file: len(file.get('name', '')), True),
+}
+
+
 class SelectionAssistant:
-    def __init__(self, service, duplicate_groups):
+    """Decides which duplicates to trash from keep and trash rules and a keep strategy.
+
+    Rules are kept in priority order and the first rule that matches a file
+    decides it. Folder rules cover the whole subtree of their folder: the
+    best matching folder rule is computed once per folder and memoized along
+    the ancestor chain of the ``folder_tree``. All path globs are compiled
+    into one regular expression, so each file is matched once. Without a
+    folder tree, folder rules only see the direct parents of a file.
+
+    ``get_files_to_trash`` then evaluates every group in a single pass.
+    Files matched by a keep rule are kept and files matched by a trash rule
+    are trashed. With a keep strategy, the best of the remaining files is
+    kept (or every remaining file is trashed if a keep rule already kept a
+    copy). At least one file of every group is always kept.
+    """
+
+    def __init__(self, service, duplicate_groups, folder_tree=None, sources=None):
         self.service = service
         self.duplicate_groups = duplicate_groups
+        self.folder_tree = folder_tree or FolderTree()
+        self.sources = sources
         self.files_to_trash = []
+        self.rules = []
+        self.keep_strategy = None
+
+    def add_rule(self, rule):
+        """Add a rule below the rules already added."""
+        self.rules.append(rule)
 
     def mark_all_but_one(self, keep_strategy='oldest'):
-        """Marks all but one file in each duplicate group for trashing."""
+        """Keeps only one file in each duplicate group, chosen by the keep strategy."""
         logging.info(f"Applying 'mark all but one' strategy, keeping the {keep_strategy} file.")
-        for md5, files in self.duplicate_groups.items():
-            if len(files) > 1:
-                # Sort files based on strategy to determine which one to keep
-                if keep_strategy == 'oldest':
-                    # Google Drive API does not directly provide creationTime in list, only modifiedTime
-                    # For simplicity, we'll use modifiedTime for now, or assume the first one found is 'oldest'
-                    # A more robust solution would require fetching creationTime for each file if needed.
-                    # For now, let's just keep the first one in the list as a placeholder for 'oldest'
-                    # or implement a proper sort if creationTime becomes available.
-                    files_sorted = sorted(files, key=lambda x: x.get('modifiedTime', ''))
-                elif keep_strategy == 'newest':
-                    files_sorted = sorted(files, key=lambda x: x.get('modifiedTime', ''), reverse=True)
-                elif keep_strategy == 'smallest':
-                    files_sorted = sorted(files, key=lambda x: int(x.get('size', 0)))
-                elif keep_strategy == 'largest':
-                    files_sorted = sorted(files, key=lambda x: int(x.get('size', 0)), reverse=True)
-                elif keep_strategy == 'shortest_name':
-                    files_sorted = sorted(files, key=lambda x: len(x.get('name', '')))
-                elif keep_strategy == 'longest_name':
-                    files_sorted = sorted(files, key=lambda x: len(x.get('name', '')), reverse=True)
-                else:
-                    logging.warning(f"Unknown keep strategy: {keep_strategy}. Defaulting to keeping the first file.")
-                    files_sorted = files
-
-                # Keep the first file in the sorted list, trash the rest
-                self.files_to_trash.extend(files_sorted[1:])
-                logging.info(f"Marked {len(files_sorted) - 1} files for trashing in group {md5}.")
+        if keep_strategy not in KEEP_STRATEGIES:
+            logging.warning(f"Unknown keep strategy: {keep_strategy}. Defaulting to keeping the first file.")
+        self.keep_strategy = keep_strategy
 
     def mark_by_folder(self, folder_id_to_trash):
-        """Marks files for trashing if they are within the specified folder ID."""
+        """Marks files for trashing if they are within the specified folder or its subfolders."""
         logging.info(f"Marking files in folder ID: {folder_id_to_trash} for trashing.")
-        for md5, files in self.duplicate_groups.items():
+        self.add_rule(SelectionRule('trash', folder_id=folder_id_to_trash))
+
+    def needs_folder_tree(self):
+        return bool(self.rules)
+
+    def fetch_folder_tree(self):
+        """Look up the folders holding the duplicates, and their ancestors, that the folder tree lacks.
+
+        With ``sources``, each file's folders are looked up through the
+        account of the DriveSource it came from, since other accounts may
+        not be able to see them.
+        """
+        parents_by_source = {}
+        for files in self.duplicate_groups.values():
             for file in files:
-                if 'parents' in file and folder_id_to_trash in file['parents']:
-                    self.files_to_trash.append(file)
-                    logging.info(f"Marked file {file['name']} (ID: {file['id']}) in folder {folder_id_to_trash} for trashing.")
+                source = file.get('source') if self.sources else None
+                parents_by_source.setdefault(source, set()).update(file.get('parents') or ())
+        for source, parents in parents_by_source.items():
+            service = self.service if source is None else self.sources[source].service_factory()
+            self.folder_tree.fetch(service, parents)
+
+    def _compile(self):
+        """Return (memoized folder rule lookup, compiled path globs or None) for the current rules."""
+        folder_rules = {}
+        for index, rule in enumerate(self.rules):
+            if rule.folder_id is not None:
+                folder_rules.setdefault(rule.folder_id, index)
+        globs = [f"(?P<r{index}>{fnmatch.translate(rule.path)})" for index, rule in enumerate(self.rules)
+                 if rule.path is not None]
+        pattern = re.compile('|'.join(globs)) if globs else None
+        no_rule = len(self.rules)
+        memo = {}
+        parents = self.folder_tree.parents
+
+        def folder_rule(folder_id):
+            # Walk up to the first folder with a known answer, then fill in the chain on the way back.
+            chain = []
+            node = folder_id
+            while node is not None and node not in memo:
+                chain.append(node)
+                node = parents.get(node)
+            best = memo.get(node, no_rule)
+            for node in reversed(chain):
+                best = min(best, folder_rules.get(node, no_rule))
+                memo[node] = best
+            return best
+
+        return folder_rule, pattern
+
+    def _decide(self, files, folder_rule, pattern):
+        """Return the files of one group to trash."""
+        keep, trash, undecided = [], [], []
+        no_rule = len(self.rules)
+        for file in files:
+            best = no_rule
+            for parent in file.get('parents') or ():
+                best = min(best, folder_rule(parent))
+                if pattern is not None:
+                    # Alternatives are tried in rule order, so the first full match is the highest priority glob.
+                    match = pattern.match(f"{self.folder_tree.path(parent)}/{file.get('name', '')}")
+                    if match:
+                        best = min(best, int(match.lastgroup[1:]))
+            if best == no_rule:
+                undecided.append(file)
+            elif self.rules[best].action == 'keep':
+                keep.append(file)
+            else:
+                trash.append(file)
+
+        if self.keep_strategy:
+            if keep:
+                trash.extend(undecided)
+            elif undecided:
+                kept = self._best(undecided)
+                trash.extend(file for file in undecided if file is not kept)
+        if len(trash) == len(files):
+            kept = self._best(trash)
+            logging.warning(f"Rules would trash every copy of {kept['name']}; keeping {kept['id']}.")
+            trash = [file for file in trash if file is not kept]
+        # A file listed twice is one file, so trashing one of its entries would trash the copy being kept.
+        trashed = {id(file) for file in trash}
+        kept_ids = {file['id'] for file in files if id(file) not in trashed}
+        return [file for file in trash if file['id'] not in kept_ids]
+
+    def _best(self, files):
+        """Return the file the keep strategy keeps, or the first file without one."""
+        key, largest = KEEP_STRATEGIES.get(self.keep_strategy, (None, False))
+        if key is None:
+            return files[0]
+        return max(files, key=key) if largest else min(files, key=key)
 
     def get_files_to_trash(self):
         """Returns the list of files marked for trashing."""
-        # Remove duplicates from the list of files to trash (a file might be marked by multiple rules)
+        marked = list(self.files_to_trash)
+        if self.rules or self.keep_strategy:
+            folder_rule, pattern = self._compile()
+            for md5, files in self.duplicate_groups.items():
+                marked.extend(self._decide(files, folder_rule, pattern))
+        # Remove duplicates from the list of files to trash (a file might be marked more than once)
         unique_files_to_trash = []
         seen_ids = set()
-        for file in self.files_to_trash:
+        for file in marked:
             if file['id'] not in seen_ids:
                 unique_files_to_trash.append(file)
                 seen_ids.add(file['id'])
@@ -101,146 +510,2434 @@ class SelectionAssistant:
 def move_file_to_trash(service, file):
     """Move the given file to trash."""
     try:
-        service.files().update(fileId=file['id'], body={'trashed': True}).execute()
+        call_api(service.files().update(fileId=file['id'], body={'trashed': True}, supportsAllDrives=True))
         logging.info(f"Successfully moved file {file['name']} (ID: {file['id']}) to trash.")
     except HttpError as error:
         logging.error(f"An error occurred while moving file {file['name']} (ID: {file['id']}) to trash: {error}")
 
 
-def fetch_all_files(service, folder_id=None, recursive=False):
-    """Fetch all file metadata from Google Drive."""
-    
-    if folder_id and recursive:
-        logging.info("Starting recursive folder scan...")
-        all_folder_ids = [folder_id]
-        folders_to_process = [folder_id]
-        while folders_to_process:
-            current_folder_id = folders_to_process.pop(0)
-            page_token = None
-            while True:
-                folder_query = f"'{current_folder_id}' in parents and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
-                response = service.files().list(q=folder_query, pageSize=1000, fields="nextPageToken, files(id, name)", pageToken=page_token).execute()
-                subfolders = response.get('files', [])
-                for folder in subfolders:
-                    all_folder_ids.append(folder['id'])
-                    folders_to_process.append(folder['id'])
-                page_token = response.get('nextPageToken', None)
-                if page_token is None:
-                    break
-        
-        logging.info(f"Found {len(all_folder_ids)} total folders to scan.")
-        
-        all_files = []
-        for i, f_id in enumerate(all_folder_ids, 1):
-            page_token = None
+def _is_rate_limited(error):
+    """Return True if an HttpError is a 429 or a 403 rate limit error."""
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    if error.resp.status == 403:
+        content = error.content.decode('utf-8', 'replace') if isinstance(error.content, bytes) else str(error.content)
+        return any(reason in content for reason in RATE_LIMIT_REASONS)
+    return False
+
+
+def _is_retryable(error):
+    """Return True for errors worth retrying: rate limits, server errors and dropped connections."""
+    if isinstance(error, HttpError):
+        return _is_rate_limited(error) or error.resp.status in RETRYABLE_STATUSES
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+def _endpoint(request):
+    """Name of the API method behind a request, such as files.list, or batch for a batch request."""
+    name = getattr(request, 'methodId', None) or getattr(request, 'endpoint', None)
+    if not isinstance(name, str):
+        return 'batch'
+    return name[len('drive.'):] if name.startswith('drive.') else name
+
+
+class RunStats:
+    """Counters for one run: per endpoint latency histograms and counts, bytes received, retries and phases.
+
+    Every call made through ``call_api`` is recorded by the RequestScheduler.
+    Phases are timed exclusively: time spent in a nested phase, or waiting
+    on an iterator wrapped by ``timed``, is charged to that phase and not to
+    the enclosing one, so listing and grouping can be told apart even though
+    the grouping consumes the listing as it streams.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.clock_started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.bytes_received = 0
+        self.phases = {}
+        self.local = threading.local()
+
+    def _endpoint_stats(self, endpoint):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = {'calls': 0, 'batched_calls': 0, 'errors': 0, 'retries': 0,
+                                                'rate_limited': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                'histogram': [0] * (len(LATENCY_BUCKETS) + 1)}
+        return stats
+
+    def record_call(self, endpoint, seconds, cost=1, error=None):
+        """Record one round trip; ``cost`` is the number of calls in a batch."""
+        bucket = bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            stats = self._endpoint_stats(endpoint)
+            stats['calls'] += 1
+            if endpoint == 'batch':
+                stats['batched_calls'] += cost
+            stats['errors'] += error is not None
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['histogram'][bucket] += 1
+
+    def record_retries(self, endpoint, count=1, rate_limited=0):
+        with self.lock:
+            stats = self._endpoint_stats(endpoint)
+            stats['retries'] += count
+            stats['rate_limited'] += rate_limited
+
+    def add_bytes(self, count):
+        with self.lock:
+            self.bytes_received += count
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def add_phase(self, name, seconds, items=0):
+        with self.lock:
+            phase = self.phases.setdefault(name, {'seconds': 0.0, 'items': 0})
+            phase['seconds'] += seconds
+            phase['items'] += items
+
+    @contextmanager
+    def phase(self, name):
+        """Time a pipeline phase; yields a dict whose 'items' the caller sets to the number of items handled."""
+        counter = {'items': 0}
+        stack = self._stack()
+        # Each entry is [start, seconds charged to nested phases].
+        entry = [time.perf_counter(), 0.0]
+        stack.append(entry)
+        try:
+            yield counter
+        finally:
+            stack.pop()
+            elapsed = time.perf_counter() - entry[0]
+            self.add_phase(name, elapsed - entry[1], counter['items'])
+            if stack:
+                stack[-1][1] += elapsed
+
+    def timed(self, iterable, name, counter=None):
+        """Yield from ``iterable``, charging the time spent waiting for each item to phase ``name``.
+
+        The number of items is also added to the optional ``counter`` of the enclosing phase.
+        """
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        clock = time.perf_counter
+        iterator = iter(iterable)
+        spent = 0.0
+        items = 0
+        try:
             while True:
-                file_query = f"'{f_id}' in parents and mimeType != 'application/vnd.google-apps.folder' and trashed = false"
-                response = service.files().list(q=file_query, pageSize=1000, fields="nextPageToken, files(id, name, size, md5Checksum, trashed, parents)", pageToken=page_token).execute()
-                all_files.extend(response.get('files', []))
-                page_token = response.get('nextPageToken', None)
-                if page_token is None:
-                    break
-            logging.info(f"Scanned folder {i} of {len(all_folder_ids)}. Total files found: {len(all_files)}")
-        return all_files
+                start = clock()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    spent += clock() - start
+                items += 1
+                yield item
+        finally:
+            self.add_phase(name, spent, items)
+            if counter is not None:
+                counter['items'] += items
+            if parent is not None:
+                parent[1] += spent
+
+    def report(self):
+        """Return the stats as a JSON-serializable dict."""
+        elapsed = time.perf_counter() - self.clock_started
+        bounds = [f"<={bound * 1000:g}ms" for bound in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1] * 1000:g}ms"]
+        with self.lock:
+            requests = {}
+            for endpoint, stats in sorted(self.endpoints.items()):
+                calls = stats['calls']
+                requests[endpoint] = {
+                    'calls': calls, 'errors': stats['errors'], 'retries': stats['retries'],
+                    'rate_limited': stats['rate_limited'],
+                    'mean_ms': round(stats['seconds'] / calls * 1000, 1) if calls else None,
+                    'max_ms': round(stats['max_seconds'] * 1000, 1),
+                    'histogram': dict(zip(bounds, stats['histogram'])),
+                }
+                if endpoint == 'batch':
+                    requests[endpoint]['batched_calls'] = stats['batched_calls']
+            phases = {name: {'seconds': round(phase['seconds'], 3), 'items': phase['items'],
+                             'items_per_second': round(phase['items'] / phase['seconds'], 1) if phase['seconds'] else None}
+                      for name, phase in self.phases.items()}
+            return {
+                'started': _format_drive_time(datetime.fromtimestamp(self.started, timezone.utc)),
+                'seconds': round(elapsed, 3),
+                'round_trips': sum(stats['calls'] for stats in self.endpoints.values()),
+                'retries': sum(stats['retries'] for stats in self.endpoints.values()),
+                'bytes_received': self.bytes_received,
+                'scheduler': _scheduler.report(),
+                'requests': requests,
+                'phases': phases,
+            }
+
+    def write(self, path):
+        with open(path, 'w') as report:
+            json.dump(self.report(), report, indent=2)
+        logging.info(f"Run stats written to {path}.")
+
+
+_stats = RunStats()
+
+
+def reset_stats():
+    """Start a new RunStats, e.g. for each run in a long-lived process, and return it."""
+    global _stats
+    _stats = RunStats()
+    return _stats
+
+
+def _count_response_bytes(http):
+    """Wrap an httplib2-style transport so the size of every response body is added to the run stats."""
+    request = http.request
+
+    def counted(*args, **kwargs):
+        response, content = request(*args, **kwargs)
+        _stats.add_bytes(len(content or b''))
+        return response, content
+    http.request = counted
+    return http
+
+
+class RequestScheduler:
+    """Central gate that every Drive API call goes through.
+
+    A token bucket keeps the request rate under ``max_qps`` (None disables
+    it). The number of calls in flight is adjusted AIMD style: it grows by
+    one per window of successful calls up to ``max_concurrency`` and is
+    halved on every rate limit response. Rate limits, 5xx responses and
+    connection errors are retried with exponential backoff and jitter.
+    """
+
+    def __init__(self, max_qps=None, max_concurrency=64, max_retries=8, base_delay=1.0, max_delay=64.0):
+        self.max_qps = max_qps
+        # A whole batch is charged at once, so the bucket must hold at least one full batch.
+        self.burst = max(max_qps, MAX_BATCH_SIZE) if max_qps else None
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.condition = threading.Condition()
+
+    def backoff_delay(self, attempt):
+        """Exponential backoff delay for the given retry attempt, with jitter."""
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def throttled(self):
+        """Multiplicative decrease of the concurrency limit after a rate limit response."""
+        with self.condition:
+            self.concurrency = max(1.0, self.concurrency / 2)
+            logging.debug(f"Rate limited, concurrency limit lowered to {int(self.concurrency)}.")
 
-    all_files = []
+    def _succeeded(self):
+        # Additive increase: roughly +1 per window of `concurrency` successful calls.
+        with self.condition:
+            self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / self.concurrency)
+            self.condition.notify_all()
+
+    def _take_tokens(self, cost):
+        if not self.max_qps:
+            return
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.max_qps)
+                self.updated = now
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                wait_time = (cost - self.tokens) / self.max_qps
+            time.sleep(wait_time)
+
+    def report(self):
+        """Return the limits and the peak concurrency reached, for the run stats."""
+        with self.condition:
+            return {'max_qps': self.max_qps, 'max_concurrency': self.max_concurrency,
+                    'concurrency_limit': int(self.concurrency), 'peak_in_flight': self.peak_in_flight}
+
+    def execute(self, request, cost=1):
+        """Execute a request (or a batch of ``cost`` requests) and return its response."""
+        endpoint = _endpoint(request)
+        attempt = 0
+        while True:
+            with self.condition:
+                while self.in_flight >= int(self.concurrency):
+                    self.condition.wait()
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            try:
+                self._take_tokens(cost)
+                started = time.perf_counter()
+                try:
+                    response = request.execute()
+                except Exception as error:
+                    _stats.record_call(endpoint, time.perf_counter() - started, cost, error)
+                    raise
+                _stats.record_call(endpoint, time.perf_counter() - started, cost)
+            except Exception as error:
+                if not _is_retryable(error) or attempt >= self.max_retries:
+                    raise
+                rate_limited = _is_rate_limited(error)
+                if rate_limited:
+                    self.throttled()
+                _stats.record_retries(endpoint, rate_limited=int(rate_limited))
+                attempt += 1
+                delay = self.backoff_delay(attempt)
+                logging.warning(f"Request failed ({error}), retrying in {delay:.1f}s (attempt {attempt} of {self.max_retries}).")
+            else:
+                self._succeeded()
+                return response
+            finally:
+                with self.condition:
+                    self.in_flight -= 1
+                    self.condition.notify_all()
+            time.sleep(delay)
+
+
+_scheduler = RequestScheduler()
+
+
+def configure_scheduler(**kwargs):
+    """Replace the shared RequestScheduler, e.g. to size it to the project quota."""
+    global _scheduler
+    _scheduler = RequestScheduler(**kwargs)
+    return _scheduler
+
+
+def call_api(request, cost=1):
+    """Execute a Drive API request through the shared RequestScheduler."""
+    return _scheduler.execute(request, cost)
+
+
+def execute_batched(service, items, make_request, on_success=None, on_failure=None,
+                    batch_size=MAX_BATCH_SIZE, max_retries=5):
+    """Run one Drive request per item through batch HTTP requests.
+
+    ``make_request(item)`` builds the request for an item. Up to
+    ``batch_size`` requests share one HTTP round trip and each result is
+    handled on its own: ``on_success(item, response)`` or
+    ``on_failure(item, error)`` is called per item, except that rate limited
+    items and server errors are requeued and retried with exponential
+    backoff first. Returns
+    the lists of items that succeeded and failed.
+    """
+    succeeded = []
+    failed = []
+    queue = list(items)
+    attempt = 0
+    while queue:
+        requeue = []
+        rate_limited = []
+
+        def handle(item, response, error):
+            if error is None:
+                succeeded.append(item)
+                if on_success:
+                    on_success(item, response)
+            elif _is_retryable(error) and attempt < max_retries:
+                requeue.append(item)
+                if _is_rate_limited(error):
+                    rate_limited.append(item)
+            else:
+                failed.append(item)
+                if on_failure:
+                    on_failure(item, error)
+
+        for start in range(0, len(queue), batch_size):
+            chunk = {str(i): item for i, item in enumerate(queue[start:start + batch_size])}
+            batch = service.new_batch_http_request(
+                callback=lambda request_id, response, exception, chunk=chunk: handle(chunk[request_id], response,
+                                                                                     exception))
+            for request_id, item in chunk.items():
+                batch.add(make_request(item), request_id=request_id)
+            try:
+                call_api(batch, cost=len(chunk))
+            except HttpError as error:
+                # The batch request itself failed, so none of its items were applied.
+                for item in chunk.values():
+                    handle(item, None, error)
+
+        queue = requeue
+        if queue:
+            _stats.record_retries('batch item', len(queue), len(rate_limited))
+            attempt += 1
+            if rate_limited:
+                _scheduler.throttled()
+            delay = _scheduler.backoff_delay(attempt)
+            logging.warning(f"{len(queue)} batched requests failed temporarily ({len(rate_limited)} rate limited), retrying in {delay:.1f}s (attempt {attempt} of {max_retries}).")
+            time.sleep(delay)
+    return succeeded, failed
+
+
+def trash_files_batched(service, files, batch_size=MAX_BATCH_SIZE, max_retries=5):
+    """Move files to trash using Drive batch requests.
+
+    Results are logged per file like ``move_file_to_trash`` does. Returns
+    the lists of trashed and failed files.
+    """
+    def trashed(file, response):
+        logging.info(f"Successfully moved file {file['name']} (ID: {file['id']}) to trash.")
+
+    def failed(file, error):
+        logging.error(f"An error occurred while moving file {file['name']} (ID: {file['id']}) to trash: {error}")
+
+    with _stats.phase('trashing') as trashing:
+        trashing['items'] = len(files)
+        return execute_batched(service, files,
+                               lambda file: service.files().update(fileId=file['id'], body={'trashed': True},
+                                                                   supportsAllDrives=True),
+                               trashed, failed, batch_size, max_retries)
+
+
+def hydrate_records(service, duplicate_groups, workers=1, service_factory=None, batch_size=MAX_BATCH_SIZE):
+    """Fetch name, parents and modifiedTime for every FileRecord in the duplicate groups.
+
+    This is the second phase of a lean listing: only members of duplicate
+    groups are looked up, through batched files().get requests. With several
+    workers the records are split into one slice per worker, each sent
+    through its own client from ``service_factory``. Records that could not
+    be fetched, usually because the file is gone, are removed from
+    ``duplicate_groups`` together with groups left with fewer than two files,
+    so nothing is selected or reported without its metadata.
+    """
+    records = [record for group in duplicate_groups.values() for record in group]
+    logging.info(f"Fetching metadata for {len(records)} duplicate files.")
+
+    def fetched(record, response):
+        record.name = response.get('name')
+        if 'parents' in response:
+            record.parents = tuple(sys.intern(parent) for parent in response['parents'])
+        record.modified_time = response.get('modifiedTime')
+
+    def failed(record, error):
+        logging.error(f"An error occurred while fetching metadata for file ID {record.id}: {error}")
+
+    def hydrate(worker_service, records_slice):
+        return execute_batched(worker_service, records_slice,
+                               lambda record: worker_service.files().get(fileId=record.id, fields=HYDRATE_FIELDS,
+                                                                                         supportsAllDrives=True),
+                               fetched, failed, batch_size)
+
+    if workers <= 1 or service_factory is None:
+        fetched_records, failed_records = hydrate(service, records)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda records_slice: hydrate(service_factory(), records_slice),
+                                        [records[i::workers] for i in range(workers)]))
+        fetched_records = [r for ok, _ in results for r in ok]
+        failed_records = [r for _, bad in results for r in bad]
+
+    if failed_records:
+        failed_ids = {record.id for record in failed_records}
+        for md5 in list(duplicate_groups):
+            group = [record for record in duplicate_groups[md5] if record.id not in failed_ids]
+            if len(group) >= 2:
+                duplicate_groups[md5] = group
+            else:
+                del duplicate_groups[md5]
+        logging.warning(f"Left out {len(failed_records)} files whose metadata could not be fetched.")
+    return fetched_records, failed_records
+
+
+def _list_query(service, query, fields):
+    """Follow the nextPageToken chain of a files().list query.
+
+    Returns the collected files and the number of requests it took.
+    """
+    results = []
+    requests = 0
     page_token = None
+    while True:
+        # Folder queries work in shared drives too, where the items are only returned with these flags.
+        response = call_api(service.files().list(q=query, pageSize=1000, fields=fields, pageToken=page_token,
+                                                 supportsAllDrives=True, includeItemsFromAllDrives=True))
+        requests += 1
+        results.extend(response.get('files', []))
+        page_token = response.get('nextPageToken', None)
+        if page_token is None:
+            break
+    return results, requests
+
+
+def _parents_clause(folder_ids):
+    """Build a `in parents` clause matching the children of any of the given folders."""
+    clause = ' or '.join(f"'{f_id}' in parents" for f_id in folder_ids)
+    return f"({clause})" if len(folder_ids) > 1 else clause
+
+
+def _pack_folder_ids(folder_ids, max_query_length):
+    """Split folder IDs into chunks whose packed `in parents` clause fits in max_query_length.
+
+    A max_query_length of 0 disables packing and yields one folder per chunk.
+    """
+    chunk = []
+    length = 0
+    for f_id in folder_ids:
+        term_length = len(f_id) + len("'' in parents or ")
+        if chunk and (not max_query_length or length + term_length > max_query_length):
+            yield chunk
+            chunk = []
+            length = 0
+        chunk.append(f_id)
+        length += term_length
+    if chunk:
+        yield chunk
+
+
+def _list_subfolders(service, folder_ids):
+    """Return the direct, non-trashed subfolders of the given folders."""
+    query = f"{_parents_clause(folder_ids)} and mimeType = '{FOLDER_MIME_TYPE}' and trashed = false"
+    return _list_query(service, query, "nextPageToken, files(id, name, parents)")
+
+
+def _list_folder_files(service, folder_ids, fields=FILE_FIELDS):
+    """Return the direct, non-trashed non-folder children of the given folders."""
+    query = f"{_parents_clause(folder_ids)} and mimeType != '{FOLDER_MIME_TYPE}' and trashed = false"
+    return _list_query(service, query, fields)
+
+
+class ScanCheckpoint:
+    """Append-only JSON lines log of a scan's progress, used to resume an interrupted scan.
+
+    The first line describes the scan. Every completed listing step then
+    appends one line: a flat listing page with its nextPageToken, a
+    recursive subfolder query with the folders it found, a recursive file
+    query with its files, or a sharded listing page with the shards that
+    replace it. Lines are flushed as they are written, so an
+    interrupted scan loses at most the step in flight. A truncated last line
+    is ignored on load.
+    """
+
+    def __init__(self, path, scan, resume=False):
+        self.path = path
+        self.scan = scan
+        self.resumed = resume and os.path.exists(path)
+        self.replay_size = 0
+        if self.resumed:
+            with open(path, 'rb') as checkpoint:
+                header = json.loads(checkpoint.readline())
+                if header.get('scan') != scan:
+                    raise ValueError(f"The checkpoint {path} was written for a different scan: {header.get('scan')}")
+                # Only replay complete lines; whatever follows was cut off by the interruption.
+                self.replay_size = checkpoint.tell()
+                for line in checkpoint:
+                    if not line.endswith(b'\n'):
+                        break
+                    self.replay_size += len(line)
+            self.file = open(path, 'r+', encoding='utf-8')
+            self.file.truncate(self.replay_size)
+            self.file.seek(self.replay_size)
+        else:
+            self.file = open(path, 'w', encoding='utf-8')
+            self._append({'t': 'scan', 'scan': scan})
+
+    def _append(self, entry):
+        self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self.file.flush()
+
+    def _entries(self):
+        """Yield the entries written before this run."""
+        if not self.resumed:
+            return
+        with open(self.path, 'rb') as checkpoint:
+            position = len(checkpoint.readline())
+            for line in checkpoint:
+                position += len(line)
+                if position > self.replay_size:
+                    break
+                yield json.loads(line)
+
+    def record_page(self, next_page_token, files):
+        self._append({'t': 'page', 'next': next_page_token, 'files': files})
+
+    def record_subfolders(self, folder_ids, subfolder_ids):
+        self._append({'t': 'folders', 'chunk': folder_ids, 'found': subfolder_ids})
+
+    def record_files(self, folder_ids, files):
+        self._append({'t': 'files', 'chunk': folder_ids, 'files': files})
+
+    def record_shard(self, shard, next_shards, files):
+        self._append({'t': 'shard', 'shard': shard, 'next': next_shards, 'files': files})
+
+    def replay_files(self):
+        """Yield the files recorded before this run."""
+        for entry in self._entries():
+            if entry['t'] in ('page', 'files', 'shard'):
+                yield from entry['files']
+
+    def flat_state(self):
+        """Return (page_token, finished) for resuming a flat listing."""
+        page_token, finished = None, False
+        for entry in self._entries():
+            if entry['t'] == 'page':
+                page_token, finished = entry['next'], entry['next'] is None
+        return page_token, finished
+
+    def recursive_state(self, folder_id):
+        """Return (discovered folders, folders with subfolders listed, folders with files listed)."""
+        discovered = [folder_id]
+        discover_done = set()
+        files_done = set()
+        for entry in self._entries():
+            if entry['t'] == 'folders':
+                discover_done.update(entry['chunk'])
+                discovered.extend(entry['found'])
+            elif entry['t'] == 'files':
+                files_done.update(entry['chunk'])
+        return discovered, discover_done, files_done
+
+    def sharded_state(self):
+        """Return the shards still to be listed, or None if the sharded listing never started."""
+        pending = None
+        for entry in self._entries():
+            if entry['t'] == 'shard':
+                pending = {} if pending is None else pending
+                if entry['shard']:
+                    pending.pop(tuple(entry['shard'][:3]), None)
+                for shard in entry['next']:
+                    pending[tuple(shard[:3])] = shard
+        return None if pending is None else list(pending.values())
+
+    def close(self):
+        self.file.close()
+
+
+def _iter_recursive(service_factory, folder_id, workers, max_query_length=0, fields=FILE_FIELDS, checkpoint=None,
+                    folders=None):
+    """Walk a folder tree with a pool of workers, yielding files as folders are listed.
+
+    Every batch of folders yields two independent tasks: one lists their
+    subfolders (which schedules the same two tasks for the children) and one
+    lists their files. The traversal and the file listing therefore run in a
+    single pipelined pass with up to ``workers`` requests in flight.
+
+    With ``max_query_length`` set, the folders discovered by one task are
+    packed into OR-ed `in parents` queries up to that length. Both queries
+    request the ``parents`` field, so every result still maps back to the
+    folder it belongs to.
+
+    Completed tasks are recorded in ``checkpoint``; a resumed checkpoint
+    replays its files and only schedules the tasks that never completed.
+    Every subfolder found is stored by id in the optional ``folders`` dict.
+    """
+    def discover(folder_ids):
+        return _list_subfolders(service_factory(), folder_ids)
+
+    def list_files(folder_ids):
+        return _list_folder_files(service_factory(), folder_ids, fields)
+
+    discovered, discover_done, files_done = [folder_id], set(), set()
+    if checkpoint and checkpoint.resumed:
+        discovered, discover_done, files_done = checkpoint.recursive_state(folder_id)
+        logging.info(f"Resuming recursive scan: {len(discovered)} folders found, {len(files_done)} already listed.")
+    files_found = 0
+    progress = Progress("Scanned folder {scanned} of {found} found so far. Total files found: {files}")
+    if checkpoint:
+        for file in checkpoint.replay_files():
+            files_found += 1
+            yield file
+    seen_folders = set(discovered)
+    folders_found = len(discovered)
+    folders_scanned = len(files_done)
+    requests = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        def schedule(kind, task, folder_ids):
+            for chunk in _pack_folder_ids(folder_ids, max_query_length):
+                pending[executor.submit(task, chunk)] = (kind, chunk)
+
+        schedule('folders', discover, [f_id for f_id in discovered if f_id not in discover_done])
+        schedule('files', list_files, [f_id for f_id in discovered if f_id not in files_done])
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, chunk = pending.pop(future)
+                results, task_requests = future.result()
+                requests += task_requests
+                if kind == 'folders':
+                    if folders is not None:
+                        folders.update((folder['id'], folder) for folder in results)
+                    subfolder_ids = [folder['id'] for folder in results if folder['id'] not in seen_folders]
+                    seen_folders.update(subfolder_ids)
+                    folders_found += len(subfolder_ids)
+                    if checkpoint:
+                        checkpoint.record_subfolders(chunk, subfolder_ids)
+                    schedule('folders', discover, subfolder_ids)
+                    schedule('files', list_files, subfolder_ids)
+                else:
+                    if checkpoint:
+                        checkpoint.record_files(chunk, results)
+                    files_found += len(results)
+                    folders_scanned += len(chunk)
+                    progress.update(scanned=folders_scanned, found=folders_found, files=files_found)
+                    yield from results
+    logging.info(f"Found {folders_found} total folders to scan.")
+    if max_query_length:
+        # Unpacked, every folder costs at least one subfolder and one file request.
+        saved = 2 * folders_found - requests
+        logging.info(f"Query packing issued {requests} list requests for {folders_found} folders, saving {saved} requests.")
+
+
+def _with_modified_time(fields):
+    """Add modifiedTime to a files.list fields selector if it is not there yet."""
+    return fields if 'modifiedTime' in fields else fields.replace('files(', 'files(modifiedTime, ', 1)
+
+
+def _with_owned_by_me(fields):
+    """Add ownedByMe to a files.list fields selector if it is not there yet."""
+    return fields if 'ownedByMe' in fields else fields.replace('files(', 'files(ownedByMe, ', 1)
+
+
+def _format_drive_time(moment):
+    """Format a UTC datetime the way Drive returns modifiedTime, so the two compare as strings."""
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.') + f'{moment.microsecond // 1000:03d}Z'
+
+
+def _parse_drive_time(value):
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
+
+
+def _modified_time_clause(start, end):
+    """Return the query clause for start <= modifiedTime < end; either bound may be None."""
+    clauses = []
+    if start:
+        clauses.append(f"modifiedTime >= '{start}'")
+    if end:
+        clauses.append(f"modifiedTime < '{end}'")
+    return ' and '.join(clauses)
+
+
+def _initial_shards(count, now):
+    """Split all modification times into count + 1 disjoint ranges, open-ended at both sides."""
+    step = (now - SHARD_EPOCH) / count
+    bounds = [None] + [_format_drive_time(SHARD_EPOCH + step * i) for i in range(count)] + [None]
+    return [[start, end, None, []] for start, end in zip(bounds, bounds[1:])]
+
+
+def _split_time_range(start, end, now):
+    """Split start <= modifiedTime < end in two halves, or return None if it is too narrow to split."""
+    lower = _parse_drive_time(start)
+    upper = _parse_drive_time(end) if end else max(now, lower) + timedelta(days=1)
+    middle = lower + (upper - lower) / 2
+    middle_text = _format_drive_time(middle)
+    if middle_text <= start or (end and middle_text >= end):
+        return None
+    return middle_text
+
+
+def _iter_sharded(service_factory, base_query, workers, fields=FILE_FIELDS, checkpoint=None, corpus=None):
+    """List a flat query as disjoint modifiedTime shards on a pool of workers, yielding files as pages arrive.
+
+    Every shard is listed in modifiedTime order. When a page shows that a
+    shard holds more than one page and a worker is idle, the rest of the
+    shard (from the last modifiedTime seen onwards) is re-split into two
+    new shards instead of following the nextPageToken, so large shards are
+    spread over the workers as the scan goes. The new lower shard skips the
+    files already returned at its start time. A file edited during the scan
+    can still move into a shard that is listed later, so the ids already
+    yielded are kept and no file is yielded twice.
+
+    Every page is recorded in ``checkpoint`` together with the shards that
+    replace it; a resumed checkpoint continues the shards still pending.
+    ``corpus`` holds extra files().list arguments (see ``_corpus_args``).
+    """
+    def list_page(start, end, page_token):
+        query = ' and '.join(filter(None, [base_query, _modified_time_clause(start, end)]))
+        return call_api(service_factory().files().list(
+            q=query,
+            pageSize=1000,
+            fields=fields,
+            orderBy='modifiedTime',
+            pageToken=page_token,
+            **(corpus or {})))
+
+    now = datetime.now(timezone.utc)
+    shards = checkpoint.sharded_state() if checkpoint and checkpoint.resumed else None
+    files_found = 0
+    seen_ids = set()
+    progress = Progress("Retrieved {files} files' metadata so far...")
+    if checkpoint and checkpoint.resumed:
+        for file in checkpoint.replay_files():
+            files_found += 1
+            seen_ids.add(file['id'])
+            yield file
+        logging.info(f"Resumed sharded scan from checkpoint with {files_found} files already retrieved.")
+    if shards is None:
+        shards = _initial_shards(workers, now)
+        if checkpoint:
+            checkpoint.record_shard(None, shards, [])
+    logging.info(f"Listing {len(shards)} modifiedTime shards with {workers} worker(s)...")
+
+    requests = 0
+    splits = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        def schedule(shard):
+            pending[executor.submit(list_page, *shard[:3])] = shard
+
+        for shard in shards:
+            schedule(shard)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                shard = pending.pop(future)
+                start, end, _, skip_ids = shard
+                response = future.result()
+                requests += 1
+                skip = set(skip_ids)
+                files = []
+                for file in response.get('files', []):
+                    if file['id'] not in skip and file['id'] not in seen_ids:
+                        seen_ids.add(file['id'])
+                        files.append(file)
+                page_token = response.get('nextPageToken')
+                next_shards = []
+                if page_token:
+                    page = response['files']
+                    last = page[-1]['modifiedTime']
+                    # The files already returned at the last modifiedTime; earlier pages can hold some too when
+                    # this whole page shares one modifiedTime.
+                    boundary_ids = [file['id'] for file in page if file['modifiedTime'] == last]
+                    if page[0]['modifiedTime'] == last:
+                        boundary_ids = list(dict.fromkeys(skip_ids + boundary_ids))
+                    middle = None
+                    # With a single worker there is nobody to hand the other half to, so just follow the token.
+                    if workers > 1 and len(pending) < workers and (start is None or last > start):
+                        middle = _split_time_range(last, end, now)
+                    if middle is None:
+                        next_shards = [[start, end, page_token, boundary_ids]]
+                    else:
+                        next_shards = [[last, middle, None, boundary_ids], [middle, end, None, []]]
+                        splits += 1
+                if checkpoint:
+                    checkpoint.record_shard(shard[:3], next_shards, files)
+                for next_shard in next_shards:
+                    schedule(next_shard)
+                files_found += len(files)
+                progress.update(files=files_found)
+                yield from files
+    logging.info(f"Sharded listing retrieved {files_found} files' metadata in {requests} list requests and re-split {splits} shards.")
+
+
+def _corpus_args(folder_id=None, drive_id=None):
+    """Return the files().list arguments that select a shared drive, or let a folder query reach into one."""
+    if drive_id:
+        return {'corpora': 'drive', 'driveId': drive_id, 'supportsAllDrives': True, 'includeItemsFromAllDrives': True}
+    if folder_id:
+        return {'supportsAllDrives': True, 'includeItemsFromAllDrives': True}
+    return {}
+
+
+def iter_files(service, folder_id=None, recursive=False, workers=1, service_factory=None,
+               pack_queries=False, fields=FILE_FIELDS, checkpoint=None, sharded=False, folders=None, drive_id=None):
+    """Yield file metadata from Google Drive page by page as it is listed.
+
+    Recursive scans run on ``workers`` threads. Each thread needs its own
+    client, so ``service_factory`` (see ``make_service_factory``) is required
+    when ``workers`` is greater than one. ``pack_queries`` merges many folders
+    into each recursive listing query. Progress is recorded in the optional
+    ScanCheckpoint, and a resumed checkpoint continues where it stopped.
+    ``sharded`` lists a flat scan as modifiedTime shards on ``workers``
+    threads instead of following a single chain of pages. Recursive scans
+    store every subfolder they find (id, name, parents) in the optional
+    ``folders`` dict. ``drive_id`` lists a shared drive instead of My Drive.
+    """
+    if service_factory is None and (sharded or (folder_id and recursive)):
+        if workers > 1:
+            raise ValueError("service_factory is required when workers > 1")
+        service_factory = lambda: service
+    if folder_id and recursive:
+        logging.info(f"Starting recursive folder scan with {workers} worker(s)...")
+        max_query_length = MAX_PACKED_QUERY_LENGTH if pack_queries else 0
+        yield from _iter_recursive(service_factory, folder_id, workers, max_query_length, fields, checkpoint, folders)
+        return
+
     query = "mimeType != 'application/vnd.google-apps.folder' and trashed = false"
     if folder_id:
         query += f" and '{folder_id}' in parents"
+    corpus = _corpus_args(folder_id, drive_id)
+    if sharded:
+        yield from _iter_sharded(service_factory, query, workers, _with_modified_time(fields), checkpoint, corpus)
+        return
+
+    files_found = 0
+    page_token = None
+    progress = Progress("Retrieved {files} files' metadata so far...")
+    if checkpoint and checkpoint.resumed:
+        page_token, finished = checkpoint.flat_state()
+        for file in checkpoint.replay_files():
+            files_found += 1
+            yield file
+        logging.info(f"Resumed scan from checkpoint with {files_found} files already retrieved.")
+        if finished:
+            return
 
     while True:
-        response = service.files().list(
+        response = call_api(service.files().list(
             q=query,
             pageSize=1000,
-            fields="nextPageToken, files(id, name, size, md5Checksum, trashed, parents)",
-            pageToken=page_token).execute()
-        all_files.extend(response.get('files', []))
-        logging.info(f"Retrieved {len(all_files)} file's metadata so far...")
+            fields=fields,
+            pageToken=page_token,
+            **corpus))
+        files = response.get('files', [])
         page_token = response.get('nextPageToken', None)
+        if checkpoint:
+            checkpoint.record_page(page_token, files)
+        files_found += len(files)
+        progress.update(files=files_found)
+        yield from files
         if page_token is None:
             break
-    return all_files
+    logging.info(f"Retrieved {files_found} files' metadata.")
 
 
+class DriveSource:
+    """One drive to scan, My Drive or a shared drive, with the client factory of the account that can read it."""
+    __slots__ = ('name', 'service_factory', 'drive_id')
 
+    def __init__(self, name, service_factory, drive_id=None):
+        self.name = name
+        self.service_factory = service_factory
+        self.drive_id = drive_id
 
-def find_duplicates(service, delete=False, folder_id=None, recursive=False, keep_strategy=None, trash_folder_id=None):
-    """Find duplicate files in Google Drive."""
-    if folder_id:
-        logging.info(f"Scanning folder with ID: {folder_id}")
-    else:
-        logging.info("Scanning all files in Google Drive.")
-        
-    all_files = fetch_all_files(service, folder_id, recursive)
-    total_files = len(all_files)
-    # Change: Store lists of files for each md5Checksum
+    def __repr__(self):
+        return f"DriveSource({self.name!r})"
+
+
+def list_shared_drives(service):
+    """Return the shared drives (id and name) the account behind service is a member of."""
+    drives = []
+    page_token = None
+    while True:
+        response = call_api(service.drives().list(pageSize=100, fields='nextPageToken, drives(id, name)',
+                                                  pageToken=page_token))
+        drives.extend(response.get('drives', []))
+        page_token = response.get('nextPageToken')
+        if page_token is None:
+            return drives
+
+
+def build_sources(service_factories, shared_drive_ids=(), all_shared_drives=False, include_my_drive=True):
+    """Return the DriveSources to scan for a dict of {account name: service factory}.
+
+    Every account contributes its My Drive and, with ``all_shared_drives``,
+    every shared drive it is a member of. ``shared_drive_ids`` are read
+    through the first account. A shared drive several accounts can see is
+    only scanned once.
+    """
+    sources = []
+    seen = set()
+    for position, (account, factory) in enumerate(service_factories.items()):
+        if include_my_drive:
+            sources.append(DriveSource(f"My Drive of {account}", factory))
+        drives = list_shared_drives(factory()) if all_shared_drives else []
+        if position == 0:
+            drives += [{'id': drive_id, 'name': drive_id} for drive_id in shared_drive_ids]
+        for drive in drives:
+            if drive['id'] not in seen:
+                seen.add(drive['id'])
+                sources.append(DriveSource(f"shared drive {drive['name']}", factory, drive['id']))
+    return sources
+
+
+def iter_sources(sources, workers=1, fields=FILE_FIELDS, sharded=False):
+    """Yield the files of many drives, listed at the same time, into one stream.
+
+    Up to ``workers`` sources are listed in parallel, each on its own thread
+    through the client its account's factory builds for that thread. With
+    ``sharded`` each source's listing is sharded (see ``iter_files``) on an
+    equal share of the ``workers``. Every file gets a ``source`` key holding
+    the index of its DriveSource, so later steps can use the right account
+    for it.
+
+    A My Drive listing also returns the files shared with the account, so a
+    file several accounts can see is listed more than once. Each file ID is
+    only yielded once, from the account that owns it if that account is
+    scanned; copies listed by other accounts are held back until the end.
+    """
+    pages = queue.Queue(maxsize=workers * 4)
+    finished = object()
+    stop = threading.Event()
+
+    def put(item):
+        # Give up once the consumer is gone, so no worker blocks on a full queue forever.
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def list_source(index, source):
+        try:
+            page = []
+            for file in iter_files(source.service_factory(), drive_id=source.drive_id, fields=listing_fields,
+                                   sharded=sharded, workers=shard_workers, service_factory=source.service_factory):
+                file['source'] = index
+                page.append(file)
+                if len(page) >= 1000:
+                    put(page)
+                    page = []
+                    if stop.is_set():
+                        return
+            put(page)
+            logging.info(f"Finished listing {source.name}.")
+        except BaseException as error:
+            put(error)
+        finally:
+            put(finished)
+
+    listing_fields = _with_owned_by_me(fields)
+    shard_workers = max(1, workers // max(1, min(workers, len(sources))))
+    yielded_ids = set()
+    not_owned = {}
+    repeats = 0
+    logging.info(f"Listing {len(sources)} drives with {workers} worker(s)...")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for index, source in enumerate(sources):
+            executor.submit(list_source, index, source)
+        try:
+            remaining = len(sources)
+            while remaining:
+                page = pages.get()
+                if page is finished:
+                    remaining -= 1
+                elif isinstance(page, BaseException):
+                    raise page
+                else:
+                    for file in page:
+                        file_id = file['id']
+                        if file_id in yielded_ids:
+                            repeats += 1
+                        elif file.get('ownedByMe', True):
+                            repeats += not_owned.pop(file_id, None) is not None
+                            yielded_ids.add(file_id)
+                            yield file
+                        elif file_id in not_owned:
+                            repeats += 1
+                        else:
+                            not_owned[file_id] = file
+            # Files shared with a scanned account by an owner who is not scanned.
+            yield from not_owned.values()
+            if repeats:
+                logging.info(f"Skipped {repeats} files listed by more than one account.")
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def fetch_all_files(service, folder_id=None, recursive=False, workers=1, service_factory=None,
+                    pack_queries=False, fields=FILE_FIELDS, sharded=False):
+    """Fetch all file metadata from Google Drive as one list (see ``iter_files``)."""
+    return list(iter_files(service, folder_id, recursive, workers=workers, service_factory=service_factory,
+                           pack_queries=pack_queries, fields=fields, sharded=sharded))
+
+
+class MetadataIndex:
+    """On-disk SQLite index of Drive file metadata, kept current through the Changes feed.
+
+    Only files with an md5Checksum are stored, since nothing else can be a
+    duplicate. Duplicate groups are returned as FileRecords.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS files (
+                id TEXT PRIMARY KEY, md5Checksum TEXT NOT NULL, size INTEGER, name TEXT,
+                parents TEXT, modifiedTime TEXT)""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_md5 ON files (md5Checksum)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def close(self):
+        self.conn.close()
+
+    def get_start_page_token(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'startPageToken'").fetchone()
+        return row[0] if row else None
+
+    def set_start_page_token(self, token):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('startPageToken', ?)", (token,))
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def apply(self, upserts=(), removed_ids=()):
+        """Insert or replace the given file dicts and delete the given IDs in one transaction.
+
+        Files without an md5Checksum are deleted rather than stored.
+        """
+        rows = []
+        removed = list(removed_ids)
+        for file in upserts:
+            if 'md5Checksum' in file:
+                rows.append((file['id'], file['md5Checksum'], int(file['size']) if 'size' in file else None,
+                             file.get('name'), json.dumps(file.get('parents', [])), file.get('modifiedTime')))
+            else:
+                removed.append(file['id'])
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.conn.executemany("DELETE FROM files WHERE id = ?", [(f_id,) for f_id in removed])
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM files")
+
+    def duplicate_groups(self, min_group_size=2):
+        """Return {md5 digest: [FileRecord, ...]} for every md5Checksum shared by at least min_group_size files."""
+        groups = {}
+        cursor = self.conn.execute("""SELECT id, md5Checksum, size, name, parents, modifiedTime FROM files
+            WHERE md5Checksum IN (SELECT md5Checksum FROM files GROUP BY md5Checksum HAVING COUNT(*) >= ?)
+            ORDER BY md5Checksum""", (min_group_size,))
+        for f_id, md5, size, name, parents, modified_time in cursor:
+            record = FileRecord(f_id, bytes.fromhex(md5), size, name,
+                                tuple(sys.intern(parent) for parent in json.loads(parents)), modified_time)
+            groups.setdefault(record.md5, []).append(record)
+        return groups
+
+
+def sync_index(service, index):
+    """Bring the index up to date with Drive.
+
+    The first run takes a startPageToken, then lists the whole drive. Later
+    runs only apply the delta reported by changes().list since the stored
+    token. Returns the number of files or changes processed.
+    """
+    token = index.get_start_page_token()
+    if token is None:
+        logging.info("No index found, building it from a full scan.")
+        # Take the token before listing so changes made during the scan are replayed next time.
+        token = call_api(service.changes().getStartPageToken())['startPageToken']
+        index.clear()
+        listed = 0
+        page = []
+        for file in iter_files(service):
+            page.append(file)
+            if len(page) == 1000:
+                index.apply(upserts=page)
+                listed += len(page)
+                page = []
+        index.apply(upserts=page)
+        listed += len(page)
+        index.set_start_page_token(token)
+        logging.info(f"Indexed {index.count()} files with an md5Checksum.")
+        return listed
+
+    logging.info("Applying changes since the last run to the index.")
+    processed = 0
+    while token is not None:
+        response = call_api(service.changes().list(pageToken=token, pageSize=1000, spaces='drive',
+                                                   fields=CHANGE_FIELDS))
+        upserts = []
+        removed_ids = []
+        for change in response.get('changes', []):
+            file = change.get('file')
+            if change.get('removed') or file is None or file.get('trashed') or file.get('mimeType') == FOLDER_MIME_TYPE:
+                removed_ids.append(change['fileId'])
+            else:
+                upserts.append(file)
+        index.apply(upserts, removed_ids)
+        processed += len(upserts) + len(removed_ids)
+        if 'newStartPageToken' in response:
+            index.set_start_page_token(response['newStartPageToken'])
+            token = None
+        else:
+            token = response.get('nextPageToken')
+    logging.info(f"Applied {processed} changes. The index holds {index.count()} files with an md5Checksum.")
+    return processed
+
+
+def group_by_md5(files, min_group_size=2):
+    """Group a stream of file dicts by md5 digest as they arrive.
+
+    Files without an md5Checksum are dropped immediately and the rest are
+    turned into FileRecords, so the raw listing never has to be held in
+    memory. A digest seen once maps to its bare record and only becomes a
+    list on the second match. Returns the groups of at least
+    ``min_group_size`` files, by default only actual duplicates.
+    """
     file_dict = {}
-    for i, file in enumerate(all_files, 1):
+    checked = 0
+    progress = Progress("Grouped {checked} files so far.")
+    for checked, file in enumerate(files, 1):
         if 'md5Checksum' in file:
-            md5 = file['md5Checksum']
-            if md5 not in file_dict:
-                file_dict[md5] = []
-            file_dict[md5].append(file)
+            record = FileRecord.from_drive(file)
+            existing = file_dict.get(record.md5)
+            if existing is None:
+                file_dict[record.md5] = record
+            elif type(existing) is list:
+                existing.append(record)
+            else:
+                file_dict[record.md5] = [existing, record]
 
-        if i % 100 == 0 or i == total_files:
-            logging.info(f"Checked {i} out of {total_files} files.")
+        # Checking the clock on every file would cost more than grouping it.
+        if checked % 1000 == 0:
+            progress.update(checked=checked)
+    logging.info(f"Checked {checked} files.")
 
+    if min_group_size <= 1:
+        return {md5: group if type(group) is list else [group] for md5, group in file_dict.items()}
     # Filter out unique files, leaving only groups with duplicates
-    duplicate_groups = {md5: files for md5, files in file_dict.items() if len(files) > 1}
+    return {md5: group for md5, group in file_dict.items() if type(group) is list and len(group) >= min_group_size}
+
+
+def find_duplicates(service, delete=False, folder_id=None, recursive=False, keep_strategy=None, trash_folder_id=None,
+                    workers=1, service_factory=None, pack_queries=False, index_path=None, lean_listing=False,
+                    checkpoint_path=None, resume=False, sharded=False, rules=(), plan_path=None, sources=None,
+                    report_path=None):
+    """Find duplicate files in Google Drive.
+
+    With ``index_path`` the whole drive is read from a local MetadataIndex
+    that is first synced through the Changes feed, instead of being listed.
+    With ``lean_listing`` the listing only asks for id, md5Checksum and size,
+    and the remaining metadata is fetched for duplicates only. With
+    ``checkpoint_path`` the scan progress is logged to a ScanCheckpoint that
+    ``resume`` continues from; it is deleted once the scan completes.
+    ``sharded`` lists flat scans as parallel modifiedTime shards. ``rules``
+    are SelectionRules applied before ``trash_folder_id`` when deleting.
+    Without ``delete``, ``plan_path`` gets a plan of the files the selection
+    would trash, for ``apply_plan`` to trash later without a new scan.
+    With ``sources``, a list of DriveSources, those drives are listed in
+    parallel into one grouping and each file is trashed through its own
+    source's account. With ``report_path`` the duplicate groups are written
+    to a JSON lines report instead of one log line per file.
+    """
+    folders = None
+    if sources:
+        with _stats.phase('grouping') as grouping:
+            duplicate_groups = group_by_md5(_stats.timed(iter_sources(sources, workers, FILE_FIELDS, sharded),
+                                                         'listing', grouping))
+    elif index_path:
+        logging.info(f"Using the metadata index at {index_path}")
+        index = MetadataIndex(index_path)
+        try:
+            with _stats.phase('listing') as listing:
+                listing['items'] = sync_index(service, index)
+            with _stats.phase('grouping') as grouping:
+                duplicate_groups = index.duplicate_groups()
+                grouping['items'] = sum(len(group) for group in duplicate_groups.values())
+        finally:
+            index.close()
+    else:
+        if folder_id:
+            logging.info(f"Scanning folder with ID: {folder_id}")
+        else:
+            logging.info("Scanning all files in Google Drive.")
+
+        fields = LEAN_FILE_FIELDS if lean_listing else FILE_FIELDS
+        # Folders found by a recursive scan spare the lookups needed to evaluate folder rules.
+        folders = {} if folder_id and recursive else None
+        checkpoint = None
+        if checkpoint_path:
+            scan = {'folder_id': folder_id, 'recursive': bool(folder_id and recursive), 'fields': fields,
+                    'sharded': sharded}
+            checkpoint = ScanCheckpoint(checkpoint_path, scan, resume)
+            if resume and not checkpoint.resumed:
+                logging.info(f"No checkpoint found at {checkpoint_path}, starting a new scan.")
+        files = iter_files(service, folder_id, recursive, workers=workers, service_factory=service_factory,
+                           pack_queries=pack_queries, fields=fields, checkpoint=checkpoint, sharded=sharded,
+                           folders=folders)
+        try:
+            with _stats.phase('grouping') as grouping:
+                duplicate_groups = group_by_md5(_stats.timed(files, 'listing', grouping))
+        except BaseException:
+            if checkpoint:
+                logging.warning(f"Scan interrupted. Run again with --resume to continue from {checkpoint_path}.")
+            raise
+        finally:
+            if checkpoint:
+                checkpoint.close()
+        if checkpoint:
+            os.remove(checkpoint_path)
+        if lean_listing and duplicate_groups:
+            with _stats.phase('hydration') as hydration:
+                hydration['items'] = sum(len(group) for group in duplicate_groups.values())
+                hydrate_records(service, duplicate_groups, workers=workers, service_factory=service_factory)
 
     if not duplicate_groups:
         logging.info("No duplicate files found.")
         return
 
     logging.info(f"Found {len(duplicate_groups)} groups of duplicate files.")
+    if report_path:
+        written = write_duplicate_report(report_path, duplicate_groups, sources)
+        logging.info(f"Wrote the {len(duplicate_groups)} groups, {written} files in all, to {report_path}.")
 
     if not delete:
         logging.info("'--delete' flag was not used. No files will be moved to trash.")
-        logging.info("Summary of duplicate files (not trashed):")
-        for md5, files in duplicate_groups.items():
-            logging.info(f"  MD5: {md5}")
-            for file in files:
-                logging.info(f"    - {file['name']} (ID: {file['id']})")
+        if not report_path:
+            logging.info("Summary of duplicate files (not trashed):")
+            for md5, files in duplicate_groups.items():
+                logging.info(f"  MD5: {_md5_hex(md5)}")
+                for file in files:
+                    where = f" in {sources[file['source']].name}" if sources else ""
+                    logging.info(f"    - {file['name']} (ID: {file['id']}){where}")
+        if plan_path:
+            files_to_trash = _select_files_to_trash(service, duplicate_groups, keep_strategy, trash_folder_id, rules,
+                                                    folders, sources)
+            groups_written, planned = write_plan(plan_path, duplicate_groups, files_to_trash)
+            logging.info(f"Wrote a plan of {groups_written} groups with {planned} files to trash to {plan_path}. "
+                         f"Run with --apply-plan {plan_path} to trash them without scanning again.")
         return
 
+    files_to_trash = _select_files_to_trash(service, duplicate_groups, keep_strategy, trash_folder_id, rules, folders,
+                                            sources)
+
+    if files_to_trash:
+        logging.info(f"Proceeding to trash {len(files_to_trash)} files based on selection criteria.")
+        if sources:
+            trashed, failed = [], []
+            for index, source in enumerate(sources):
+                source_files = [file for file in files_to_trash if file['source'] == index]
+                if source_files:
+                    source_trashed, source_failed = trash_files_batched(source.service_factory(), source_files)
+                    trashed += source_trashed
+                    failed += source_failed
+        else:
+            trashed, failed = trash_files_batched(service, files_to_trash)
+        logging.info(f"Moved {len(trashed)} files to trash, {len(failed)} failed.")
+    else:
+        logging.info("No files were marked for trashing based on the provided selection criteria.")
+
+
+def _select_files_to_trash(service, duplicate_groups, keep_strategy=None, trash_folder_id=None, rules=(),
+                           folders=None, sources=None):
+    """Run the SelectionAssistant over the duplicate groups and return the files to trash."""
     # Initialize SelectionAssistant
-    selection_assistant = SelectionAssistant(service, duplicate_groups)
+    folder_tree = FolderTree(folders.values()) if folders else None
+    selection_assistant = SelectionAssistant(service, duplicate_groups, folder_tree, sources)
 
     # Apply selection strategies based on arguments
     if keep_strategy:
         selection_assistant.mark_all_but_one(keep_strategy)
-    
+
+    for rule in rules:
+        selection_assistant.add_rule(rule)
+
     if trash_folder_id:
         selection_assistant.mark_by_folder(trash_folder_id)
 
-    # Get the final list of files to trash
-    files_to_trash = selection_assistant.get_files_to_trash()
+    with _stats.phase('selection') as selection:
+        selection['items'] = sum(len(files) for files in duplicate_groups.values())
+        if selection_assistant.needs_folder_tree():
+            selection_assistant.fetch_folder_tree()
 
-    if files_to_trash:
-        logging.info(f"Proceeding to trash {len(files_to_trash)} files based on selection criteria.")
-        for file_to_trash in files_to_trash:
-            move_file_to_trash(service, file_to_trash)
+        # Get the final list of files to trash
+        return selection_assistant.get_files_to_trash()
+
+
+def write_duplicate_report(path, duplicate_groups, sources=None):
+    """Write every duplicate group to a JSON lines report through a large write buffer.
+
+    Each line is one group: its md5, the size of one copy and the id, name,
+    modifiedTime and parents of every file, plus the name of the DriveSource
+    it came from when ``sources`` are given. Returns the number of files written.
+    """
+    written = 0
+    with open(path, 'w', encoding='utf-8', buffering=REPORT_BUFFER_SIZE) as report:
+        for md5, files in duplicate_groups.items():
+            entries = []
+            for file in files:
+                entry = file.to_dict() if isinstance(file, FileRecord) else dict(file)
+                entry.pop('md5Checksum', None)
+                entry.pop('size', None)
+                if sources:
+                    entry['source'] = sources[file['source']].name
+                entries.append(entry)
+            size = files[0].get('size')
+            report.write(json.dumps({'md5': _md5_hex(md5), 'size': int(size) if size is not None else None,
+                                     'files': entries}, separators=(',', ':')) + '\n')
+            written += len(files)
+    return written
+
+
+def write_plan(path, duplicate_groups, files_to_trash):
+    """Write the duplicate groups and the files chosen for trashing to a JSON lines plan file.
+
+    The first line identifies the format. Every other line is one group:
+    its md5 and the [id, modifiedTime, name] of the files to keep and to
+    trash. Returns the number of groups and of files to trash written.
+    """
+    trash_ids = {file['id'] for file in files_to_trash}
+    groups = planned = 0
+    with open(path, 'w', encoding='utf-8') as plan:
+        plan.write(json.dumps({'plan': PLAN_VERSION, 'created': datetime.now(timezone.utc).isoformat()}) + '\n')
+        for md5, files in duplicate_groups.items():
+            entry = {'md5': _md5_hex(md5), 'keep': [], 'trash': []}
+            for file in files:
+                entry['trash' if file['id'] in trash_ids else 'keep'].append(
+                    [file['id'], file.get('modifiedTime'), file.get('name')])
+            plan.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            groups += 1
+            planned += len(entry['trash'])
+    return groups, planned
+
+
+def read_plan(path):
+    """Yield the groups of a plan file written by ``write_plan``, one at a time."""
+    with open(path, encoding='utf-8') as plan:
+        header = json.loads(plan.readline() or 'null')
+        if not isinstance(header, dict) or header.get('plan') != PLAN_VERSION:
+            raise ValueError(f"{path} is not a version {PLAN_VERSION} plan file")
+        for line in plan:
+            if line.strip():
+                yield json.loads(line)
+
+
+def apply_plan(service, path, groups_per_chunk=1000, batch_size=MAX_BATCH_SIZE):
+    """Trash the files planned in a plan file without scanning Drive again.
+
+    The plan is read in chunks of ``groups_per_chunk`` groups. For each
+    chunk, the planned files and the first file kept in every group are
+    fetched through batched files().get requests. A planned file is only
+    trashed if its md5Checksum and modifiedTime still match the plan, and
+    only if the kept file still does too, so a copy is never trashed after
+    the original changed or disappeared. Returns (trashed, failed, skipped)
+    counts.
+    """
+    totals = [0, 0, 0]
+
+    def apply_chunk(groups):
+        checks = []
+        for group in groups:
+            if group['trash'] and group['keep']:
+                checks.append((group['md5'], group['keep'][0]))
+                checks.extend((group['md5'], file) for file in group['trash'])
+            else:
+                totals[2] += len(group['trash'])
+        current = {}
+
+        def fetched(check, response):
+            current[check[1][0]] = response
+
+        execute_batched(service, checks,
+                        lambda check: service.files().get(fileId=check[1][0],
+                                                          fields='id, md5Checksum, modifiedTime, trashed',
+                                                          supportsAllDrives=True),
+                        fetched, None, batch_size)
+
+        def unchanged(md5, file):
+            response = current.get(file[0])
+            return (response is not None and not response.get('trashed') and response.get('md5Checksum') == md5
+                    and (file[1] is None or response.get('modifiedTime') == file[1]))
+
+        to_trash = []
+        for group in groups:
+            if not (group['trash'] and group['keep']):
+                continue
+            kept = group['keep'][0]
+            if not unchanged(group['md5'], kept):
+                logging.warning(f"Skipping group {group['md5']}: the kept file {kept[2]} (ID: {kept[0]}) has changed.")
+                totals[2] += len(group['trash'])
+                continue
+            for file in group['trash']:
+                if unchanged(group['md5'], file):
+                    to_trash.append({'id': file[0], 'name': file[2]})
+                else:
+                    logging.warning(f"Skipping {file[2]} (ID: {file[0]}): it changed since the plan was written.")
+                    totals[2] += 1
+        trashed, failed = trash_files_batched(service, to_trash, batch_size)
+        totals[0] += len(trashed)
+        totals[1] += len(failed)
+
+    logging.info(f"Applying the plan in {path}.")
+    chunk = []
+    for group in read_plan(path):
+        chunk.append(group)
+        if len(chunk) >= groups_per_chunk:
+            apply_chunk(chunk)
+            chunk = []
+    if chunk:
+        apply_chunk(chunk)
+    logging.info(f"Moved {totals[0]} files to trash, {totals[1]} failed, {totals[2]} skipped because they changed.")
+    return tuple(totals)
+
+
+class DuplicateWatcher:
+    """Keeps the md5 groups of a whole drive in memory and follows the Changes feed to flag new duplicates.
+
+    ``start`` lists the drive once. Each ``poll`` then reads the changes made
+    since the previous one and only moves the files they name between
+    groups, so a poll costs one request per 1000 changes however large the
+    drive is. Every group that gained a file and now holds at least two is a
+    duplicate event: it is logged, passed to ``on_duplicate(md5, files)``
+    and, with ``delete``, resolved right away by the keep strategy and rules.
+    Only the files that joined in that poll are ever trashed; copies that
+    were there before are left to a normal run.
+    ``stats`` reports the size of the map and the lag between a change in
+    Drive and the poll that saw it; ``status_path`` gets them after every poll.
+    """
+
+    def __init__(self, service, delete=False, keep_strategy=None, rules=(), on_duplicate=None, status_path=None):
+        self.service = service
+        self.delete = delete
+        self.keep_strategy = keep_strategy
+        self.rules = list(rules)
+        self.on_duplicate = on_duplicate
+        self.status_path = status_path
+        # Like group_by_md5, a digest maps to its bare record until a second file shares it.
+        self.groups = {}
+        self.md5_by_id = {}
+        self.duplicate_groups = 0
+        self.token = None
+        self.polls = 0
+        self.changes = 0
+        self.events = 0
+        self.trashed = 0
+        self.last_lag = None
+        self.max_lag = None
+        self.last_poll = None
+
+    def start(self, workers=1, service_factory=None, sharded=False):
+        """List the whole drive into the map, taking the changes token first so nothing made during the scan is missed."""
+        self.token = call_api(self.service.changes().getStartPageToken())['startPageToken']
+        for file in iter_files(self.service, workers=workers, service_factory=service_factory, sharded=sharded):
+            if 'md5Checksum' in file:
+                self._add(FileRecord.from_drive(file))
+        logging.info(f"Watching {len(self.md5_by_id)} files with {len(self.groups)} distinct checksums; "
+                     f"{self.duplicate_groups} groups of duplicates already exist and are not reported as events.")
+
+    def _add(self, record):
+        """Add a record to its group; returns True if the group now holds duplicates."""
+        self.md5_by_id[record.id] = record.md5
+        existing = self.groups.get(record.md5)
+        if existing is None:
+            self.groups[record.md5] = record
+            return False
+        if type(existing) is list:
+            existing.append(record)
+        else:
+            self.groups[record.md5] = [existing, record]
+            self.duplicate_groups += 1
+        return True
+
+    def _remove(self, file_id):
+        md5 = self.md5_by_id.pop(file_id, None)
+        if md5 is None:
+            return
+        group = self.groups[md5]
+        if type(group) is not list:
+            del self.groups[md5]
+            return
+        group[:] = [record for record in group if record.id != file_id]
+        if len(group) == 1:
+            self.groups[md5] = group[0]
+            self.duplicate_groups -= 1
+
+    def _update(self, file):
+        """Apply one changed file that has a checksum; returns its digest if it joined a group of duplicates."""
+        record = FileRecord.from_drive(file)
+        if self.md5_by_id.get(record.id) == record.md5:
+            # Renamed, moved or touched without new content: swap the record in place.
+            group = self.groups[record.md5]
+            if type(group) is list:
+                group[:] = [record if old.id == record.id else old for old in group]
+            else:
+                self.groups[record.md5] = record
+            return None
+        self._remove(record.id)
+        return record.md5 if self._add(record) else None
+
+    def poll(self):
+        """Apply the changes since the last poll; returns the new duplicate groups as {md5 digest: [FileRecord, ...]}."""
+        joined = set()
+        joined_ids = set()
+        lag = None
+        while self.token is not None:
+            response = call_api(self.service.changes().list(pageToken=self.token, pageSize=1000, spaces='drive',
+                                                            fields=WATCH_CHANGE_FIELDS))
+            now = datetime.now(timezone.utc)
+            for change in response.get('changes', []):
+                file = change.get('file')
+                if change.get('removed') or file is None or file.get('trashed') or 'md5Checksum' not in file:
+                    self._remove(change['fileId'])
+                else:
+                    md5 = self._update(file)
+                    if md5 is not None:
+                        joined.add(md5)
+                        joined_ids.add(file['id'])
+                if 'time' in change:
+                    change_lag = (now - _parse_drive_time(change['time'])).total_seconds()
+                    lag = change_lag if lag is None else max(lag, change_lag)
+                self.changes += 1
+            if 'newStartPageToken' in response:
+                self.token = response['newStartPageToken']
+                break
+            self.token = response.get('nextPageToken')
+
+        self.polls += 1
+        self.last_poll = _format_drive_time(datetime.now(timezone.utc))
+        if lag is not None:
+            self.last_lag = lag
+            self.max_lag = lag if self.max_lag is None else max(self.max_lag, lag)
+        # A group can shrink back to one file later in the same poll.
+        new_groups = {md5: list(self.groups[md5]) for md5 in joined if type(self.groups.get(md5)) is list}
+        for md5, files in new_groups.items():
+            self.events += 1
+            logging.info(f"New duplicate: {len(files)} files share MD5 {_md5_hex(md5)}: "
+                         + ', '.join(f"{file['name']} (ID: {file['id']})" for file in files))
+            if self.on_duplicate:
+                self.on_duplicate(md5, files)
+        if self.delete and new_groups:
+            self._resolve(new_groups, joined_ids)
+        if self.status_path:
+            self.write_status()
+        return new_groups
+
+    def _resolve(self, new_groups, joined_ids):
+        # The selection sees the whole group to pick the copy to keep, but only files that just joined are trashed.
+        files_to_trash = [file for file in _select_files_to_trash(self.service, new_groups, self.keep_strategy,
+                                                                  rules=self.rules)
+                          if file['id'] in joined_ids]
+        if not files_to_trash:
+            return
+        trashed, failed = trash_files_batched(self.service, files_to_trash)
+        # The trashed files also come back through the feed; dropping them now keeps the map exact until then.
+        for file in trashed:
+            self._remove(file['id'])
+        self.trashed += len(trashed)
+        logging.info(f"Moved {len(trashed)} new duplicates to trash, {len(failed)} failed.")
+
+    def stats(self):
+        return {'files': len(self.md5_by_id), 'checksums': len(self.groups), 'duplicate_groups': self.duplicate_groups,
+                'polls': self.polls, 'changes': self.changes, 'events': self.events, 'trashed': self.trashed,
+                'last_lag_seconds': self.last_lag, 'max_lag_seconds': self.max_lag, 'last_poll': self.last_poll}
+
+    def write_status(self):
+        """Replace the status file atomically, so readers never see a partial write."""
+        partial = self.status_path + '.tmp'
+        with open(partial, 'w') as status:
+            json.dump(self.stats(), status, indent=2)
+        os.replace(partial, self.status_path)
+
+    def run(self, interval=DEFAULT_POLL_INTERVAL, max_polls=None):
+        """Poll every ``interval`` seconds until interrupted, or until ``max_polls`` polls were made."""
+        logging.info(f"Polling the changes feed every {interval}s.")
+        while max_polls is None or self.polls < max_polls:
+            started = time.monotonic()
+            try:
+                self.poll()
+            except HttpError as error:
+                # The token only advances past pages that were applied, so the next poll picks up from here.
+                logging.error(f"Polling the changes feed failed, retrying in {interval}s: {error}")
+                self.polls += 1
+            if max_polls is not None and self.polls >= max_polls:
+                break
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+
+class FolderNode:
+    """One folder of a scanned tree, with the content hash of its whole subtree.
+
+    ``digests`` collects the hashes of the direct children while the tree is
+    built; ``hash`` is None until computed, and stays None for folders whose
+    subtree holds a file without an md5Checksum (such as a Google Doc), since
+    their content cannot be compared.
+    """
+    __slots__ = ('id', 'name', 'parent', 'digests', 'hashable', 'file_count', 'size', 'hash')
+
+    def __init__(self, id, name, parent=None):
+        self.id = id
+        self.name = name
+        self.parent = parent
+        self.digests = []
+        self.hashable = True
+        self.file_count = 0
+        self.size = 0
+        self.hash = None
+
+    @property
+    def path(self):
+        names = []
+        node = self
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        return '/' + '/'.join(reversed(names))
+
+    def depth(self):
+        depth, node = 0, self
+        while node.parent is not None:
+            depth, node = depth + 1, node.parent
+        return depth
+
+    def is_within(self, folder_ids):
+        """Return True if this folder or one of its ancestors is in folder_ids."""
+        node = self
+        while node is not None:
+            if node.id in folder_ids:
+                return True
+            node = node.parent
+        return False
+
+    def __repr__(self):
+        return f"FolderNode({self.id!r}, {self.path!r}, files={self.file_count})"
+
+
+def build_folder_tree(service, folder_id='root', workers=1, service_factory=None, pack_queries=False):
+    """Scan a folder recursively and return {folder id: FolderNode} with Merkle hashes of every subtree.
+
+    A folder's hash is the md5 of the sorted hashes of its children: the
+    md5Checksum of each file and the hash of each subfolder. Names are left
+    out, so renamed copies still match, but the structure is not: the same
+    files arranged in different subfolders give a different hash.
+    """
+    # Children list the real ID of the scanned folder, not an alias such as 'root'.
+    folder_id = call_api(service.files().get(fileId=folder_id, fields='id', supportsAllDrives=True))['id']
+    folders = {}
+    nodes = {folder_id: FolderNode(folder_id, '')}
+    for file in iter_files(service, folder_id, recursive=True, workers=workers, service_factory=service_factory,
+                           pack_queries=pack_queries, fields=FOLDER_TREE_FIELDS, folders=folders):
+        for parent_id in file.get('parents', ()):
+            node = nodes.get(parent_id) or nodes.setdefault(parent_id, FolderNode(parent_id, None))
+            if 'md5Checksum' in file:
+                node.digests.append(b'f' + bytes.fromhex(file['md5Checksum']))
+                node.size += int(file.get('size', 0))
+                node.file_count += 1
+            else:
+                node.hashable = False
+
+    # Files with several parents may also name folders outside the scanned tree.
+    nodes = {node_id: node for node_id, node in nodes.items() if node_id == folder_id or node_id in folders}
+    for folder in folders.values():
+        node = nodes.get(folder['id']) or nodes.setdefault(folder['id'], FolderNode(folder['id'], None))
+        node.name = folder.get('name')
+    for folder in folders.values():
+        parent_id = next((parent for parent in folder.get('parents', ()) if parent in nodes), None)
+        nodes[folder['id']].parent = nodes.get(parent_id)
+    logging.info(f"Built a tree of {len(nodes)} folders. Hashing subtrees...")
+
+    # Children before parents, so every folder is hashed after all of its subfolders.
+    for node in sorted(nodes.values(), key=FolderNode.depth, reverse=True):
+        if node.hashable:
+            node.hash = hashlib.md5(b''.join(sorted(node.digests))).digest()
+        node.digests = None
+        if node.parent is not None:
+            if node.hashable:
+                node.parent.digests.append(b'd' + node.hash)
+                node.parent.file_count += node.file_count
+                node.parent.size += node.size
+            else:
+                node.parent.hashable = False
+    return nodes
+
+
+def group_identical_folders(nodes):
+    """Return the lists of folders with identical, non-empty subtrees, outermost copies only.
+
+    A group is dropped when each of its folders sits in a different parent
+    and those parents are themselves identical copies, because reporting
+    the parents already covers it. Groups are sorted by wasted bytes.
+    """
+    by_hash = {}
+    for node in nodes.values():
+        if node.hash is not None and node.file_count and node.parent is not None:
+            by_hash.setdefault(node.hash, []).append(node)
+    groups = {folder_hash: group for folder_hash, group in by_hash.items() if len(group) > 1}
+
+    def covered(group):
+        parents = {node.parent.id: node.parent for node in group}
+        parent_hashes = {parent.hash for parent in parents.values()}
+        return (len(parents) == len(group) and len(parent_hashes) == 1
+                and None not in parent_hashes and parent_hashes <= groups.keys())
+
+    return sorted((group for group in groups.values() if not covered(group)),
+                  key=lambda group: group[0].size * (len(group) - 1), reverse=True)
+
+
+def find_duplicate_folders(service, folder_id='root', delete=False, workers=1, service_factory=None,
+                           pack_queries=False):
+    """Find folders whose whole subtrees are identical and report each set of copies as one unit.
+
+    With ``delete`` one copy of every group is kept (the one with the
+    shortest path) and the others are trashed as whole folders, which takes
+    one request per folder instead of one per file. Returns the groups.
+    """
+    logging.info(f"Scanning the folder tree under {folder_id} for duplicate folders.")
+    with _stats.phase('listing') as listing:
+        nodes = build_folder_tree(service, folder_id, workers, service_factory, pack_queries)
+        listing['items'] = len(nodes)
+    with _stats.phase('grouping') as grouping:
+        groups = group_identical_folders(nodes)
+        grouping['items'] = len(nodes)
+    if not groups:
+        logging.info("No duplicate folders found.")
+        return groups
+
+    wasted = sum(group[0].size * (len(group) - 1) for group in groups)
+    logging.info(f"Found {len(groups)} groups of identical folders, wasting {wasted} bytes.")
+    for group in groups:
+        logging.info(f"{len(group)} identical folders of {group[0].file_count} files ({group[0].size} bytes each):")
+        for node in sorted(group, key=lambda node: node.path):
+            logging.info(f"  - {node.path} (ID: {node.id})")
+    if not delete:
+        return groups
+
+    # Outer groups first, so copies inside an already trashed folder are not counted as kept.
+    to_trash = set()
+    # Kept folders and all of their ancestors; trashing any of them would trash a kept copy.
+    protected = set()
+    folders_to_trash = []
+    for group in sorted(groups, key=lambda group: min(node.depth() for node in group)):
+        remaining = sorted((node for node in group if not node.is_within(to_trash)),
+                           key=lambda node: (len(node.path), node.path))
+        if not remaining:
+            continue
+        # A copy that holds the kept copy of another group has to stay; otherwise keep the shortest path.
+        kept = [node for node in remaining if node.id in protected] or remaining[:1]
+        for node in kept:
+            ancestor = node
+            while ancestor is not None and ancestor.id not in protected:
+                protected.add(ancestor.id)
+                ancestor = ancestor.parent
+        for node in remaining:
+            if node.id not in protected:
+                to_trash.add(node.id)
+                folders_to_trash.append({'id': node.id, 'name': node.path})
+    logging.info(f"Proceeding to trash {len(folders_to_trash)} duplicate folders.")
+    trashed, failed = trash_files_batched(service, folders_to_trash)
+    logging.info(f"Moved {len(trashed)} folders to trash, {len(failed)} failed.")
+    return groups
+
+
+class LocalHashCache:
+    """SQLite cache of local file md5s keyed by (path, size, mtime), so unchanged files are not hashed again."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, md5 TEXT NOT NULL)""")
+
+    def get(self, path, size, mtime_ns):
+        row = self.conn.execute("SELECT md5 FROM hashes WHERE path = ? AND size = ? AND mtime_ns = ?",
+                                (path, size, mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def put_many(self, rows):
+        """Store (path, size, mtime_ns, md5) rows."""
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)", rows)
+
+    def close(self):
+        self.conn.close()
+
+
+_hash_buffer = None  # One read buffer per hashing process
+
+
+def _hash_local_file(path):
+    """Return (hex md5, None) for a local file, or (None, error message) if it cannot be read.
+
+    The file is read with large readinto() calls into one reused buffer, which
+    keeps a single core at close to disk bandwidth without mapping the file.
+    This runs in the hashing processes, whose log records never reach the log
+    listener thread of the parent, so errors are returned for it to log.
+    """
+    global _hash_buffer
+    if _hash_buffer is None:
+        _hash_buffer = bytearray(LOCAL_HASH_READ_SIZE)
+    buffer = _hash_buffer
+    view = memoryview(buffer)
+    digest = hashlib.md5()
+    try:
+        with open(path, 'rb', buffering=0) as local_file:
+            while True:
+                read = local_file.readinto(buffer)
+                if not read:
+                    break
+                digest.update(view[:read])
+    except OSError as error:
+        return None, str(error)
+    return digest.hexdigest(), None
+
+
+def _walk_local_files(root):
+    """Yield (path, size, mtime_ns) for every regular file under root."""
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                file_stat = os.stat(path, follow_symlinks=False)
+            except OSError as error:
+                logging.error(f"Could not stat local file {path}: {error}")
+                continue
+            if stat.S_ISREG(file_stat.st_mode):
+                yield path, file_stat.st_size, file_stat.st_mtime_ns
+
+
+def hash_local_tree(root, workers=None, cache_path=None, sizes=None):
+    """Hash every file under a local directory in a process pool.
+
+    Hashes are cached by (path, size, mtime) in a LocalHashCache at
+    ``cache_path``. If ``sizes`` is given, only files with one of those sizes
+    are hashed, since no other file can match. Returns a list of
+    (path, size, md5) tuples, with md5 None for files that were skipped or
+    could not be read.
+    """
+    cache = LocalHashCache(cache_path) if cache_path else None
+    results = []
+    to_hash = []
+    try:
+        for path, size, mtime_ns in _walk_local_files(root):
+            if sizes is not None and size not in sizes:
+                results.append((path, size, None))
+                continue
+            md5 = cache.get(path, size, mtime_ns) if cache else None
+            if md5 is None:
+                to_hash.append((path, size, mtime_ns))
+            else:
+                results.append((path, size, md5))
+        logging.info(f"Hashing {len(to_hash)} local files ({len(results)} skipped or cached) with {workers or os.cpu_count()} processes.")
+
+        # Largest files first, so one huge file does not end up running alone at the end.
+        to_hash.sort(key=lambda item: item[1], reverse=True)
+        hashed = []
+        progress = Progress("Hashed {hashed} of {total} local files.")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            paths = [path for path, _, _ in to_hash]
+            hashes = executor.map(_hash_local_file, paths, chunksize=8)
+            for i, ((path, size, mtime_ns), (md5, error)) in enumerate(zip(to_hash, hashes), 1):
+                if error:
+                    logging.error(f"Could not read local file {path}: {error}")
+                results.append((path, size, md5))
+                if md5 is not None:
+                    hashed.append((path, size, mtime_ns, md5))
+                if cache and len(hashed) >= 1000:
+                    cache.put_many(hashed)
+                    hashed = []
+                progress.update(hashed=i, total=len(to_hash))
+        if cache:
+            cache.put_many(hashed)
+    finally:
+        if cache:
+            cache.close()
+    return results
+
+
+def compare_local_to_drive(service, local_dir, report_path, folder_id=None, recursive=False, workers=1,
+                           service_factory=None, pack_queries=False, index_path=None, hash_workers=None,
+                           hash_cache_path=None, sharded=False):
+    """Report which files under a local directory already exist in Google Drive.
+
+    The Drive side is grouped by md5 like ``find_duplicates`` does (or read
+    from the metadata index), the local side is hashed by ``hash_local_tree``
+    and the two are joined on md5. One CSV row per local file is written to
+    ``report_path``. Returns the number of local files found in Drive.
+    """
+    if index_path:
+        index = MetadataIndex(index_path)
+        try:
+            sync_index(service, index)
+            drive_groups = index.duplicate_groups(min_group_size=1)
+        finally:
+            index.close()
     else:
-        logging.info("No files were marked for trashing based on the provided selection criteria.")
+        files = iter_files(service, folder_id, recursive, workers=workers, service_factory=service_factory,
+                           pack_queries=pack_queries, fields=LEAN_FILE_FIELDS, sharded=sharded)
+        with _stats.phase('grouping') as grouping:
+            drive_groups = group_by_md5(_stats.timed(files, 'listing', grouping), min_group_size=1)
+    drive_sizes = {record.size for group in drive_groups.values() for record in group}
+    logging.info(f"Drive holds {len(drive_groups)} distinct contents. Hashing local files under {local_dir}.")
+
+    with _stats.phase('hashing') as hashing:
+        local_files = hash_local_tree(local_dir, hash_workers, hash_cache_path, sizes=drive_sizes)
+        hashing['items'] = len(local_files)
+    in_drive = 0
+    with open(report_path, 'w', newline='', encoding='utf-8') as report:
+        writer = csv.writer(report)
+        writer.writerow(['path', 'size', 'md5', 'in_drive', 'drive_ids'])
+        for path, size, md5 in local_files:
+            matches = drive_groups.get(bytes.fromhex(md5), []) if md5 else []
+            in_drive += bool(matches)
+            writer.writerow([path, size, md5 or '', 'yes' if matches else 'no',
+                             ' '.join(record.id for record in matches)])
+    logging.info(f"{in_drive} of {len(local_files)} local files are already in Drive. Report written to {report_path}.")
+    return in_drive
+
+
+class FingerprintCache:
+    """SQLite cache of near-duplicate fingerprints keyed by (fileId, modifiedTime), so unchanged files are not fetched again.
+
+    A NULL fingerprint records a file that was fetched but had nothing to
+    fingerprint, such as an empty document.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS fingerprints (
+                id TEXT PRIMARY KEY, modified_time TEXT NOT NULL, fingerprint BLOB)""")
+
+    def get(self, file_id, modified_time):
+        """Return (found, fingerprint)."""
+        row = self.conn.execute("SELECT fingerprint FROM fingerprints WHERE id = ? AND modified_time = ?",
+                                (file_id, modified_time)).fetchone()
+        return (True, row[0]) if row else (False, None)
+
+    def put_many(self, rows):
+        """Store (id, modified_time, fingerprint) rows."""
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)", rows)
+
+    def close(self):
+        self.conn.close()
+
+
+def minhash_text(text, slots=MINHASH_SLOTS):
+    """Return the MinHash signature of the word shingles of a text as bytes, or None if it has no words.
 
+    Each shingle is hashed once: the hash picks one of ``slots`` bins and the
+    rest of it competes for that bin's minimum (one permutation hashing).
+    Empty bins borrow the next filled bin, offset by their distance to it, so
+    two texts agree on about as many slots as their shingle sets overlap.
+    """
+    words = re.findall(r'\w+', text.lower())
+    if not words:
+        return None
+    mins = [None] * slots
+    for i in range(max(1, len(words) - SHINGLE_WORDS + 1)):
+        value = int.from_bytes(hashlib.blake2b(' '.join(words[i:i + SHINGLE_WORDS]).encode(), digest_size=8).digest(),
+                               'little')
+        slot, rest = value % slots, value // slots
+        if mins[slot] is None or rest < mins[slot]:
+            mins[slot] = rest
+    # rest < 2**64 // slots, so adding up to slots - 1 offsets still fits in 64 bits.
+    offset = 2 ** 64 // slots
+    filled = [slot for slot in range(slots) if mins[slot] is not None]
+    for slot in range(slots):
+        if mins[slot] is None:
+            donor = next((filled_slot for filled_slot in filled if filled_slot > slot), filled[0])
+            mins[slot] = mins[donor] + (donor - slot) % slots * offset
+    return array('Q', mins).tobytes()
+
+
+def text_similarity(signature, other):
+    """Estimate the Jaccard similarity of two texts from their MinHash signatures."""
+    first, second = array('Q', signature), array('Q', other)
+    return sum(a == b for a, b in zip(first, second)) / len(first)
+
+
+def difference_hash(pixels):
+    """Return the 64-bit difference hash of a 9 x 8 grayscale image given as a flat, row by row sequence of pixels.
+
+    Each bit says whether a pixel is brighter than its right neighbour, which
+    survives rescaling, recompression and small colour changes.
+    """
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = value << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def _image_fingerprint(content):
+    """Return the difference hash of an image as 8 bytes, or None if it cannot be decoded."""
+    try:
+        image = Image.open(io.BytesIO(content)).convert('L').resize((9, 8), Image.LANCZOS)
+    except (OSError, ValueError) as error:
+        logging.warning(f"Could not decode a thumbnail: {error}")
+        return None
+    return difference_hash(image.tobytes()).to_bytes(8, 'big')
+
+
+def _near_duplicate_kind(file):
+    """Return 'text' or 'image' for files the near-duplicate stage can fingerprint, or None."""
+    if file.get('mimeType') in EXPORT_MIME_TYPES:
+        return 'text'
+    if Image is not None and file.get('mimeType', '').startswith('image/') and 'thumbnailLink' in file:
+        return 'image'
+    return None
+
+
+class _ThumbnailRequest:
+    """A thumbnailLink download, executed like an API request so call_api retries it and records its stats."""
+
+    endpoint = 'thumbnail'
+
+    def __init__(self, service, uri):
+        self.service = service
+        self.uri = uri
+
+    def execute(self):
+        response, content = self.service._http.request(self.uri)
+        if response.status != 200:
+            raise HttpError(response, content, uri=self.uri)
+        return content
+
+
+def fingerprint_file(service, file):
+    """Fetch an exported document or a thumbnail and return its fingerprint bytes, or None if it has none.
+
+    Raises HttpError if the content cannot be fetched, so the failure is not cached.
+    """
+    if _near_duplicate_kind(file) == 'text':
+        content = call_api(service.files().export(fileId=file['id'], mimeType=EXPORT_MIME_TYPES[file['mimeType']]))
+        return minhash_text(content.decode('utf-8', errors='replace'))
+    return _image_fingerprint(call_api(_ThumbnailRequest(service, file['thumbnailLink'])))
+
+
+def _lsh_candidates(fingerprints, bands):
+    """Yield each pair of IDs that share at least one band.
+
+    ``fingerprints`` maps IDs to fingerprint bytes and ``bands`` lists the
+    (start, end) byte ranges that are bucketed separately; only pairs that
+    land in the same bucket are ever compared.
+    """
+    seen = set()
+    for band, (start, end) in enumerate(bands):
+        buckets = {}
+        for file_id, fingerprint in fingerprints.items():
+            buckets.setdefault(fingerprint[start:end], []).append(file_id)
+        for members in buckets.values():
+            for i, first in enumerate(members):
+                for second in members[i + 1:]:
+                    if (first, second) not in seen:
+                        seen.add((first, second))
+                        yield first, second
+
+
+def group_near_duplicates(files, fingerprints, kind, text_threshold=DEFAULT_TEXT_SIMILARITY,
+                          image_distance=DEFAULT_IMAGE_DISTANCE):
+    """Cluster files of one kind whose fingerprints are close, using an LSH index instead of comparing all pairs.
+
+    MinHash signatures are cut into MINHASH_BANDS bands of rows; a pair is a
+    candidate if all rows of one band agree, then kept if its estimated
+    similarity reaches ``text_threshold``. Image hashes are cut into
+    ``image_distance`` + 1 bands, so any two hashes at most ``image_distance``
+    bits apart share a band; candidates are kept if they are. Files with the
+    same md5Checksum are left to the exact duplicate scan. Returns a list of
+    groups of file dicts, largest first.
+    """
+    if kind == 'text':
+        band_bytes = MINHASH_SLOTS // MINHASH_BANDS * 8
+        bands = [(band * band_bytes, (band + 1) * band_bytes) for band in range(MINHASH_BANDS)]
+        close = lambda a, b: text_similarity(a, b) >= text_threshold
+    else:
+        # Bands are whole bytes, so a distance above 7 is checked with 8 one-byte bands and may miss some pairs.
+        count = min(image_distance + 1, 8)
+        bands = [(8 * band // count, 8 * (band + 1) // count) for band in range(count)]
+        close = lambda a, b: bin(int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).count('1') <= image_distance
+
+    parent = {}
+
+    def find(file_id):
+        root = file_id
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while file_id != root:
+            parent[file_id], file_id = root, parent.get(file_id, file_id)
+        return root
+
+    for first, second in _lsh_candidates(fingerprints, bands):
+        md5 = files[first].get('md5Checksum')
+        if md5 is not None and md5 == files[second].get('md5Checksum'):
+            continue
+        root, other = find(first), find(second)
+        if root != other and close(fingerprints[first], fingerprints[second]):
+            parent.setdefault(root, root)
+            parent[other] = root
+
+    clusters = {}
+    for file_id in parent:
+        clusters.setdefault(find(file_id), []).append(files[file_id])
+    return sorted(clusters.values(), key=len, reverse=True)
+
+
+def find_near_duplicates(service, folder_id=None, recursive=False, workers=1, service_factory=None, pack_queries=False,
+                         sharded=False, cache_path=DEFAULT_FINGERPRINT_CACHE_PATH,
+                         text_threshold=DEFAULT_TEXT_SIMILARITY, image_distance=DEFAULT_IMAGE_DISTANCE):
+    """Find Google Docs, Sheets and Slides with nearly the same text, and images that look alike.
+
+    Native files are exported as text and fingerprinted with ``minhash_text``;
+    images are fingerprinted with the ``difference_hash`` of their thumbnail,
+    which needs Pillow. Fingerprints are fetched on ``workers`` threads, each
+    with its own client from ``service_factory``, and cached in a
+    FingerprintCache at ``cache_path``, so a later run only fetches new or
+    modified files. Groups are only reported, never trashed. Returns a list of
+    (kind, files) tuples.
+    """
+    if Image is None:
+        logging.warning("Pillow is not installed, so images are skipped. Install it with: pip install Pillow")
+    files = {}
+    listed = iter_files(service, folder_id, recursive, workers=workers, service_factory=service_factory,
+                        pack_queries=pack_queries, fields=NEAR_DUPLICATE_FIELDS, sharded=sharded)
+    for file in _stats.timed(listed, 'listing'):
+        if _near_duplicate_kind(file):
+            files[file['id']] = file
+
+    cache = FingerprintCache(cache_path)
+    fingerprints = {'text': {}, 'image': {}}
+    try:
+        to_fetch = []
+        for file in files.values():
+            found, fingerprint = cache.get(file['id'], file.get('modifiedTime', ''))
+            if not found:
+                to_fetch.append(file)
+            elif fingerprint is not None:
+                fingerprints[_near_duplicate_kind(file)][file['id']] = fingerprint
+        logging.info(f"Fingerprinting {len(to_fetch)} of {len(files)} documents and images "
+                     f"({len(files) - len(to_fetch)} cached) with {workers} worker(s).")
+
+        def fetch(file):
+            try:
+                return file, fingerprint_file(service_factory() if service_factory else service, file), None
+            except HttpError as error:
+                return file, None, error
+
+        fetched = []
+        progress = Progress("Fingerprinted {done} of {total} files.")
+        with _stats.phase('fingerprinting') as fingerprinting, ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            fingerprinting['items'] = len(to_fetch)
+            for i, (file, fingerprint, error) in enumerate(executor.map(fetch, to_fetch), 1):
+                if error is not None:
+                    logging.error(f"Could not fetch the content of {file['name']} (ID: {file['id']}): {error}")
+                    continue
+                fetched.append((file['id'], file.get('modifiedTime', ''), fingerprint))
+                if fingerprint is not None:
+                    fingerprints[_near_duplicate_kind(file)][file['id']] = fingerprint
+                if len(fetched) >= 1000:
+                    cache.put_many(fetched)
+                    fetched = []
+                progress.update(done=i, total=len(to_fetch))
+        cache.put_many(fetched)
+    finally:
+        cache.close()
+
+    groups = []
+    with _stats.phase('grouping') as grouping:
+        grouping['items'] = len(files)
+        for kind in ('text', 'image'):
+            groups += [(kind, group) for group in group_near_duplicates(files, fingerprints[kind], kind,
+                                                                        text_threshold, image_distance)]
+    if not groups:
+        logging.info("No near-duplicate files found.")
+        return groups
+    logging.info(f"Found {len(groups)} groups of near-duplicate files. They are only reported, not trashed.")
+    for kind, group in groups:
+        logging.info(f"  Similar {'documents' if kind == 'text' else 'images'}:")
+        for file in group:
+            logging.info(f"    - {file['name']} (ID: {file['id']})")
+    return groups
 
 
 def main():
     parser = argparse.ArgumentParser(description="Find duplicate files in Google Drive")
     parser.add_argument('--delete', action='store_true', help='Move duplicate files to trash')
     parser.add_argument('--folder', help='ID of the Google Drive folder to scan')
+    parser.add_argument('--token', action='append', metavar='PATH',
+                        help='OAuth token file of an account to scan (default: token.json). Repeat to scan several '
+                             'accounts at once; a missing file starts the sign-in flow for a new account')
+    parser.add_argument('--shared-drive', action='append', default=[], metavar='ID',
+                        help='ID of a shared drive to scan, through the first --token account. Can be repeated.')
+    parser.add_argument('--all-shared-drives', action='store_true',
+                        help='Scan every shared drive each account is a member of')
+    parser.add_argument('--skip-my-drive', action='store_true',
+                        help='With --shared-drive or --all-shared-drives, do not scan the My Drive of each account')
     parser.add_argument('--recursive', action='store_true', help='Scan subfolders recursively when a folder is specified')
     parser.add_argument('--keep-strategy', choices=['oldest', 'newest', 'smallest', 'largest', 'shortest_name', 'longest_name'],
                         help='Strategy to keep one file in each duplicate group (e.g., oldest, newest, smallest, etc.). Implies --delete.')
-    parser.add_argument('--trash-folder-id', help='ID of the folder from which to trash duplicate files. Implies --delete.')
+    parser.add_argument('--trash-folder-id', action='append', default=[],
+                        help='ID of a folder from which to trash duplicate files, subfolders included. Can be repeated. Implies --delete.')
+    parser.add_argument('--trash-path', action='append', default=[], metavar='GLOB',
+                        help='Trash duplicates whose path matches GLOB, e.g. "/My Drive/Backups/*". Can be repeated. Implies --delete.')
+    parser.add_argument('--keep-folder-id', action='append', default=[],
+                        help='Never trash duplicates in this folder or its subfolders. Can be repeated.')
+    parser.add_argument('--keep-path', action='append', default=[], metavar='GLOB',
+                        help='Never trash duplicates whose path matches GLOB. Can be repeated.')
+    parser.add_argument('--rules', metavar='PATH',
+                        help='JSON file with a list of keep and trash rules in priority order, applied before the rule flags')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Number of concurrent requests used by recursive scans (default: 8)')
+    parser.add_argument('--pack-queries', action='store_true',
+                        help='Merge many folders into each recursive listing query to save requests')
+    parser.add_argument('--shard-listing', action='store_true',
+                        help='List scans without --recursive as parallel modifiedTime ranges on --workers threads')
+    parser.add_argument('--index', metavar='PATH',
+                        help='Keep a local metadata index of the whole drive at PATH and only fetch changes on later runs')
+    parser.add_argument('--max-qps', type=float, default=DEFAULT_MAX_QPS,
+                        help=f'Upper bound on Drive API requests per second, sized to the project quota (default: {DEFAULT_MAX_QPS})')
+    parser.add_argument('--checkpoint', metavar='PATH',
+                        help='Log the scan progress to PATH so an interrupted scan can be continued with --resume')
+    parser.add_argument('--resume', action='store_true',
+                        help=f'Continue an interrupted scan from its checkpoint instead of starting over '
+                             f'(default checkpoint: {DEFAULT_CHECKPOINT_PATH})')
+    parser.add_argument('--lean-listing', action='store_true',
+                        help='List only id, md5Checksum and size, then fetch the remaining metadata for duplicates only')
+    parser.add_argument('--plan', metavar='PATH',
+                        help='Write the duplicate groups and the files the selection options would trash to PATH '
+                             'instead of trashing them')
+    parser.add_argument('--apply-plan', metavar='PATH',
+                        help='Trash the files in a plan written by --plan, after checking they did not change')
+    parser.add_argument('--folder-duplicates', action='store_true',
+                        help='Report folders whose whole subtrees are identical instead of single files; '
+                             'with --delete, all but one copy of each folder is trashed')
+    parser.add_argument('--local-dir', metavar='PATH',
+                        help='Report which files under this local directory already exist in Drive instead of finding duplicates')
+    parser.add_argument('--local-report', metavar='PATH', default='local_vs_drive.csv',
+                        help='CSV report written by --local-dir (default: local_vs_drive.csv)')
+    parser.add_argument('--hash-workers', type=int,
+                        help='Processes used to hash local files (default: one per CPU)')
+    parser.add_argument('--hash-cache', metavar='PATH', default=DEFAULT_HASH_CACHE_PATH,
+                        help=f'Cache of local file hashes (default: {DEFAULT_HASH_CACHE_PATH})')
+    parser.add_argument('--near-duplicates', action='store_true',
+                        help='Report Google Docs, Sheets and Slides with nearly the same text and images that look '
+                             'alike, which have no shared md5Checksum. Images need Pillow')
+    parser.add_argument('--fingerprint-cache', metavar='PATH', default=DEFAULT_FINGERPRINT_CACHE_PATH,
+                        help=f'Cache of near-duplicate fingerprints (default: {DEFAULT_FINGERPRINT_CACHE_PATH})')
+    parser.add_argument('--text-similarity', type=float, default=DEFAULT_TEXT_SIMILARITY,
+                        help=f'Share of text two documents need in common to be reported (default: {DEFAULT_TEXT_SIMILARITY})')
+    parser.add_argument('--image-distance', type=int, default=DEFAULT_IMAGE_DISTANCE,
+                        help=f'Most bits two image hashes may differ in to be reported (default: {DEFAULT_IMAGE_DISTANCE})')
+    parser.add_argument('--report', metavar='PATH', default=DEFAULT_REPORT_PATH,
+                        help=f'JSON lines file that every duplicate group is written to (default: {DEFAULT_REPORT_PATH})')
+    parser.add_argument('--log-file', metavar='PATH', default=DEFAULT_LOG_PATH,
+                        help=f'File the log is appended to (default: {DEFAULT_LOG_PATH})')
+    parser.add_argument('--stats-json', metavar='PATH',
+                        help='Write request counts, latency histograms, retries, bytes received and the time and '
+                             'throughput of each phase to PATH at the end of the run')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Profile the run with cProfile and write the stats to PATH. Only the main thread is '
+                             'profiled; time spent waiting for worker threads shows up as waits')
+    parser.add_argument('--watch', action='store_true',
+                        help='Scan the whole drive once, then keep running and report new duplicates as they appear; '
+                             'with --keep-strategy or trash rules, the new copies they select are trashed right away')
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL, metavar='SECONDS',
+                        help=f'Seconds between two reads of the changes feed in --watch mode (default: {DEFAULT_POLL_INTERVAL})')
+    parser.add_argument('--status-file', metavar='PATH',
+                        help='In --watch mode, rewrite PATH with the map size, detection lag and event counts after every poll')
     args = parser.parse_args()
-    service = get_service()
+    if args.watch and (args.folder or args.index or args.plan or args.apply_plan or args.local_dir
+                       or args.folder_duplicates or args.lean_listing or args.checkpoint or args.resume
+                       or args.recursive):
+        parser.error('--watch follows the changes feed of the whole drive and only supports the selection options')
+    if args.watch and args.delete and not (args.keep_strategy or args.trash_folder_id or args.trash_path or args.rules):
+        parser.error('--watch --delete needs --keep-strategy or trash rules to choose which new duplicates to trash')
+    if args.near_duplicates and (args.index or args.delete or args.keep_strategy or args.trash_folder_id
+                                 or args.trash_path or args.plan or args.apply_plan or args.local_dir
+                                 or args.folder_duplicates or args.watch or args.lean_listing or args.checkpoint
+                                 or args.resume):
+        parser.error('--near-duplicates only reports similar files and supports --folder, --recursive and --shard-listing')
+    if args.index and args.folder:
+        parser.error('--index always covers the whole drive and cannot be combined with --folder')
+    if args.index and (args.checkpoint or args.resume or args.lean_listing or args.shard_listing or args.pack_queries):
+        parser.error('--index reads the drive from the local index and does not list it, so it cannot be combined '
+                     'with --checkpoint, --resume, --lean-listing, --shard-listing or --pack-queries')
+    if args.folder_duplicates and (args.index or args.keep_strategy or args.trash_folder_id or args.trash_path
+                                   or args.keep_folder_id or args.keep_path or args.rules):
+        parser.error('--folder-duplicates scans the folder tree and only supports --delete')
+    if args.plan and args.delete:
+        parser.error('--plan only writes what would be trashed; trash it afterwards with --apply-plan')
+    if args.shard_listing and args.recursive:
+        parser.error('--shard-listing only applies to scans without --recursive')
+    configure_scheduler(max_qps=args.max_qps, max_concurrency=max(args.workers, 1))
+    tokens = args.token or ['token.json']
+    multi_source = len(tokens) > 1 or args.shared_drive or args.all_shared_drives
+    if multi_source and (args.folder or args.index or args.lean_listing or args.checkpoint or args.resume
+                         or args.local_dir or args.folder_duplicates or args.apply_plan or args.plan or args.watch
+                         or args.near_duplicates):
+        parser.error('Scanning several accounts or shared drives only supports whole-drive duplicate scans')
+
+    configure_logging(args.log_file)
+    reset_stats()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        _run(args, tokens, multi_source)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logging.info(f"Profile written to {args.profile}. Inspect it with: python -m pstats {args.profile}")
+        if args.stats_json:
+            _stats.write(args.stats_json)
+        stop_logging()
+
+
+def _run(args, tokens, multi_source):
+    """Run the mode selected by the parsed command line arguments."""
+    creds = get_credentials(tokens[0])
+    service = get_service(creds)
+
+    if args.local_dir:
+        compare_local_to_drive(service, args.local_dir, args.local_report, folder_id=args.folder,
+                               recursive=args.recursive, workers=args.workers,
+                               service_factory=make_service_factory(creds), pack_queries=args.pack_queries,
+                               index_path=args.index, hash_workers=args.hash_workers, hash_cache_path=args.hash_cache,
+                               sharded=args.shard_listing)
+        return
+
+    if args.apply_plan:
+        apply_plan(service, args.apply_plan)
+        return
+
+    if args.near_duplicates:
+        find_near_duplicates(service, folder_id=args.folder, recursive=args.recursive, workers=args.workers,
+                             service_factory=make_service_factory(creds), pack_queries=args.pack_queries,
+                             sharded=args.shard_listing, cache_path=args.fingerprint_cache,
+                             text_threshold=args.text_similarity, image_distance=args.image_distance)
+        return
+
+    delete = (args.delete or args.keep_strategy or args.trash_folder_id or args.trash_path) and not args.plan
+    # Keep rules come before trash rules, so a file matching both is kept.
+    rules = load_rules(args.rules) if args.rules else []
+    rules += [SelectionRule('keep', folder_id=folder_id) for folder_id in args.keep_folder_id]
+    rules += [SelectionRule('keep', path=path) for path in args.keep_path]
+    rules += [SelectionRule('trash', folder_id=folder_id) for folder_id in args.trash_folder_id]
+    rules += [SelectionRule('trash', path=path) for path in args.trash_path]
+
+    if args.folder_duplicates:
+        find_duplicate_folders(service, args.folder or 'root', delete=args.delete, workers=args.workers,
+                               service_factory=make_service_factory(creds), pack_queries=args.pack_queries)
+        return
+
+    if args.watch:
+        watcher = DuplicateWatcher(service, delete=delete, keep_strategy=args.keep_strategy, rules=rules,
+                                   status_path=args.status_file)
+        watcher.start(workers=args.workers, service_factory=make_service_factory(creds), sharded=args.shard_listing)
+        try:
+            watcher.run(args.poll_interval)
+        except KeyboardInterrupt:
+            logging.info(f"Stopped watching: {watcher.stats()}")
+        return
 
-    delete = args.delete or args.keep_strategy or args.trash_folder_id
+    sources = None
+    if multi_source:
+        factories = {tokens[0]: make_service_factory(creds)}
+        for token in tokens[1:]:
+            factories[token] = make_service_factory(get_credentials(token))
+        sources = build_sources(factories, args.shared_drive, args.all_shared_drives,
+                                include_my_drive=not args.skip_my_drive)
 
     find_duplicates(service, delete=delete, folder_id=args.folder, recursive=args.recursive, 
-                    keep_strategy=args.keep_strategy, trash_folder_id=args.trash_folder_id)
+                    keep_strategy=args.keep_strategy, rules=rules,
+                    workers=args.workers, service_factory=make_service_factory(creds),
+                    pack_queries=args.pack_queries, index_path=args.index,
+                    lean_listing=args.lean_listing, resume=args.resume,
+                    sharded=args.shard_listing, plan_path=args.plan, sources=sources, report_path=args.report,
+                    checkpoint_path=args.checkpoint or (DEFAULT_CHECKPOINT_PATH if args.resume else None))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,656 @@
+"""In-memory fake of the parts of the Drive v3 API that duplicate_scanner uses.
+
+FakeDriveService can stand in for the object returned by get_service() in
+tests and offline benchmarks. It supports files().list with pagination,
+``q`` filter evaluation, ``fields`` projection and shared drive corpora,
+files().get/update/export, thumbnail downloads through ``_http``,
+changes().getStartPageToken/list, drives().list, batch requests, per-round-trip latency and random or scripted error injection.
+Every round trip is counted, together with the JSON size of its response.
+
+    drive = build_synthetic_drive(100000, folders=2000)
+    service = FakeDriveService(drive, latency=0.05)
+"""
+import json
+import random
+import re
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import Counter
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+NATIVE_MIME_TYPES = ('application/vnd.google-apps.document', 'application/vnd.google-apps.spreadsheet',
+                     'application/vnd.google-apps.presentation')
+ROOT_ID = 'root'
+THUMBNAIL_URL = 'https://fake.drive/thumbnails/'
+
+
+def _format_time(seconds):
+    """Format an epoch time as an RFC 3339 UTC string with milliseconds, like Drive's time fields."""
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)) + f'.{int(seconds % 1 * 1000):03d}Z'
+
+
+class FakeFile:
+    """One stored file or folder; kept small so synthetic drives of millions of files fit in memory.
+
+    ``content`` is what files().export returns for a Google Doc, Sheet or
+    Slides file, and the thumbnail image of any other file. A file with an
+    ``owner`` reports ``ownedByMe`` to the service of that account only.
+    """
+    __slots__ = ('id', 'name', 'mime_type', 'md5', 'size', 'parents', 'modified_time', 'trashed', 'drive_id',
+                 'content', 'owner')
+
+    def __init__(self, id, name, mime_type, parents, md5=None, size=None, modified_time='2020-01-01T00:00:00.000Z',
+                 trashed=False, drive_id=None, content=None, owner=None):
+        self.id = id
+        self.name = name
+        self.mime_type = mime_type
+        self.parents = tuple(parents)
+        self.md5 = md5
+        self.size = size
+        self.modified_time = modified_time
+        self.trashed = trashed
+        self.drive_id = drive_id
+        self.content = content
+        self.owner = owner
+
+    def to_dict(self, account=None):
+        file = {'kind': 'drive#file', 'id': self.id, 'name': self.name, 'mimeType': self.mime_type,
+                'parents': list(self.parents), 'trashed': self.trashed, 'modifiedTime': self.modified_time}
+        if self.md5 is not None:
+            file['md5Checksum'] = self.md5
+        if self.size is not None:
+            file['size'] = str(self.size)
+        if self.drive_id is not None:
+            file['driveId'] = self.drive_id
+        if self.owner is not None:
+            file['ownedByMe'] = self.owner == account
+        if self.content is not None and not self.mime_type.startswith('application/vnd.google-apps.'):
+            file['thumbnailLink'] = THUMBNAIL_URL + self.id
+        return file
+
+    def value(self, field):
+        return {'name': self.name, 'mimeType': self.mime_type, 'trashed': self.trashed,
+                'modifiedTime': self.modified_time}[field]
+
+
+class FakeDrive:
+    """The stored state of a fake drive: files, shared drives, a parent index, a modifiedTime index and a change log.
+
+    Files in a shared drive carry its ID in ``drive_id``; the top folder of a
+    shared drive has the drive's ID, as in Drive.
+    """
+
+    def __init__(self):
+        self.shared_drives = {}
+        self.files = {}
+        self.children = {}
+        self.change_log = []
+        self.change_times = []
+        self.lock = threading.RLock()
+        self._by_modified_time = None
+
+    def by_modified_time(self):
+        """Return (modified times, files) sorted by modifiedTime, rebuilt after any change."""
+        with self.lock:
+            if self._by_modified_time is None:
+                files = sorted(self.files.values(), key=lambda file: file.modified_time)
+                self._by_modified_time = ([file.modified_time for file in files], files)
+            return self._by_modified_time
+
+    def add(self, file):
+        with self.lock:
+            self.files[file.id] = file
+            for parent in file.parents:
+                self.children.setdefault(parent, []).append(file.id)
+            self._log_change(file.id)
+            self._by_modified_time = None
+        return file
+
+    def add_shared_drive(self, drive_id, name=None):
+        with self.lock:
+            self.shared_drives[drive_id] = name or drive_id
+
+    def add_folder(self, folder_id, name=None, parent=None, drive_id=None):
+        return self.add(FakeFile(folder_id, name or folder_id, FOLDER_MIME_TYPE, [parent or drive_id or ROOT_ID],
+                                 drive_id=drive_id))
+
+    def add_file(self, file_id, name=None, parent=None, md5=None, size=None, mime_type='application/octet-stream',
+                 modified_time='2020-01-01T00:00:00.000Z', drive_id=None, content=None, owner=None):
+        return self.add(FakeFile(file_id, name or file_id, mime_type, [parent or drive_id or ROOT_ID], md5, size,
+                                 modified_time, drive_id=drive_id, content=content, owner=owner))
+
+    def update(self, file_id, **changes):
+        with self.lock:
+            file = self.files[file_id]
+            for attr, value in changes.items():
+                setattr(file, attr, value)
+            self._log_change(file_id)
+            self._by_modified_time = None
+        return file
+
+    def delete(self, file_id):
+        with self.lock:
+            file = self.files.pop(file_id)
+            for parent in file.parents:
+                self.children[parent].remove(file_id)
+            self._log_change(file_id)
+            self._by_modified_time = None
+
+    def _log_change(self, file_id):
+        self.change_log.append(file_id)
+        self.change_times.append(time.time())
+
+
+def build_synthetic_drive(files, folders=None, duplicate_ratio=0.05, native_ratio=0.1, seed=0):
+    """Build a FakeDrive with a random folder tree under ROOT_ID.
+
+    ``duplicate_ratio`` of the binary files copy the content of an earlier
+    file and ``native_ratio`` of all files are Google Docs without an
+    md5Checksum.
+    """
+    rng = random.Random(seed)
+    drive = FakeDrive()
+    folders = max(1, files // 50) if folders is None else folders
+    folder_ids = [ROOT_ID]
+    for i in range(folders):
+        folder_id = f'folder{i:09d}'
+        drive.add_folder(folder_id, f'Folder {i}', rng.choice(folder_ids))
+        folder_ids.append(folder_id)
+
+    contents = []
+    for i in range(files):
+        parent = rng.choice(folder_ids)
+        modified_time = f'20{rng.randint(15, 25)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T00:00:00.000Z'
+        if rng.random() < native_ratio:
+            drive.add(FakeFile(f'file{i:010d}', f'Document {i}', rng.choice(NATIVE_MIME_TYPES), [parent],
+                               modified_time=modified_time))
+            continue
+        if contents and rng.random() < duplicate_ratio:
+            md5, size = rng.choice(contents)
+        else:
+            md5, size = f'{i:032x}', rng.randint(1, 10 ** 8)
+            contents.append((md5, size))
+        drive.add(FakeFile(f'file{i:010d}', f'IMG_{i:08d}.jpg', 'image/jpeg', [parent], md5, size, modified_time))
+    return drive
+
+
+_TOKEN_RE = re.compile(r"\s*(?:(?P<string>'(?:[^'\\]|\\.)*')|(?P<op>!=|<=|>=|=|<|>|\(|\))|(?P<word>[A-Za-z0-9_.:-]+))")
+
+
+def _tokenize(query):
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = _TOKEN_RE.match(query, position)
+        if not match or match.end() == position:
+            raise ValueError(f"Invalid query near: {query[position:]!r}")
+        position = match.end()
+        if match.group('string') is not None:
+            tokens.append(('string', re.sub(r"\\(.)", r"\1", match.group('string')[1:-1])))
+        elif match.group('op') is not None:
+            tokens.append(('op', match.group('op')))
+        else:
+            tokens.append(('word', match.group('word')))
+    return tokens
+
+
+class _QueryParser:
+    """Recursive descent parser for the subset of the Drive query language used by the scanner.
+
+    Produces a tree of tuples: ('and', a, b), ('or', a, b), ('not', a),
+    ('in_parents', folder_id) and ('compare', field, op, value).
+    """
+
+    def __init__(self, query):
+        self.tokens = _tokenize(query)
+        self.position = 0
+
+    def parse(self):
+        node = self._or()
+        if self.position != len(self.tokens):
+            raise ValueError(f"Unexpected token {self.tokens[self.position]!r}")
+        return node
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def _next(self):
+        token = self._peek()
+        self.position += 1
+        return token
+
+    def _or(self):
+        node = self._and()
+        while self._peek() == ('word', 'or'):
+            self._next()
+            node = ('or', node, self._and())
+        return node
+
+    def _and(self):
+        node = self._unary()
+        while self._peek() == ('word', 'and'):
+            self._next()
+            node = ('and', node, self._unary())
+        return node
+
+    def _unary(self):
+        if self._peek() == ('word', 'not'):
+            self._next()
+            return ('not', self._unary())
+        if self._peek() == ('op', '('):
+            self._next()
+            node = self._or()
+            if self._next() != ('op', ')'):
+                raise ValueError("Missing closing parenthesis")
+            return node
+        return self._comparison()
+
+    def _comparison(self):
+        kind, value = self._next()
+        if kind == 'string':
+            if self._next() != ('word', 'in') or self._next() != ('word', 'parents'):
+                raise ValueError("Only \"'<id>' in parents\" is supported")
+            return ('in_parents', value)
+        field = value
+        _, op = self._next()
+        value_kind, literal = self._next()
+        if value_kind == 'word':
+            literal = {'true': True, 'false': False}.get(literal, literal)
+        return ('compare', field, op, literal)
+
+
+_COMPARE = {
+    '=': lambda a, b: a == b, '!=': lambda a, b: a != b, '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b, '>': lambda a, b: a > b, '>=': lambda a, b: a >= b,
+}
+
+
+def _matches(node, file):
+    kind = node[0]
+    if kind == 'and':
+        return _matches(node[1], file) and _matches(node[2], file)
+    if kind == 'or':
+        return _matches(node[1], file) or _matches(node[2], file)
+    if kind == 'not':
+        return not _matches(node[1], file)
+    if kind == 'in_parents':
+        return node[1] in file.parents
+    _, field, op, value = node
+    if op == 'contains':
+        return value in file.value(field)
+    return _COMPARE[op](file.value(field), value)
+
+
+def _candidate_parents(node):
+    """Return the folder IDs a query is restricted to, or None if it may match anywhere."""
+    kind = node[0]
+    if kind == 'in_parents':
+        return {node[1]}
+    if kind == 'and':
+        left, right = _candidate_parents(node[1]), _candidate_parents(node[2])
+        if left is None:
+            return right
+        return left if right is None else left & right
+    if kind == 'or':
+        left, right = _candidate_parents(node[1]), _candidate_parents(node[2])
+        return None if left is None or right is None else left | right
+    return None
+
+
+def _modified_time_bounds(node):
+    """Return the (lowest, highest) modifiedTime a query can match; either may be None for unbounded."""
+    kind = node[0]
+    if kind == 'and':
+        left, right = _modified_time_bounds(node[1]), _modified_time_bounds(node[2])
+        lows = [bound for bound in (left[0], right[0]) if bound is not None]
+        highs = [bound for bound in (left[1], right[1]) if bound is not None]
+        return max(lows, default=None), min(highs, default=None)
+    if kind == 'compare' and node[1] == 'modifiedTime':
+        if node[2] in ('>', '>='):
+            return node[3], None
+        if node[2] in ('<', '<='):
+            return None, node[3]
+        if node[2] == '=':
+            return node[3], node[3]
+    return None, None
+
+
+def _parse_fields(fields):
+    """Parse a fields selector like "nextPageToken, files(id, name)" into a nested dict."""
+    tree = {}
+    stack = [tree]
+    name = ''
+    for char in fields or '':
+        if char in ',()':
+            if name.strip():
+                stack[-1][name.strip()] = None
+            if char == '(':
+                subtree = {}
+                stack[-1][name.strip()] = subtree
+                stack.append(subtree)
+            elif char == ')':
+                stack.pop()
+            name = ''
+        else:
+            name += char
+    if name.strip():
+        stack[-1][name.strip()] = None
+    return tree
+
+
+def _project(value, tree):
+    if not tree:
+        return value
+    if isinstance(value, list):
+        return [_project(item, tree) for item in value]
+    if isinstance(value, dict):
+        return {key: _project(item, tree[key]) for key, item in value.items() if key in tree}
+    return value
+
+
+def _http_error(status, reason):
+    content = json.dumps({'error': {'code': status, 'message': reason, 'errors': [{'reason': reason}]}})
+    return HttpError(httplib2.Response({'status': status}), content.encode())
+
+
+_ERROR_REASONS = {429: 'rateLimitExceeded', 403: 'userRateLimitExceeded', 500: 'backendError', 503: 'backendError'}
+
+
+class FakeRequest:
+    """A pending fake API call, executed like googleapiclient's HttpRequest."""
+
+    def __init__(self, service, endpoint, handler):
+        self.service = service
+        self.endpoint = endpoint
+        self.handler = handler
+
+    def execute(self):
+        return self.service._round_trip(self)
+
+
+class FakeBatch:
+    """Fake of BatchHttpRequest: one round trip, one callback per item."""
+
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None, callback=None):
+        self.requests.append((request_id or str(len(self.requests)), request, callback or self.callback))
+
+    def execute(self):
+        self.service._round_trip(self)
+
+
+class FakeDriveService:
+    """Drop-in fake for the Drive v3 service object built by googleapiclient.
+
+    ``latency`` seconds are spent per round trip (a single call or a whole
+    batch). ``error_rate`` is the probability that a call fails with one of
+    ``error_statuses``; ``fail_next`` scripts specific failures. Counters:
+    ``requests`` (calls per endpoint, batch items included), ``round_trips``
+    and ``bytes_received``. The service is thread-safe, so one instance can
+    be shared by all workers. ``_http`` stands in for the authorized
+    transport of a real client and serves thumbnailLink URLs. ``account``
+    names the account the service acts for; several services on one
+    FakeDrive stand for accounts that can see the same files.
+    """
+
+    def __init__(self, drive=None, latency=0.0, error_rate=0.0, error_statuses=(429, 500, 503), seed=0,
+                 max_page_size=1000, account=None):
+        self.drive = drive if drive is not None else FakeDrive()
+        self.account = account
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.max_page_size = max_page_size
+        self.rng = random.Random(seed)
+        self.scripted_errors = []
+        self.requests = Counter()
+        self.round_trips = 0
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+        # Like Drive's, page tokens stay valid after their last page, so a resumed scan can reuse them.
+        self._cursors = {}
+        self._next_cursor = 0
+        self._http = _FakeHttp(self)
+
+    def fail_next(self, count=1, status=429, endpoint=None):
+        """Make the next ``count`` calls (optionally only to ``endpoint``) fail with ``status``."""
+        with self.lock:
+            self.scripted_errors.extend([(endpoint, status)] * count)
+
+    # Resources
+
+    def files(self):
+        return _FilesResource(self)
+
+    def changes(self):
+        return _ChangesResource(self)
+
+    def drives(self):
+        return _DrivesResource(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    # Plumbing
+
+    def _injected_error(self, endpoint):
+        with self.lock:
+            for i, (scripted_endpoint, status) in enumerate(self.scripted_errors):
+                if scripted_endpoint in (None, endpoint):
+                    del self.scripted_errors[i]
+                    return _http_error(status, _ERROR_REASONS.get(status, 'error'))
+            if self.error_rate and self.rng.random() < self.error_rate:
+                status = self.rng.choice(self.error_statuses)
+                return _http_error(status, _ERROR_REASONS.get(status, 'error'))
+        return None
+
+    def _call(self, request):
+        with self.lock:
+            self.requests[request.endpoint] += 1
+        error = self._injected_error(request.endpoint)
+        if error is not None:
+            raise error
+        return request.handler()
+
+    def _round_trip(self, request):
+        with self.lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if isinstance(request, FakeBatch):
+            with self.lock:
+                self.requests['batch'] += 1
+            error = self._injected_error('batch')
+            if error is not None:
+                raise error
+            received = 0
+            for request_id, item, callback in request.requests:
+                try:
+                    response = self._call(item)
+                except HttpError as item_error:
+                    callback(request_id, None, item_error)
+                else:
+                    received += len(json.dumps(response))
+                    callback(request_id, response, None)
+            with self.lock:
+                self.bytes_received += received
+            return None
+        response = self._call(request)
+        with self.lock:
+            self.bytes_received += len(response) if isinstance(response, bytes) else len(json.dumps(response))
+        return response
+
+    def _store_cursor(self, items):
+        with self.lock:
+            self._next_cursor += 1
+            token = f'cursor{self._next_cursor}'
+            self._cursors[token] = items
+        return token
+
+    def _page(self, items, page_size, offset):
+        """Return the page starting at offset and the token for the rest, if any."""
+        end = offset + min(page_size or 100, self.max_page_size)
+        return items[offset:end], (end if end < len(items) else None)
+
+
+class _FilesResource:
+    def __init__(self, service):
+        self.service = service
+        self.drive = service.drive
+
+    def list(self, q=None, pageSize=100, fields=None, pageToken=None, orderBy=None, **kwargs):
+        def handler():
+            if pageToken:
+                token, offset = pageToken.rsplit(':', 1)
+                items = self.service._cursors[token]
+                offset = int(offset)
+            else:
+                token, items, offset = None, self._query(q, orderBy, kwargs), 0
+            page, next_offset = self.service._page(items, pageSize, offset)
+            response = {'kind': 'drive#fileList', 'files': [file.to_dict(self.service.account) for file in page]}
+            if next_offset is not None:
+                token = token or self.service._store_cursor(items)
+                response['nextPageToken'] = f'{token}:{next_offset}'
+            return _project(response, _parse_fields(fields))
+        return FakeRequest(self.service, 'files.list', handler)
+
+    def _query(self, q, order_by=None, corpus=None):
+        items = self._match(q)
+        # Like Drive, only list shared drive items when asked to, and only one shared drive with corpora=drive.
+        corpus = corpus or {}
+        if corpus.get('corpora') == 'drive':
+            items = [file for file in items if file.drive_id == corpus.get('driveId')]
+        elif not corpus.get('includeItemsFromAllDrives'):
+            items = [file for file in items if file.drive_id is None]
+        # Sort by the last key first, so the stable sorts leave the first key in charge.
+        for key in reversed(order_by.split(',') if order_by else []):
+            field, *direction = key.split()
+            items.sort(key=lambda file: file.value(field) or '', reverse=direction == ['desc'])
+        return items
+
+    def _match(self, q):
+        with self.drive.lock:
+            if not q:
+                return list(self.drive.files.values())
+            node = _QueryParser(q).parse()
+            parents = _candidate_parents(node)
+            low, high = _modified_time_bounds(node)
+            if parents is None and (low or high):
+                times, files = self.drive.by_modified_time()
+                candidates = files[bisect_left(times, low) if low else 0:bisect_right(times, high) if high else None]
+            elif parents is None:
+                candidates = self.drive.files.values()
+            else:
+                candidates = [self.drive.files[file_id] for parent in sorted(parents)
+                              for file_id in self.drive.children.get(parent, ())]
+            return [file for file in candidates if _matches(node, file)]
+
+    def get(self, fileId, fields=None, **kwargs):
+        def handler():
+            with self.drive.lock:
+                file = self.drive.files.get(fileId)
+                if file is None and fileId == ROOT_ID:
+                    return _project({'kind': 'drive#file', 'id': ROOT_ID, 'name': 'My Drive',
+                                     'mimeType': FOLDER_MIME_TYPE}, _parse_fields(fields))
+                if file is None:
+                    raise _http_error(404, 'notFound')
+                return _project(file.to_dict(self.service.account), _parse_fields(fields))
+        return FakeRequest(self.service, 'files.get', handler)
+
+    def update(self, fileId, body=None, fields=None, **kwargs):
+        def handler():
+            with self.drive.lock:
+                if fileId not in self.drive.files:
+                    raise _http_error(404, 'notFound')
+                if body and 'trashed' in body:
+                    self.drive.update(fileId, trashed=body['trashed'])
+                file = self.drive.files[fileId].to_dict(self.service.account)
+            return _project(file, _parse_fields(fields or 'id, name, mimeType, kind'))
+        return FakeRequest(self.service, 'files.update', handler)
+
+
+    def export(self, fileId, mimeType, **kwargs):
+        def handler():
+            with self.drive.lock:
+                file = self.drive.files.get(fileId)
+                if file is None:
+                    raise _http_error(404, 'notFound')
+                if not file.mime_type.startswith('application/vnd.google-apps.'):
+                    raise _http_error(403, 'fileNotExportable')
+                return file.content or b''
+        return FakeRequest(self.service, 'files.export', handler)
+
+
+class _FakeHttp:
+    """Serves GET requests for thumbnailLink URLs like an authorized httplib2 transport."""
+
+    def __init__(self, service):
+        self.service = service
+
+    def request(self, uri, method='GET', **kwargs):
+        def handler():
+            with self.service.drive.lock:
+                file = self.service.drive.files.get(uri[len(THUMBNAIL_URL):])
+                return file.content if file is not None and file.content is not None else b''
+        content = FakeRequest(self.service, 'thumbnail', handler).execute()
+        return httplib2.Response({'status': 200 if content else 404}), content
+
+
+class _DrivesResource:
+    def __init__(self, service):
+        self.service = service
+        self.drive = service.drive
+
+    def list(self, pageSize=10, fields=None, pageToken=None, **kwargs):
+        def handler():
+            with self.drive.lock:
+                drives = [{'kind': 'drive#drive', 'id': drive_id, 'name': name}
+                          for drive_id, name in self.drive.shared_drives.items()]
+            offset = int(pageToken or 0)
+            response = {'kind': 'drive#driveList', 'drives': drives[offset:offset + pageSize]}
+            if offset + pageSize < len(drives):
+                response['nextPageToken'] = str(offset + pageSize)
+            return _project(response, _parse_fields(fields))
+        return FakeRequest(self.service, 'drives.list', handler)
+
+
+class _ChangesResource:
+    def __init__(self, service):
+        self.service = service
+        self.drive = service.drive
+
+    def getStartPageToken(self, **kwargs):
+        def handler():
+            with self.drive.lock:
+                return {'kind': 'drive#startPageToken', 'startPageToken': str(len(self.drive.change_log))}
+        return FakeRequest(self.service, 'changes.getStartPageToken', handler)
+
+    def list(self, pageToken, pageSize=100, fields=None, **kwargs):
+        def handler():
+            with self.drive.lock:
+                start = int(pageToken)
+                end = min(start + min(pageSize, self.service.max_page_size), len(self.drive.change_log))
+                changes = []
+                for file_id, changed in zip(self.drive.change_log[start:end], self.drive.change_times[start:end]):
+                    file = self.drive.files.get(file_id)
+                    change = {'kind': 'drive#change', 'changeType': 'file', 'fileId': file_id,
+                              'removed': file is None, 'time': _format_time(changed)}
+                    if file is not None:
+                        change['file'] = file.to_dict(self.service.account)
+                    changes.append(change)
+                response = {'kind': 'drive#changeList', 'changes': changes}
+                if end < len(self.drive.change_log):
+                    response['nextPageToken'] = str(end)
+                else:
+                    response['newStartPageToken'] = str(end)
+            return _project(response, _parse_fields(fields))
+        return FakeRequest(self.service, 'changes.list', handler)
@@ -1,6 +1,74 @@
+import csv
+import hashlib
+import io
+import json
+import logging
+import logging.handlers
+import os
+import random
+import tempfile
+import time
 import unittest
-from unittest.mock import Mock
-from duplicate_scanner import SelectionAssistant
+from unittest.mock import Mock, patch
+import httplib2
+from googleapiclient.errors import HttpError
+from duplicate_scanner import (DuplicateWatcher, FileRecord, FolderTree, MetadataIndex, Progress, RequestScheduler,
+                               ScanCheckpoint, SelectionAssistant, SelectionRule,
+                               apply_plan, build_folder_tree, build_sources, compare_local_to_drive, configure_logging,
+                               fetch_all_files, find_duplicate_folders, find_duplicates, find_near_duplicates,
+                               group_by_md5, group_identical_folders, hash_local_tree, hydrate_records, iter_files,
+                               iter_sources, minhash_text, reset_stats, stop_logging, sync_index, text_similarity,
+                               trash_files_batched, _pack_folder_ids, _parents_clause)
+from fake_drive import FakeDrive, FakeDriveService, build_synthetic_drive
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+MD5_1 = 'c4ca4238a0b923820dcc509a6f75849b'
+MD5_2 = 'c81e728d9d4c2f636f067f89cc14862c'
+
+
+class TestFetchAllFilesRecursive(unittest.TestCase):
+
+    def setUp(self):
+        self.drive = FakeDrive()
+        self.drive.add_folder("sub1", parent="root")
+        self.drive.add_folder("sub2", parent="sub1")
+        self.drive.add_file("f1", parent="root", md5="x")
+        self.drive.add_file("f2", parent="sub1", md5="x")
+        self.drive.add_file("f3", parent="sub2", md5="y")
+        self.service = FakeDriveService(self.drive)
+
+    def test_recursive_scan_finds_nested_files(self):
+        files = fetch_all_files(self.service, folder_id="root", recursive=True, workers=4,
+                                service_factory=lambda: self.service)
+        self.assertEqual(sorted(f['id'] for f in files), ["f1", "f2", "f3"])
+        # One subfolder query and one file query per folder
+        self.assertEqual(self.service.requests['files.list'], 6)
+
+    def test_packed_queries_cut_requests(self):
+        self.drive.add_folder("sub3", parent="root")
+        self.drive.add_file("f4", parent="sub3", md5="y")
+        files = fetch_all_files(self.service, folder_id="root", recursive=True, workers=2,
+                                service_factory=lambda: self.service, pack_queries=True)
+        self.assertEqual(sorted(f['id'] for f in files), ["f1", "f2", "f3", "f4"])
+        # sub1 and sub3 share one subfolder query and one file query
+        self.assertEqual(self.service.requests['files.list'], 6)
+
+    def test_pack_folder_ids_respects_query_length(self):
+        folder_ids = [f"folder{i}" for i in range(10)]
+        chunks = list(_pack_folder_ids(folder_ids, 60))
+        self.assertEqual([f_id for chunk in chunks for f_id in chunk], folder_ids)
+        for chunk in chunks:
+            self.assertLessEqual(len(_parents_clause(chunk)), 60)
+        self.assertEqual(list(_pack_folder_ids(folder_ids[:3], 0)), [["folder0"], ["folder1"], ["folder2"]])
+
+    def test_multiple_workers_require_service_factory(self):
+        with self.assertRaises(ValueError):
+            fetch_all_files(self.service, folder_id="root", recursive=True, workers=4)
+
 
 class TestSelectionAssistant(unittest.TestCase):
 
@@ -149,5 +217,820 @@ class TestSelectionAssistant(unittest.TestCase):
         self.assertIn({"id": "file1_newest", "name": "b_longer_name.txt", "modifiedTime": "2023-01-02T10:00:00Z", "size": "200", "parents": ["folderB"]}, files_to_trash)
         self.assertIn({"id": "file1_oldest", "name": "a.txt", "modifiedTime": "2023-01-01T10:00:00Z", "size": "100", "parents": ["folderA"]}, files_to_trash)
 
+class TestSelectionRules(unittest.TestCase):
+
+    def setUp(self):
+        # /My Drive/Photos/2020 and /My Drive/Backups/Old
+        self.tree = FolderTree([
+            {"id": "root", "name": "My Drive"},
+            {"id": "photos", "name": "Photos", "parents": ["root"]},
+            {"id": "y2020", "name": "2020", "parents": ["photos"]},
+            {"id": "backups", "name": "Backups", "parents": ["root"]},
+            {"id": "old", "name": "Old", "parents": ["backups"]},
+        ])
+        self.photo = {"id": "photo", "name": "a.jpg", "modifiedTime": "2023-01-02", "parents": ["y2020"]}
+        self.backup = {"id": "backup", "name": "a.jpg", "modifiedTime": "2023-01-01", "parents": ["old"]}
+        self.loose = {"id": "loose", "name": "a copy.jpg", "modifiedTime": "2023-01-03", "parents": ["root"]}
+        self.groups = {"md5": [self.photo, self.backup, self.loose]}
+
+    def trashed_ids(self, *rules, keep_strategy=None):
+        assistant = SelectionAssistant(Mock(), self.groups, self.tree)
+        if keep_strategy:
+            assistant.mark_all_but_one(keep_strategy)
+        for rule in rules:
+            assistant.add_rule(rule)
+        return sorted(file['id'] for file in assistant.get_files_to_trash())
+
+    def test_folder_rule_covers_nested_subfolders(self):
+        self.assertEqual(self.trashed_ids(SelectionRule('trash', folder_id="backups")), ["backup"])
+
+    def test_first_matching_rule_wins(self):
+        rules = [SelectionRule('keep', path="/My Drive/Backups/*"), SelectionRule('trash', folder_id="root")]
+        self.assertEqual(self.trashed_ids(*rules), ["loose", "photo"])
+
+    def test_keep_strategy_applies_to_files_no_rule_decided(self):
+        self.assertEqual(self.trashed_ids(SelectionRule('trash', path="*/Old/*"), keep_strategy='newest'),
+                         ["backup", "photo"])
+        self.assertEqual(self.trashed_ids(SelectionRule('keep', folder_id="photos"), keep_strategy='oldest'),
+                         ["backup", "loose"])
+
+    def test_one_copy_is_always_kept(self):
+        self.assertEqual(self.trashed_ids(SelectionRule('trash', folder_id="root"), keep_strategy='oldest'),
+                         ["loose", "photo"])
+
+    def test_a_file_listed_twice_is_never_trashed(self):
+        groups = {"md5": [self.backup, dict(self.backup)]}
+        assistant = SelectionAssistant(Mock(), groups, self.tree)
+        assistant.mark_all_but_one('oldest')
+        self.assertEqual(assistant.get_files_to_trash(), [])
+
+    def test_folder_tree_fetches_missing_ancestors(self):
+        drive = FakeDrive()
+        drive.add_folder("photos", name="Photos")
+        drive.add_folder("y2020", name="2020", parent="photos")
+        service = FakeDriveService(drive)
+        tree = FolderTree([{"id": "photos", "name": "Photos", "parents": ["root"]}])
+        tree.fetch(service, ["y2020"])
+        self.assertEqual(tree.path("y2020"), "/My Drive/Photos/2020")
+        self.assertEqual(service.requests['files.get'], 2)
+
+
+def http_error(status, reason=''):
+    return HttpError(httplib2.Response({'status': status}), f'{{"error": {{"errors": [{{"reason": "{reason}"}}]}}}}'.encode())
+
+
+class TestTrashFilesBatched(unittest.TestCase):
+
+    def setUp(self):
+        self.drive = FakeDrive()
+        self.files = [self.drive.add_file(f"file{i}", f"{i}.txt", md5=MD5_1).to_dict() for i in range(250)]
+        self.service = FakeDriveService(self.drive)
+
+    def test_batches_hold_at_most_100_updates(self):
+        trashed, failed = trash_files_batched(self.service, self.files)
+        self.assertEqual(len(trashed), 250)
+        self.assertEqual(failed, [])
+        self.assertEqual(self.service.requests['batch'], 3)
+        self.assertTrue(all(file.trashed for file in self.drive.files.values()))
+
+    @patch('duplicate_scanner.time.sleep')
+    def test_rate_limited_items_are_requeued(self, mock_sleep):
+        self.service.fail_next(1, 429, 'files.update')
+        self.service.fail_next(1, 403, 'files.update')
+        missing = {"id": "missing", "name": "missing.txt"}
+        trashed, failed = trash_files_batched(self.service, self.files[:8] + [missing])
+        self.assertEqual(sorted(f['id'] for f in trashed), sorted(f"file{i}" for i in range(8)))
+        self.assertEqual([f['id'] for f in failed], ["missing"])
+        # The two rate limited updates went out again in a second batch
+        self.assertEqual(self.service.requests['batch'], 2)
+        self.assertEqual(self.service.requests['files.update'], 11)
+        mock_sleep.assert_called_once()
+
+
+class TestRequestScheduler(unittest.TestCase):
+
+    @patch('duplicate_scanner.time.sleep')
+    def test_retries_rate_limits_and_halves_concurrency(self, mock_sleep):
+        scheduler = RequestScheduler(max_concurrency=8)
+        request = Mock()
+        request.execute.side_effect = [http_error(429), http_error(503), {'id': 'ok'}]
+        self.assertEqual(scheduler.execute(request), {'id': 'ok'})
+        self.assertEqual(request.execute.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+        # Halved once for the 429, then a small additive increase for the success
+        self.assertLess(scheduler.concurrency, 5)
+        self.assertEqual(scheduler.in_flight, 0)
+
+    @patch('duplicate_scanner.time.sleep')
+    def test_non_retryable_errors_are_raised(self, mock_sleep):
+        scheduler = RequestScheduler()
+        request = Mock()
+        request.execute.side_effect = http_error(404, 'notFound')
+        with self.assertRaises(HttpError):
+            scheduler.execute(request)
+        mock_sleep.assert_not_called()
+
+    @patch('duplicate_scanner.time.sleep')
+    def test_gives_up_after_max_retries(self, mock_sleep):
+        scheduler = RequestScheduler(max_retries=2)
+        request = Mock()
+        request.execute.side_effect = http_error(403, 'userRateLimitExceeded')
+        with self.assertRaises(HttpError):
+            scheduler.execute(request)
+        self.assertEqual(request.execute.call_count, 3)
+
+    def test_backoff_grows_exponentially_with_jitter(self):
+        scheduler = RequestScheduler(base_delay=1.0, max_delay=64.0)
+        for attempt in range(1, 9):
+            delay = scheduler.backoff_delay(attempt)
+            cap = min(64.0, 2 ** attempt)
+            self.assertGreaterEqual(delay, cap / 2)
+            self.assertLessEqual(delay, cap)
+
+
+class TestRunStats(unittest.TestCase):
+
+    @patch('duplicate_scanner.time.sleep')
+    def test_records_calls_retries_and_phases_of_a_scan(self, mock_sleep):
+        drive = FakeDrive()
+        for i in range(2500):
+            drive.add_file(f"file{i}", md5=(MD5_1, MD5_2)[i % 2], size=1, modified_time=f"2020-01-01T00:00:{i % 60:02d}.000Z")
+        service = FakeDriveService(drive)
+        service.fail_next(1, status=503, endpoint='files.list')
+        stats = reset_stats()
+
+        find_duplicates(service, delete=True, keep_strategy='oldest')
+
+        report = stats.report()
+        listing = report['requests']['files.list']
+        self.assertEqual((listing['calls'], listing['errors'], listing['retries']), (4, 1, 1))
+        self.assertEqual(sum(listing['histogram'].values()), listing['calls'])
+        self.assertEqual(report['requests']['batch']['batched_calls'], 2498)
+        self.assertEqual(report['round_trips'], service.round_trips)
+        self.assertEqual({name: phase['items'] for name, phase in report['phases'].items()},
+                         {'listing': 2500, 'grouping': 2500, 'selection': 2500, 'trashing': 2498})
+        self.assertGreater(report['scheduler']['peak_in_flight'], 0)
+        json.dumps(report)
+
+    def test_time_spent_in_a_wrapped_iterator_is_not_charged_to_the_enclosing_phase(self):
+        stats = reset_stats()
+
+        def slow_listing():
+            for i in range(3):
+                time.sleep(0.02)
+                yield i
+
+        with stats.phase('grouping') as grouping:
+            self.assertEqual(list(stats.timed(slow_listing(), 'listing', grouping)), [0, 1, 2])
+        phases = stats.report()['phases']
+        self.assertGreaterEqual(phases['listing']['seconds'], 0.06)
+        self.assertLess(phases['grouping']['seconds'], 0.02)
+        self.assertEqual(phases['grouping']['items'], 3)
+
+
+class TestHydrateRecords(unittest.TestCase):
+
+    def test_lean_records_get_name_parents_and_modified_time(self):
+        groups = group_by_md5(iter([
+            {"id": "a", "md5Checksum": MD5_1, "size": "10"},
+            {"id": "b", "md5Checksum": MD5_1, "size": "10"},
+            {"id": "c", "md5Checksum": MD5_2, "size": "20"},
+        ]))
+        drive = FakeDrive()
+        drive.add_file("a", "a.txt", parent="folderA", md5=MD5_1, size=10, modified_time="2023-01-01T10:00:00Z")
+        drive.add_file("c", "c.txt", parent="folderA", md5=MD5_2, size=20)
+        service = FakeDriveService(drive)
+        fetched, failed = hydrate_records(service, groups)
+        self.assertEqual([record.id for record in failed], ["b"])
+        record = fetched[0]
+        self.assertEqual((record.id, record['name'], record['parents'], record['modifiedTime']),
+                         ("a", "a.txt", ("folderA",), "2023-01-01T10:00:00Z"))
+        self.assertEqual(service.requests['batch'], 1)
+        # "b" is gone, so its group no longer holds duplicates.
+        self.assertEqual(groups, {})
+
+    def test_files_that_fail_hydration_are_never_kept_or_reported(self):
+        drive = FakeDrive()
+        for i, modified_time in enumerate(("2020", "2021", "2022")):
+            drive.add_file(f"copy{i}", md5=MD5_1, size=10, modified_time=f"{modified_time}-01-01T00:00:00.000Z")
+        service = FakeDriveService(drive)
+        # The oldest copy disappears between the listing and the metadata fetch.
+        service.fail_next(1, status=404, endpoint='files.get')
+
+        find_duplicates(service, delete=True, keep_strategy='oldest', lean_listing=True)
+
+        self.assertEqual(sorted(f.id for f in drive.files.values() if f.trashed), ["copy2"])
+
+
+class TestScanCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'checkpoint.jsonl')
+        self.drive = FakeDrive()
+        self.drive.add_folder("sub1")
+        self.drive.add_folder("sub2", parent="sub1")
+        for i in range(2500):
+            self.drive.add_file(f"file{i}", parent=("root", "sub1", "sub2")[i % 3], md5=MD5_1)
+        self.service = FakeDriveService(self.drive)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def interrupted_scan(self, files_before_interrupt, **kwargs):
+        checkpoint = ScanCheckpoint(self.path, {'scan': 1})
+        files = iter_files(self.service, checkpoint=checkpoint, **kwargs)
+        for _ in range(files_before_interrupt):
+            next(files)
+        files.close()
+        checkpoint.close()
+
+    def test_flat_scan_resumes_from_last_page_token(self):
+        self.interrupted_scan(1500)
+        self.assertEqual(self.service.requests['files.list'], 2)
+        checkpoint = ScanCheckpoint(self.path, {'scan': 1}, resume=True)
+        ids = [f['id'] for f in iter_files(self.service, checkpoint=checkpoint)]
+        checkpoint.close()
+        self.assertEqual(sorted(ids), sorted(f"file{i}" for i in range(2500)))
+        self.assertEqual(self.service.requests['files.list'], 3)
+
+    def test_recursive_scan_resumes_pending_folders(self):
+        self.interrupted_scan(1, folder_id="root", recursive=True)
+        checkpoint = ScanCheckpoint(self.path, {'scan': 1}, resume=True)
+        discovered, discover_done, files_done = checkpoint.recursive_state("root")
+        self.assertEqual(len(files_done), 1)
+        ids = [f['id'] for f in iter_files(self.service, "root", recursive=True, checkpoint=checkpoint)]
+        checkpoint.close()
+        self.assertEqual(sorted(ids), sorted(f"file{i}" for i in range(2500)))
+
+    def test_sharded_scan_resumes_pending_shards(self):
+        self.interrupted_scan(1500, sharded=True, workers=2, service_factory=lambda: self.service)
+        checkpoint = ScanCheckpoint(self.path, {'scan': 1}, resume=True)
+        ids = [f['id'] for f in iter_files(self.service, checkpoint=checkpoint, sharded=True, workers=2,
+                                           service_factory=lambda: self.service)]
+        checkpoint.close()
+        self.assertEqual(sorted(ids), sorted(f"file{i}" for i in range(2500)))
+
+    def test_truncated_last_line_is_ignored(self):
+        self.interrupted_scan(1500)
+        with open(self.path, 'a') as checkpoint_file:
+            checkpoint_file.write('{"t":"page","next":"tok')
+        checkpoint = ScanCheckpoint(self.path, {'scan': 1}, resume=True)
+        self.assertEqual(len(list(checkpoint.replay_files())), 2000)
+        checkpoint.close()
+
+    def test_resume_rejects_a_different_scan(self):
+        self.interrupted_scan(10)
+        with self.assertRaises(ValueError):
+            ScanCheckpoint(self.path, {'scan': 2}, resume=True)
+
+
+class TestShardedListing(unittest.TestCase):
+
+    def test_shards_cover_the_drive_exactly_once(self):
+        drive = build_synthetic_drive(5000)
+        serial = sorted(f['id'] for f in iter_files(FakeDriveService(drive)))
+        service = FakeDriveService(drive, max_page_size=100)
+        sharded = [f['id'] for f in iter_files(service, sharded=True, workers=4, service_factory=lambda: service)]
+        self.assertEqual(sorted(sharded), serial)
+        # Re-split shards start over from their last modifiedTime instead of following the page token.
+        self.assertGreater(service.requests['files.list'], len(serial) // 100)
+
+    def test_a_file_edited_during_the_scan_is_yielded_once(self):
+        drive = build_synthetic_drive(20000)
+        service = FakeDriveService(drive, max_page_size=100)
+        ids = []
+        for file in iter_files(service, sharded=True, workers=4, service_factory=lambda: service):
+            if not ids:
+                # The edit moves the file into the last shard, which is listed later.
+                drive.update(file['id'], modified_time='2099-01-01T00:00:00.000Z')
+            ids.append(file['id'])
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(len(ids), 20000)
+
+    def test_a_single_worker_follows_page_tokens(self):
+        drive = build_synthetic_drive(5000)
+        service = FakeDriveService(drive, max_page_size=100)
+        ids = [f['id'] for f in iter_files(service, sharded=True, workers=1, service_factory=lambda: service)]
+        self.assertEqual(len(ids), 5000)
+        # Two initial shards, each paged through without being split again.
+        self.assertLessEqual(service.requests['files.list'], 5000 // 100 + 2)
+
+    def test_each_source_is_sharded_on_its_share_of_the_workers(self):
+        drive = build_synthetic_drive(5000)
+        service = FakeDriveService(drive, max_page_size=100)
+        ids = [f['id'] for f in iter_sources(build_sources({'a': lambda: service}), workers=4, sharded=True)]
+        self.assertEqual(len(ids), 5000)
+        # Idle workers take over re-split shards instead of the source paging through on one thread.
+        self.assertGreater(service.requests['files.list'], 5000 // 100 + 2)
+
+    def test_files_sharing_one_modified_time_are_paged_through(self):
+        drive = FakeDrive()
+        for i in range(250):
+            drive.add_file(f"file{i}", md5=MD5_1, modified_time='2021-05-05T10:00:00.000Z')
+        drive.add_file("later", md5=MD5_2, modified_time='2022-05-05T10:00:00.000Z')
+        service = FakeDriveService(drive, max_page_size=100)
+        ids = [f['id'] for f in iter_files(service, sharded=True, workers=3, service_factory=lambda: service)]
+        self.assertEqual(sorted(ids), sorted([f"file{i}" for i in range(250)] + ["later"]))
+
+    def test_shards_split_after_following_a_page_token_skip_the_earlier_pages(self):
+        drive = FakeDrive()
+        for year in (2015, 2023):
+            for i in range(250):
+                drive.add_file(f"file{year}_{i}", md5=MD5_1, modified_time=f'{year}-05-05T10:00:00.000Z')
+        for i in range(30):
+            drive.add_file(f"other{i}", md5=MD5_2, modified_time=f'{2010 + i % 14}-0{1 + i % 9}-05T10:00:00.000Z')
+        service = FakeDriveService(drive, max_page_size=100)
+        ids = [f['id'] for f in iter_files(service, sharded=True, workers=2, service_factory=lambda: service)]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(len(ids), 530)
+
+
+class TestDuplicateFolders(unittest.TestCase):
+
+    def setUp(self):
+        self.drive = FakeDrive()
+        self.drive.add_folder("C")
+        for folder, parent in (("A", "root"), ("B", "root"), ("C_A", "C")):
+            self.drive.add_folder(folder, parent=parent)
+            self.drive.add_folder(folder + "_sub", name="sub", parent=folder)
+            self.drive.add_file(folder + "_f1", parent=folder, md5=MD5_1, size=10)
+            self.drive.add_file(folder + "_f2", parent=folder + "_sub", md5=MD5_2, size=20)
+        # Same files, but both at the top level.
+        self.drive.add_folder("D")
+        self.drive.add_file("D_f1", parent="D", md5=MD5_1, size=10)
+        self.drive.add_file("D_f2", parent="D", md5=MD5_2, size=20)
+        # Google Docs have no md5Checksum, so folders holding them are never reported.
+        for folder in ("E", "F"):
+            self.drive.add_folder(folder)
+            self.drive.add_file(folder + "_doc", parent=folder, mime_type='application/vnd.google-apps.document')
+        self.service = FakeDriveService(self.drive)
+
+    def test_subtree_hashes_ignore_names_but_not_structure(self):
+        nodes = build_folder_tree(self.service, "root")
+        self.assertEqual(nodes["A"].hash, nodes["B"].hash)
+        self.assertEqual(nodes["A"].hash, nodes["C_A"].hash)
+        self.assertNotEqual(nodes["A"].hash, nodes["D"].hash)
+        self.assertIsNone(nodes["E"].hash)
+        self.assertIsNone(nodes["root"].hash)
+        self.assertEqual((nodes["A"].file_count, nodes["A"].size), (2, 30))
+        self.assertEqual(nodes["C_A_sub"].path, "/C/C_A/sub")
+
+    def test_only_outermost_copies_are_reported(self):
+        groups = group_identical_folders(build_folder_tree(self.service, "root"))
+        self.assertEqual([sorted(node.id for node in group) for group in groups], [["A", "B", "C_A"]])
+
+    def test_delete_trashes_whole_folders_and_keeps_shortest_path(self):
+        find_duplicate_folders(self.service, "root", delete=True)
+        self.assertEqual(self.service.requests['files.update'], 2)
+        self.assertEqual(sorted(f.id for f in self.drive.files.values() if f.trashed), ["B", "C_A"])
+
+    def test_delete_never_trashes_a_folder_holding_another_groups_kept_copy(self):
+        drive = FakeDrive()
+        drive.add_folder("abc")
+        drive.add_folder("e", parent="abc")
+        drive.add_folder("d")
+        drive.add_folder("verylongname", parent="d")
+        drive.add_folder("qqqqqqq")
+        for folder in ("e", "verylongname", "qqqqqqq"):
+            drive.add_file(folder + "_f", parent=folder, md5=MD5_1, size=10)
+        service = FakeDriveService(drive)
+
+        find_duplicate_folders(service, "root", delete=True)
+
+        trashed = {f.id for f in drive.files.values() if f.trashed}
+
+        def in_trash(file_id):
+            while file_id in drive.files:
+                if file_id in trashed:
+                    return True
+                file_id = drive.files[file_id].parents[0]
+            return False
+        self.assertEqual([folder for folder in ("e", "verylongname", "qqqqqqq") if not in_trash(folder)], ["e"])
+        self.assertNotIn("abc", trashed)
+
+
+class TestPlanFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'plan.jsonl')
+        self.drive = FakeDrive()
+        for group, md5 in enumerate((MD5_1, MD5_2, 'c' * 32)):
+            for copy in range(3):
+                self.drive.add_file(f"g{group}_{copy}", md5=md5, size=10,
+                                    modified_time=f'202{copy}-01-01T00:00:00.000Z')
+        self.service = FakeDriveService(self.drive)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_dry_run_writes_plan_and_apply_checks_before_trashing(self):
+        find_duplicates(self.service, keep_strategy='oldest', plan_path=self.path)
+        self.assertFalse(any(f.trashed for f in self.drive.files.values()))
+        with open(self.path) as plan:
+            self.assertEqual(len(plan.readlines()), 4)
+
+        self.drive.update("g0_1", modified_time='2024-01-01T00:00:00.000Z')
+        self.drive.delete("g1_0")
+        list_requests = self.service.requests['files.list']
+        self.assertEqual(apply_plan(self.service, self.path, groups_per_chunk=2), (3, 0, 3))
+        self.assertEqual(self.service.requests['files.list'], list_requests)
+        self.assertEqual(sorted(f.id for f in self.drive.files.values() if f.trashed), ["g0_2", "g2_1", "g2_2"])
+
+    def test_rejects_files_that_are_not_plans(self):
+        with open(self.path, 'w') as plan:
+            plan.write('{"t": "scan"}\n')
+        with self.assertRaises(ValueError):
+            apply_plan(self.service, self.path)
+
+
+class TestReportingAndLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_duplicate_report_is_written_instead_of_logged(self):
+        drive = FakeDrive()
+        for copy in range(3):
+            drive.add_file(f"copy{copy}", f"copy{copy}.txt", md5=MD5_1, size=10)
+        drive.add_file("unique", md5=MD5_2, size=10)
+        report_path = os.path.join(self.tmpdir.name, 'report.jsonl')
+
+        with self.assertLogs(level='INFO') as logs:
+            find_duplicates(FakeDriveService(drive), report_path=report_path)
+
+        self.assertFalse(any('copy1.txt' in line for line in logs.output))
+        with open(report_path) as report:
+            groups = [json.loads(line) for line in report]
+        self.assertEqual([(group['md5'], group['size']) for group in groups], [(MD5_1, 10)])
+        self.assertEqual([file['name'] for file in groups[0]['files']], ['copy0.txt', 'copy1.txt', 'copy2.txt'])
+
+    def test_progress_is_throttled(self):
+        with self.assertLogs(level='INFO') as logs:
+            progress = Progress("Listed {files} files.", interval=3600)
+            for files in range(1000):
+                progress.update(files=files)
+            progress.interval = progress.next_log = 0
+            progress.update(files=1000)
+        self.assertEqual(logs.output, ['INFO:root:Listed 1000 files.'])
+
+    def test_records_reach_the_log_file_through_the_background_thread(self):
+        root = logging.getLogger()
+        handlers, level = root.handlers[:], root.level
+        self.addCleanup(lambda: (setattr(root, 'handlers', handlers), root.setLevel(level)))
+        log_path = os.path.join(self.tmpdir.name, 'scan.log')
+
+        with patch('sys.stdout'):
+            configure_logging(log_path)
+            self.assertIsInstance(root.handlers[0], logging.handlers.QueueHandler)
+            logging.info("queued record")
+            stop_logging()
+        with open(log_path) as log:
+            self.assertIn("INFO - queued record", log.read())
+
+
+class TestMultipleSources(unittest.TestCase):
+
+    def setUp(self):
+        self.drive_a = FakeDrive()
+        self.drive_a.add_shared_drive("team", "Team")
+        self.drive_a.add_file("a_mine", md5=MD5_1, modified_time='2020-01-01T00:00:00.000Z')
+        self.drive_a.add_file("a_team", md5=MD5_1, drive_id="team", modified_time='2021-01-01T00:00:00.000Z')
+        self.drive_a.add_file("a_other", md5=MD5_2)
+        self.drive_b = FakeDrive()
+        self.drive_b.add_shared_drive("team", "Team")
+        self.drive_b.add_file("b_mine", md5=MD5_1, modified_time='2022-01-01T00:00:00.000Z')
+        self.service_a = FakeDriveService(self.drive_a)
+        self.service_b = FakeDriveService(self.drive_b)
+        self.sources = build_sources({'a': lambda: self.service_a, 'b': lambda: self.service_b},
+                                     all_shared_drives=True)
+
+    def test_shared_drives_are_listed_once_and_only_when_asked_for(self):
+        self.assertEqual([source.name for source in self.sources],
+                         ["My Drive of a", "shared drive Team", "My Drive of b"])
+        self.assertEqual([f['id'] for f in iter_files(self.service_a)], ["a_mine", "a_other"])
+        self.assertEqual([f['id'] for f in iter_files(self.service_a, drive_id="team")], ["a_team"])
+
+    def test_duplicates_across_drives_are_trashed_through_their_own_account(self):
+        find_duplicates(self.service_a, keep_strategy='oldest', delete=True, workers=3, sources=self.sources)
+        self.assertEqual(sorted(f.id for f in self.drive_a.files.values() if f.trashed), ["a_team"])
+        self.assertEqual(sorted(f.id for f in self.drive_b.files.values() if f.trashed), ["b_mine"])
+
+    def test_folder_rules_are_resolved_through_each_files_own_account(self):
+        self.drive_b.add_folder("b_backups")
+        self.drive_b.add_folder("b_sub", parent="b_backups")
+        self.drive_b.add_file("b_copy", parent="b_sub", md5=MD5_2)
+        find_duplicates(self.service_a, delete=True, rules=[SelectionRule('trash', folder_id="b_backups")],
+                        sources=self.sources)
+        self.assertEqual(sorted(f.id for f in self.drive_b.files.values() if f.trashed), ["b_copy"])
+        self.assertEqual(self.service_b.requests['files.get'], 2)
+
+    def test_a_file_several_accounts_can_see_is_listed_once_from_its_owner(self):
+        drive = FakeDrive()
+        drive.add_file("only", md5=MD5_1, owner="b")
+        drive.add_file("elsewhere", md5=MD5_2, owner="c")
+        service_a = FakeDriveService(drive, account="a")
+        service_b = FakeDriveService(drive, account="b")
+        sources = build_sources({'a': lambda: service_a, 'b': lambda: service_b})
+        self.assertEqual(sorted((f['id'], f['source']) for f in iter_sources(sources, workers=2)),
+                         [("elsewhere", 0), ("only", 1)])
+        find_duplicates(service_a, keep_strategy='oldest', delete=True, workers=2, sources=sources)
+        self.assertEqual([f.id for f in drive.files.values() if f.trashed], [])
+
+
+class TestGroupByMd5(unittest.TestCase):
+
+    def test_groups_stream_and_keeps_only_needed_fields(self):
+        files = iter([
+            {"id": "a", "name": "a.txt", "md5Checksum": MD5_1, "size": "10", "trashed": False, "kind": "drive#file"},
+            {"id": "b", "name": "b.txt", "md5Checksum": MD5_1, "size": "10", "trashed": False, "kind": "drive#file"},
+            {"id": "c", "name": "c.txt", "md5Checksum": MD5_2, "size": "20"},
+            {"id": "doc", "name": "native doc"},
+        ])
+        groups = group_by_md5(files)
+        self.assertEqual(list(groups), [bytes.fromhex(MD5_1)])
+        self.assertEqual([record.to_dict() for record in groups[bytes.fromhex(MD5_1)]], [
+            {"id": "a", "name": "a.txt", "md5Checksum": MD5_1, "size": "10"},
+            {"id": "b", "name": "b.txt", "md5Checksum": MD5_1, "size": "10"},
+        ])
+
+    def test_file_record_supports_dict_style_access(self):
+        record = FileRecord.from_drive({"id": "a", "name": "a.txt", "md5Checksum": MD5_1, "size": "10",
+                                        "parents": ["folderA"]})
+        self.assertEqual(record.md5, bytes.fromhex(MD5_1))
+        self.assertEqual(record['md5Checksum'], MD5_1)
+        self.assertEqual(record.get('size'), 10)
+        self.assertIn('parents', record)
+        self.assertNotIn('modifiedTime', record)
+        self.assertEqual(record.get('modifiedTime', ''), '')
+        with self.assertRaises(KeyError):
+            record['modifiedTime']
+
+
+class TestMetadataIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = MetadataIndex(':memory:')
+        self.service = Mock()
+        self.service.changes().getStartPageToken().execute.return_value = {'startPageToken': 'token1'}
+        self.service.files().list().execute.return_value = {'files': [
+            {"id": "a", "name": "a.txt", "md5Checksum": MD5_1, "size": "10", "parents": ["p"], "modifiedTime": "t1"},
+            {"id": "b", "name": "b.txt", "md5Checksum": MD5_1, "size": "10", "parents": ["q"], "modifiedTime": "t2"},
+            {"id": "c", "name": "c.txt", "md5Checksum": MD5_2, "size": "20", "parents": ["p"], "modifiedTime": "t3"},
+            {"id": "doc", "name": "native doc", "parents": ["p"]},
+        ]}
+
+    def tearDown(self):
+        self.index.close()
+
+    def test_first_sync_builds_index_from_full_scan(self):
+        sync_index(self.service, self.index)
+        self.assertEqual(self.index.get_start_page_token(), 'token1')
+        self.assertEqual(self.index.count(), 3)
+        groups = self.index.duplicate_groups()
+        self.assertEqual(list(groups), [bytes.fromhex(MD5_1)])
+        self.assertIn({"id": "a", "name": "a.txt", "md5Checksum": MD5_1, "size": "10", "parents": ["p"],
+                       "modifiedTime": "t1"}, [record.to_dict() for record in groups[bytes.fromhex(MD5_1)]])
+
+    def test_later_sync_applies_only_changes(self):
+        sync_index(self.service, self.index)
+        self.service.changes().list().execute.side_effect = [
+            {'nextPageToken': 'token2', 'changes': [
+                {'fileId': 'a', 'removed': True},
+                {'fileId': 'd', 'file': {"id": "d", "name": "d.txt", "md5Checksum": MD5_2, "size": "20",
+                                         "parents": ["q"], "modifiedTime": "t4"}},
+            ]},
+            {'newStartPageToken': 'token3', 'changes': [
+                {'fileId': 'b', 'file': {"id": "b", "name": "b.txt", "md5Checksum": MD5_1, "trashed": True}},
+            ]},
+        ]
+        self.service.files().list.reset_mock()
+        self.assertEqual(sync_index(self.service, self.index), 3)
+        self.service.files().list.assert_not_called()
+        self.assertEqual(self.index.get_start_page_token(), 'token3')
+        self.assertEqual(sorted(f['id'] for f in self.index.duplicate_groups()[bytes.fromhex(MD5_2)]), ["c", "d"])
+        self.assertEqual(self.index.count(), 2)
+
+
+class TestDuplicateWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.drive = FakeDrive()
+        self.drive.add_file('a', md5=MD5_1, size=1, modified_time='2020-01-01T00:00:00.000Z')
+        self.drive.add_file('b', md5=MD5_1, size=1, modified_time='2021-01-01T00:00:00.000Z')
+        self.drive.add_file('c', md5=MD5_2, size=1, modified_time='2020-01-01T00:00:00.000Z')
+        self.drive.add_folder('folder')
+        self.service = FakeDriveService(self.drive)
+
+    def test_polls_apply_only_changes_and_report_new_duplicates(self):
+        events = []
+        status_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(status_dir.cleanup)
+        status_path = os.path.join(status_dir.name, 'status.json')
+        watcher = DuplicateWatcher(self.service, on_duplicate=lambda md5, files: events.append(
+            (md5.hex(), sorted(file['id'] for file in files))), status_path=status_path)
+        watcher.start()
+        self.assertEqual(watcher.stats()['files'], 3)
+        self.assertEqual(watcher.duplicate_groups, 1)
+        self.assertEqual(watcher.poll(), {})
+
+        listed = self.service.requests['files.list']
+        self.drive.add_file('d', md5=MD5_2, size=1)
+        self.drive.update('a', name='renamed')
+        self.drive.update('b', md5='e' * 32)
+        new_groups = watcher.poll()
+
+        self.assertEqual(self.service.requests['files.list'], listed)
+        self.assertEqual(list(new_groups), [bytes.fromhex(MD5_2)])
+        self.assertEqual(events, [(MD5_2, ['c', 'd'])])
+        self.assertEqual(watcher.groups[bytes.fromhex(MD5_1)]['name'], 'renamed')
+        stats = watcher.stats()
+        self.assertEqual((stats['files'], stats['checksums'], stats['duplicate_groups']), (4, 3, 1))
+        self.assertEqual((stats['changes'], stats['events']), (3, 1))
+        self.assertGreaterEqual(stats['last_lag_seconds'], 0)
+        with open(status_path) as status:
+            self.assertEqual(json.load(status)['events'], 1)
+
+        self.drive.delete('d')
+        self.assertEqual(watcher.poll(), {})
+        self.assertEqual(watcher.duplicate_groups, 0)
+
+    def test_keep_strategy_trashes_new_duplicates(self):
+        watcher = DuplicateWatcher(self.service, delete=True, keep_strategy='oldest')
+        watcher.start()
+        self.drive.add_file('d', md5=MD5_2, size=1, modified_time='2022-01-01T00:00:00.000Z')
+        watcher.run(interval=0, max_polls=2)
+
+        self.assertTrue(self.drive.files['d'].trashed)
+        self.assertFalse(self.drive.files['c'].trashed)
+        # The group that existed before the watch started is left alone.
+        self.assertFalse(self.drive.files['b'].trashed)
+        self.assertEqual(watcher.stats()['trashed'], 1)
+        self.assertEqual(watcher.duplicate_groups, 1)
+
+    def test_copies_that_existed_before_the_watch_are_never_trashed(self):
+        watcher = DuplicateWatcher(self.service, delete=True, keep_strategy='oldest')
+        watcher.start()
+        self.drive.add_file('e', md5=MD5_1, size=1, modified_time='2019-01-01T00:00:00.000Z')
+        watcher.poll()
+
+        # The oldest copy just joined, so the strategy would trash a and b; the watcher leaves them alone.
+        self.assertEqual([f.id for f in self.drive.files.values() if f.trashed], [])
+        self.assertEqual(watcher.stats()['trashed'], 0)
+
+
+class TestNearDuplicates(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.tmpdir.name, 'fingerprints.sqlite')
+        rng = random.Random(1)
+        self.words = [f'word{rng.randrange(5000)}' for _ in range(400)]
+        self.drive = FakeDrive()
+        self.service = FakeDriveService(self.drive)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def add_document(self, file_id, words, mime_type='application/vnd.google-apps.document'):
+        self.drive.add_file(file_id, mime_type=mime_type, content=' '.join(words).encode())
+
+    def find(self):
+        return find_near_duplicates(self.service, workers=2, service_factory=lambda: self.service,
+                                    cache_path=self.cache_path)
+
+    def test_minhash_estimates_shared_text(self):
+        edited = self.words[:200] + ['changed'] + self.words[201:]
+        self.assertEqual(text_similarity(minhash_text(' '.join(self.words)), minhash_text(' '.join(self.words))), 1.0)
+        self.assertGreater(text_similarity(minhash_text(' '.join(self.words)), minhash_text(' '.join(edited))), 0.9)
+        self.assertLess(text_similarity(minhash_text(' '.join(self.words)),
+                                        minhash_text(' '.join(reversed(self.words)))), 0.1)
+        self.assertIsNone(minhash_text('  '))
+
+    def test_groups_edited_documents_and_caches_fingerprints(self):
+        self.add_document('doc', self.words)
+        self.add_document('edited', self.words[:100] + ['inserted'] + self.words[100:])
+        self.add_document('slides', self.words, mime_type='application/vnd.google-apps.presentation')
+        self.add_document('other', list(reversed(self.words)))
+        self.add_document('empty', [])
+
+        groups = self.find()
+        self.assertEqual([(kind, sorted(file['id'] for file in group)) for kind, group in groups],
+                         [('text', ['doc', 'edited', 'slides'])])
+        self.assertEqual(self.service.requests['files.export'], 5)
+
+        self.assertEqual(len(self.find()), 1)
+        self.assertEqual(self.service.requests['files.export'], 5)
+        self.drive.update('other', content=' '.join(self.words).encode(), modified_time='2024-01-01T00:00:00.000Z')
+        self.assertEqual(sorted(file['id'] for file in self.find()[0][1]), ['doc', 'edited', 'other', 'slides'])
+        self.assertEqual(self.service.requests['files.export'], 6)
+
+    @staticmethod
+    def encode(image, image_format, **options):
+        output = io.BytesIO()
+        image.save(output, image_format, **options)
+        return output.getvalue()
+
+    @unittest.skipIf(Image is None, 'Pillow is not installed')
+    def test_groups_recompressed_images_by_thumbnail(self):
+        encode = self.encode
+        photo = Image.new('L', (64, 64))
+        photo.putdata([(x * 4 + (y // 8) * 16) % 256 for y in range(64) for x in range(64)])
+        other = photo.transpose(Image.Transpose.ROTATE_90)
+        for file_id, content in (('png', encode(photo, 'PNG')), ('jpeg', encode(photo, 'JPEG', quality=40)),
+                                 ('rotated', encode(other, 'PNG'))):
+            self.drive.add_file(file_id, md5=hashlib.md5(content).hexdigest(), size=len(content),
+                                mime_type='image/png', content=content)
+
+        groups = self.find()
+        self.assertEqual([(kind, sorted(file['id'] for file in group)) for kind, group in groups],
+                         [('image', ['jpeg', 'png'])])
+        self.assertEqual(self.service.requests['thumbnail'], 3)
+
+    @unittest.skipIf(Image is None, 'Pillow is not installed')
+    @patch('duplicate_scanner.time.sleep')
+    def test_thumbnail_downloads_are_retried_and_recorded(self, mock_sleep):
+        content = self.encode(Image.new('L', (64, 64)), 'PNG')
+        for file_id, md5 in (('a', MD5_1), ('b', MD5_2)):
+            self.drive.add_file(file_id, md5=md5, size=len(content), mime_type='image/png', content=content)
+        self.service.fail_next(1, status=503, endpoint='thumbnail')
+        stats = reset_stats()
+
+        groups = self.find()
+        self.assertEqual([(kind, sorted(file['id'] for file in group)) for kind, group in groups],
+                         [('image', ['a', 'b'])])
+        thumbnails = stats.report()['requests']['thumbnail']
+        self.assertEqual((thumbnails['calls'], thumbnails['errors'], thumbnails['retries']), (3, 1, 1))
+
+
+class TestLocalHashing(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmpdir.name, 'local')
+        os.makedirs(os.path.join(self.root, 'sub'))
+        self.contents = {'a.txt': b'already uploaded', os.path.join('sub', 'b.txt'): b'only on this disk',
+                         'c.txt': b'same size!'}
+        for name, data in self.contents.items():
+            with open(os.path.join(self.root, name), 'wb') as local_file:
+                local_file.write(data)
+        self.cache_path = os.path.join(self.tmpdir.name, 'hashes.sqlite')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_hashes_are_cached_and_size_prefilter_skips_files(self):
+        results = hash_local_tree(self.root, workers=2, cache_path=self.cache_path)
+        expected = {os.path.join(self.root, name): hashlib.md5(data).hexdigest()
+                    for name, data in self.contents.items()}
+        self.assertEqual({path: md5 for path, _, md5 in results}, expected)
+
+        with patch('duplicate_scanner.ProcessPoolExecutor') as executor:
+            cached = hash_local_tree(self.root, cache_path=self.cache_path)
+        executor.return_value.__enter__.return_value.map.assert_called_once_with(
+            unittest.mock.ANY, [], chunksize=unittest.mock.ANY)
+        self.assertEqual({path: md5 for path, _, md5 in cached}, expected)
+
+        filtered = hash_local_tree(self.root, workers=1, sizes={len(b'already uploaded')})
+        self.assertEqual(sorted(md5 is not None for _, _, md5 in filtered), [False, False, True])
+
+    def test_read_errors_in_the_hashing_processes_reach_the_log(self):
+        root = logging.getLogger()
+        handlers, level = root.handlers[:], root.level
+        self.addCleanup(lambda: (setattr(root, 'handlers', handlers), root.setLevel(level)))
+        log_path = os.path.join(self.tmpdir.name, 'scan.log')
+        missing = os.path.join(self.root, 'deleted.txt')
+
+        with patch('sys.stdout'), patch('duplicate_scanner._walk_local_files', return_value=[(missing, 1, 0)]):
+            configure_logging(log_path)
+            results = hash_local_tree(self.root, workers=1)
+            stop_logging()
+        self.assertEqual(results, [(missing, 1, None)])
+        with open(log_path) as log:
+            self.assertIn(f"ERROR - Could not read local file {missing}", log.read())
+
+    def test_report_marks_local_files_found_in_drive(self):
+        drive = FakeDrive()
+        drive.add_file('d1', md5=hashlib.md5(b'already uploaded').hexdigest(), size=16)
+        drive.add_file('d2', md5=hashlib.md5(b'already uploaded').hexdigest(), size=16)
+        drive.add_file('d3', md5=hashlib.md5(b'something else').hexdigest(), size=10)
+        report_path = os.path.join(self.tmpdir.name, 'report.csv')
+
+        found = compare_local_to_drive(FakeDriveService(drive), self.root, report_path, hash_workers=2,
+                                       hash_cache_path=self.cache_path)
+
+        self.assertEqual(found, 1)
+        with open(report_path, newline='') as report:
+            rows = {os.path.relpath(row['path'], self.root): row for row in csv.DictReader(report)}
+        self.assertEqual(rows['a.txt']['in_drive'], 'yes')
+        self.assertEqual(sorted(rows['a.txt']['drive_ids'].split()), ['d1', 'd2'])
+        self.assertEqual(rows['c.txt']['in_drive'], 'no')
+        self.assertEqual(rows[os.path.join('sub', 'b.txt')]['md5'], '')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+from googleapiclient.errors import HttpError
+from fake_drive import FakeDrive, FakeDriveService, build_synthetic_drive, FOLDER_MIME_TYPE
+
+
+class TestFakeDriveService(unittest.TestCase):
+
+    def setUp(self):
+        self.drive = FakeDrive()
+        self.drive.add_folder("folderA")
+        self.drive.add_file("a", "a.txt", parent="folderA", md5="m1", size=10, modified_time="2021-05-01T00:00:00.000Z")
+        self.drive.add_file("b", "b.txt", parent="root", md5="m1", size=10, modified_time="2023-05-01T00:00:00.000Z")
+        self.drive.add_file("doc", "doc", parent="folderA", mime_type="application/vnd.google-apps.document")
+        self.service = FakeDriveService(self.drive)
+
+    def list_ids(self, q, **kwargs):
+        return [f['id'] for f in self.service.files().list(q=q, **kwargs).execute()['files']]
+
+    def test_query_filters(self):
+        self.assertEqual(self.list_ids(f"'folderA' in parents and mimeType != '{FOLDER_MIME_TYPE}'"), ["a", "doc"])
+        self.assertEqual(self.list_ids("('folderA' in parents or 'root' in parents) and trashed = false "
+                                       "and modifiedTime >= '2022-01-01T00:00:00'"), ["b"])
+        self.assertEqual(self.list_ids(f"mimeType = '{FOLDER_MIME_TYPE}'"), ["folderA"])
+        self.assertEqual(self.list_ids("not name contains 'txt'"), ["folderA", "doc"])
+
+    def test_pagination_and_fields_projection(self):
+        response = self.service.files().list(q="trashed = false", pageSize=2,
+                                             fields="nextPageToken, files(id, md5Checksum)").execute()
+        self.assertEqual(response['files'], [{'id': 'folderA'}, {'id': 'a', 'md5Checksum': 'm1'}])
+        response = self.service.files().list(q="trashed = false", pageSize=2, fields="nextPageToken, files(id)",
+                                             pageToken=response['nextPageToken']).execute()
+        self.assertEqual(response, {'files': [{'id': 'b'}, {'id': 'doc'}]})
+
+    def test_changes_feed_reports_updates(self):
+        token = self.service.changes().getStartPageToken().execute()['startPageToken']
+        self.service.files().update(fileId="a", body={'trashed': True}).execute()
+        self.drive.delete("b")
+        response = self.service.changes().list(pageToken=token, fields="newStartPageToken, changes(fileId, removed, file(trashed))").execute()
+        self.assertEqual(response['changes'], [{'fileId': 'a', 'removed': False, 'file': {'trashed': True}},
+                                               {'fileId': 'b', 'removed': True}])
+        self.assertEqual(int(response['newStartPageToken']), int(token) + 2)
+
+    def test_batch_reports_errors_per_item(self):
+        results = {}
+        batch = self.service.new_batch_http_request(
+            callback=lambda request_id, response, error: results.__setitem__(request_id, error))
+        batch.add(self.service.files().get(fileId="a"), request_id="1")
+        batch.add(self.service.files().get(fileId="missing"), request_id="2")
+        batch.execute()
+        self.assertIsNone(results["1"])
+        self.assertEqual(results["2"].resp.status, 404)
+        self.assertEqual(self.service.round_trips, 1)
+
+    def test_scripted_errors(self):
+        self.service.fail_next(1, 429, 'files.list')
+        with self.assertRaises(HttpError) as context:
+            self.list_ids("trashed = false")
+        self.assertEqual(context.exception.resp.status, 429)
+        self.assertEqual(len(self.list_ids("trashed = false")), 4)
+
+    def test_synthetic_drive_has_duplicates_and_native_files(self):
+        drive = build_synthetic_drive(1000, folders=20)
+        files = [f for f in drive.files.values() if f.mime_type != FOLDER_MIME_TYPE]
+        md5s = [f.md5 for f in files if f.md5]
+        self.assertEqual(len(files), 1000)
+        self.assertLess(len(md5s), 1000)
+        self.assertLess(len(set(md5s)), len(md5s))
+
+
+if __name__ == '__main__':
+    unittest.main()